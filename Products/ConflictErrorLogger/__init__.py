@@ -1,3 +1,8 @@
 # -*- coding: utf-8 -*-
-from Products.ConflictErrorLogger.patch import doConnectionMonkeyPatch
-from Products.ConflictErrorLogger.patch import doConflictErrorMonkeyPatch
+
+def initialize(context):
+    """ Install the patches when Zope initializes the product, not when the
+    package is imported (the offline tools import it too).
+    """
+    from Products.ConflictErrorLogger import patch
+    patch.initialize()
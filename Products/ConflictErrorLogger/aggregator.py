@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+""" Share the objects being changed between the processes (ZEO clients) of a
+host, through a SQLite database in WAL mode (CELogger_AGGREGATOR_DB).
+
+Each process publishes the objects its connections start changing, and the
+end of their transactions. The request threads only put the items in a
+bounded queue (dropped when full); a background thread writes them in
+batches and looks for the objects also changed in another process. The
+stacks are formatted by that thread, once per signature, so a process can
+show the stack of another one when a ConflictError is raised.
+
+The ended transactions are kept AGGREGATOR_RETENTION seconds: a conflict is
+usually raised after the other process committed.
+"""
+
+import os
+import time
+import errno
+import threading
+import logging
+import Queue
+import sqlite3
+from ZODB.utils import u64, p64
+from Products.ConflictErrorLogger.stacks import format_stack
+
+AGGREGATOR_QUEUE_SIZE = 10000
+AGGREGATOR_RETENTION = 60
+# Rows of processes that died without ending their transactions
+AGGREGATOR_MAX_AGE = 3600
+BATCH_SIZE = 500
+PURGE_INTERVAL = 10
+CONNECT_TIMEOUT = 5
+# The lookup of a ConflictError (on the request thread) waits this long for
+# a locked database, then the database is not read for QUERY_BACKOFF seconds
+QUERY_TIMEOUT = 0.05
+QUERY_BACKOFF = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirty (
+    oid INTEGER NOT NULL,
+    pid INTEGER NOT NULL,
+    conn INTEGER NOT NULL,
+    sig INTEGER,
+    stamp REAL NOT NULL,
+    ended REAL,
+    PRIMARY KEY (pid, conn, oid)
+);
+CREATE INDEX IF NOT EXISTS dirty_oid ON dirty (oid);
+CREATE TABLE IF NOT EXISTS stacks (
+    pid INTEGER NOT NULL,
+    sig INTEGER NOT NULL,
+    stack TEXT,
+    PRIMARY KEY (pid, sig)
+);
+"""
+
+log = logging.getLogger("CELogger.aggregator")
+
+def process_alive(pid):
+    """ Check if the process (of this host) is still running
+    """
+    if os.name != 'posix':
+        # Signal 0 would terminate it on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+def connect(path, timeout=CONNECT_TIMEOUT):
+    """ Open the database in WAL mode
+    """
+    db = sqlite3.connect(path, timeout)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+class Aggregator(object):
+    """ Publish the registers of this process, fetch the ones of the others.
+
+    `on_overlap(oid, others)` is called (by the background thread) for the
+    objects changed in this process and being changed in another one, with
+    the (pid, connection, time) of the others.
+    """
+
+    def __init__(self, path, stack_table, on_overlap=None,
+                 queue_size=AGGREGATOR_QUEUE_SIZE, pid=None):
+        self.path = path
+        self.stack_table = stack_table
+        self.on_overlap = on_overlap
+        self.pid = pid or os.getpid()
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.errors = 0
+        # Signatures whose stack is in the database
+        self.published_sigs = set()
+        self.last_purge = 0
+        # The lookups are skipped until then (see other_processes)
+        self.skip_until = 0
+
+        db = connect(path)
+        try:
+            db.executescript(SCHEMA)
+            # A previous process with the same pid
+            db.execute("DELETE FROM dirty WHERE pid = ?", (self.pid,))
+            db.execute("DELETE FROM stacks WHERE pid = ?", (self.pid,))
+            db.commit()
+        finally:
+            db.close()
+
+        self.writer = threading.Thread(target=self.write_items,
+                                       name="CELogger aggregator")
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    #--------------------------------------------------------------------------
+    #   Request threads (never wait)
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            self.dropped += 1
+
+    def publish_register(self, oid, conn_id, sig):
+        """ The connection (id) started changing the object
+        """
+        self.put(('register', u64(oid), conn_id, sig, time.time()))
+
+    def publish_registers(self, registers):
+        """ The connections started changing the objects, a list of
+        (oid, connection id, signature, time)
+        """
+        self.put(('registers', [(u64(oid), conn_id, sig, stamp)
+                                for oid, conn_id, sig, stamp in registers]))
+
+    def publish_end(self, conn_id):
+        """ The transaction of the connection (id) ended
+        """
+        self.put(('end', conn_id, time.time()))
+
+    def other_processes(self, oid):
+        """ Get the (pid, connection, time, ended, stack) of the other
+        processes changing the object (or that ended changing it lately).
+        Empty while the lookups are skipped after a failure.
+        """
+        if time.time() < self.skip_until:
+            return []
+        try:
+            # Already in WAL mode (see connect), just read
+            db = sqlite3.connect(self.path, QUERY_TIMEOUT)
+            try:
+                return db.execute(
+                    "SELECT d.pid, d.conn, d.stamp, d.ended, s.stack "
+                    "FROM dirty d LEFT JOIN stacks s "
+                    "ON s.pid = d.pid AND s.sig = d.sig "
+                    "WHERE d.oid = ? AND d.pid != ? ORDER BY d.stamp",
+                    (u64(oid), self.pid)).fetchall()
+            finally:
+                db.close()
+        except sqlite3.Error, e:
+            self.errors += 1
+            self.skip_until = time.time() + QUERY_BACKOFF
+            log.warning("Can't read the aggregator database %s: %s (not "
+                        "read for %ss)" % (self.path, e, QUERY_BACKOFF))
+            return []
+
+    #--------------------------------------------------------------------------
+    #   Background thread
+
+    def write_items(self):
+        """ Write the queued items until the aggregator is closed (None)
+        """
+        db = connect(self.path)
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < BATCH_SIZE and batch[-1] is not None:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if batch[-1] is None:
+                running = False
+            try:
+                try:
+                    self.write_batch(db, [i for i in batch if i is not None])
+                except sqlite3.Error, e:
+                    self.errors += 1
+                    db.rollback()
+                    # The stacks of the batch were not written
+                    self.published_sigs = set()
+                    log.warning("Can't write the aggregator database %s: "
+                                "%s" % (self.path, e))
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+        db.close()
+
+    def write_batch(self, db, items):
+        """ Write the items in one transaction, then look for overlaps
+        """
+        registered = []
+        for item in items:
+            if item[0] == 'register':
+                registers = [item[1:]]
+            elif item[0] == 'registers':
+                registers = item[1]
+            else:
+                registers = None
+            if registers is not None:
+                for oid, conn, sig, stamp in registers:
+                    if sig is not None and sig not in self.published_sigs:
+                        self.write_stack(db, sig)
+                    db.execute("INSERT OR REPLACE INTO dirty "
+                               "(oid, pid, conn, sig, stamp, ended) "
+                               "VALUES (?, ?, ?, ?, ?, NULL)",
+                               (oid, self.pid, conn, sig, stamp))
+                    registered.append(oid)
+            else:
+                kind, conn, stamp = item
+                db.execute("UPDATE dirty SET ended = ? "
+                           "WHERE pid = ? AND conn = ? AND ended IS NULL",
+                           (stamp, self.pid, conn))
+        now = time.time()
+        if now - self.last_purge > PURGE_INTERVAL:
+            self.purge(db, now)
+        db.commit()
+
+        if self.on_overlap is None:
+            return
+        for oid in registered:
+            others = db.execute(
+                "SELECT pid, conn, stamp FROM dirty "
+                "WHERE oid = ? AND pid != ? AND ended IS NULL",
+                (oid, self.pid)).fetchall()
+            if others:
+                try:
+                    self.on_overlap(p64(oid), others)
+                except Exception:
+                    log.exception("Error reporting an overlap")
+
+    def write_stack(self, db, sig):
+        """ Write the formatted stack of the signature
+        """
+        stack = self.stack_table.get(sig)
+        if stack is None:
+            return
+        if len(self.published_sigs) >= 2 * self.stack_table.size:
+            self.published_sigs = set()
+        self.published_sigs.add(sig)
+        db.execute("INSERT OR REPLACE INTO stacks (pid, sig, stack) "
+                   "VALUES (?, ?, ?)", (self.pid, sig, format_stack(stack)))
+
+    def purge(self, db, now):
+        """ Remove the old ended transactions, and the stacks no more used.
+
+        A process only removes its own stacks (it publishes them again when
+        needed), and the ones of the processes that died: an idle process
+        may change an object again with a stack it already published.
+        """
+        self.last_purge = now
+        db.execute("DELETE FROM dirty WHERE ended < ? OR stamp < ?",
+                   (now - AGGREGATOR_RETENTION, now - AGGREGATOR_MAX_AGE))
+        unused = db.execute(
+            "SELECT sig FROM stacks WHERE pid = ? AND sig NOT IN "
+            "(SELECT sig FROM dirty WHERE pid = ? AND sig IS NOT NULL)",
+            (self.pid, self.pid)).fetchall()
+        db.executemany("DELETE FROM stacks WHERE pid = ? AND sig = ?",
+                       [(self.pid, sig) for (sig,) in unused])
+        self.published_sigs.difference_update([sig for (sig,) in unused])
+        idle = db.execute(
+            "SELECT DISTINCT pid FROM stacks WHERE pid != ? AND pid NOT IN "
+            "(SELECT DISTINCT pid FROM dirty)", (self.pid,)).fetchall()
+        for (pid,) in idle:
+            if not process_alive(pid):
+                db.execute("DELETE FROM stacks WHERE pid = ?", (pid,))
+
+    def flush(self):
+        """ Wait until the queued items are written
+        """
+        if self.writer.isAlive():
+            self.queue.join()
+
+    def close(self):
+        """ Write the queued items and stop the background thread
+        """
+        if self.writer.isAlive():
+            self.queue.put(None)
+            self.writer.join(CONNECT_TIMEOUT)
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+""" Find the conflict hotspots in CELogger log files.
+
+    celogger-analyze [options] LOGFILE [LOGFILE...]
+
+The files (text or JSON logs, rotated, gzipped or not) are streamed line by
+line. The counters are bounded (see stats.HeavyHitters) and the conflict
+rate is kept in at most MAX_BUCKETS intervals (merged when there are more)
+and the stacks of the JSON logs in a cache of the last used ones (see
+reader.StackCache), so the memory does not grow with the size of the logs. With --jobs the files
+are read in parallel by a process pool.
+
+The report shows the objects (oids), classes and source lines of the most
+frequent ConflictErrors, the overlaps, and the conflict rate over time. The
+source line of a conflict is the last frame of the traceback of the change
+outside ZODB and this product. The objects and classes whose conflicts
+wasted the most time in request retries come with the seconds wasted per
+hour (of the logged time).
+"""
+
+import re
+import sys
+import json
+import time
+import optparse
+from Products.ConflictErrorLogger.stats import HeavyHitters
+from Products.ConflictErrorLogger.reader import open_log
+from Products.ConflictErrorLogger.reader import StackCache
+from Products.ConflictErrorLogger.stacks import OMITTED_FILENAME
+from Products.ConflictErrorLogger.stacks import OMITTED_PREFIX
+from Products.ConflictErrorLogger.events import MSG_OBJ_CONFLICT
+from Products.ConflictErrorLogger.events import MSG_OBJ_CONFLICT_DETECTED
+from Products.ConflictErrorLogger.events import MSG_OBJ_CROSS_PROCESS
+from Products.ConflictErrorLogger.events import MSG_REQUEST_RETRIED
+from Products.ConflictErrorLogger.events import MSG_REPORT_REPEATED
+from Products.ConflictErrorLogger.events import EVENT_CONFLICT
+from Products.ConflictErrorLogger.events import EVENT_OVERLAP
+from Products.ConflictErrorLogger.events import EVENT_STACK
+from Products.ConflictErrorLogger.events import EVENT_RETRY
+from Products.ConflictErrorLogger.events import EVENT_REPEATED
+
+TOP_SIZE = 1000
+INTERVAL = 300
+MAX_BUCKETS = 1000
+# Frames of the changes that are not the application code
+SKIP_FRAMES = ('/ZODB/', '/persistent/', '/transaction/',
+               'ConflictErrorLogger/patch.py', 'ConflictErrorLogger/monitor.py')
+
+# 2010-01-01 10:00:00,123 - WARNING - [time: ...]: message
+RECORD_RE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d+ - \w+ - (.*)$')
+OID_RE = re.compile(r'object\._p_oid: (0x[0-9a-fA-F]+)')
+CLASS_RE = re.compile(r'object\.to_string: <([\w.]+) object at 0x')
+RETRY_CLASS_RE = re.compile(r', class: ([\w.]+),')
+WASTED_RE = re.compile(r', wasted: ([\d.]+)s')
+REPEATED_RE = re.compile(r'\(event: ([\w-]+), object\._p_oid: (\w+), '
+                         r'class: ([\w.]+), .*occurrences: (\d+) ')
+FRAME_RE = re.compile(r'^  File "(.*)", line (\d+), in (.*)$')
+BLOCK_START = ">>>>>>>>"
+BLOCK_END = "<<<<<<<<"
+
+def source_line(filename, lineno, name):
+    """ Get the hotspot key of a frame, None if it must be skipped
+    """
+    if filename == OMITTED_FILENAME:
+        return None
+    for skip in SKIP_FRAMES:
+        if skip in filename:
+            return None
+    return "%s:%s (%s)" % (filename, lineno, name)
+
+class Analysis(object):
+    """ The bounded counters of the conflicts and overlaps.
+    """
+
+    def __init__(self, size=TOP_SIZE, interval=INTERVAL):
+        self.size = size
+        self.interval = interval
+        self.conflicts = dict([(dimension, HeavyHitters(size))
+                               for dimension in ('oid', 'class', 'line')])
+        self.overlaps = dict([(dimension, HeavyHitters(size))
+                              for dimension in ('oid', 'class')])
+        # Milliseconds wasted by the retries
+        self.wasted = dict([(dimension, HeavyHitters(size))
+                            for dimension in ('oid', 'class')])
+        self.total_conflicts = 0
+        self.total_overlaps = 0
+        self.retries = 0
+        self.total_wasted = 0.0
+        # Start of the interval -> conflicts
+        self.rate = {}
+        self.first = None
+        self.last = None
+
+    def seen(self, ts):
+        if self.first is None or ts < self.first:
+            self.first = ts
+        if self.last is None or ts > self.last:
+            self.last = ts
+
+    def conflict(self, ts, oid=None, klass=None, n=1):
+        self.seen(ts)
+        self.total_conflicts += n
+        self.add(self.conflicts, 'oid', oid, n)
+        self.add(self.conflicts, 'class', klass, n)
+        bucket = ts - ts % self.interval
+        self.rate[bucket] = self.rate.get(bucket, 0) + n
+        if len(self.rate) > MAX_BUCKETS:
+            self.rebucket(self.interval * 2)
+
+    def overlap(self, ts, oid=None, klass=None, n=1):
+        self.seen(ts)
+        self.total_overlaps += n
+        self.add(self.overlaps, 'oid', oid, n)
+        self.add(self.overlaps, 'class', klass, n)
+
+    def repeated(self, ts, event, oid=None, klass=None, n=1):
+        """ Count the events only counted by the logger (see reporting.py)
+        """
+        if event == EVENT_CONFLICT:
+            self.conflict(ts, oid, klass, n)
+        elif event == EVENT_OVERLAP:
+            self.overlap(ts, oid, klass, n)
+
+    def waste(self, ts, oid=None, klass=None, seconds=0.0):
+        self.seen(ts)
+        self.retries += 1
+        self.total_wasted += seconds
+        ms = int(seconds * 1000)
+        if ms > 0:
+            self.add(self.wasted, 'oid', oid, ms)
+            self.add(self.wasted, 'class', klass, ms)
+
+    def line(self, line):
+        self.add(self.conflicts, 'line', line)
+
+    def add(self, counters, dimension, key, n=1):
+        if key is not None:
+            counters[dimension].add(key, n)
+
+    def rebucket(self, interval):
+        """ Count the conflict rate in longer intervals
+        """
+        rate = {}
+        for bucket, count in self.rate.items():
+            bucket = bucket - bucket % interval
+            rate[bucket] = rate.get(bucket, 0) + count
+        self.rate = rate
+        self.interval = interval
+
+    def merge(self, other):
+        """ Add the counts of the analysis of another file
+        """
+        for mine, others in ((self.conflicts, other.conflicts),
+                             (self.overlaps, other.overlaps),
+                             (self.wasted, other.wasted)):
+            for dimension, counter in others.items():
+                mine[dimension].merge(counter)
+        self.total_conflicts += other.total_conflicts
+        self.total_overlaps += other.total_overlaps
+        self.retries += other.retries
+        self.total_wasted += other.total_wasted
+        interval = max(self.interval, other.interval)
+        if interval != self.interval:
+            self.rebucket(interval)
+        for bucket, count in other.rate.items():
+            bucket = bucket - bucket % interval
+            self.rate[bucket] = self.rate.get(bucket, 0) + count
+        while len(self.rate) > MAX_BUCKETS:
+            self.rebucket(self.interval * 2)
+        for ts in (other.first, other.last):
+            if ts is not None:
+                self.seen(ts)
+
+    def per_hour(self, seconds):
+        """ Get the seconds per hour of the logged time
+        """
+        if self.first is None:
+            return 0.0
+        return seconds * 3600 / max(self.last - self.first, 1)
+
+    def as_dict(self, n=10):
+        """ The report, as a dict (JSON)
+        """
+        return {
+            'conflicts': self.total_conflicts,
+            'overlaps': self.total_overlaps,
+            'first': self.first,
+            'last': self.last,
+            'interval': self.interval,
+            'top_conflicts': dict([(dimension, counter.most_common(n))
+                                   for dimension, counter
+                                   in self.conflicts.items()]),
+            'top_overlaps': dict([(dimension, counter.most_common(n))
+                                  for dimension, counter
+                                  in self.overlaps.items()]),
+            'rate': sorted(self.rate.items()),
+            'retries': self.retries,
+            'wasted': self.total_wasted,
+            'wasted_per_hour': self.per_hour(self.total_wasted),
+            # (seconds per hour, seconds, key)
+            'top_wasted': dict([(dimension,
+                                 [(self.per_hour(ms / 1000.0), ms / 1000.0,
+                                   key) for ms, key in counter.most_common(n)])
+                                for dimension, counter
+                                in self.wasted.items()]),
+        }
+
+    def report(self, n=10):
+        """ The report, as text
+        """
+        data = self.as_dict(n)
+        lines = ["Conflicts: %(conflicts)s, overlaps: %(overlaps)s" % data]
+        if self.first is not None:
+            lines.append("From %s to %s" % (format_time(self.first),
+                                            format_time(self.last)))
+        for title, top in (("conflicts", data['top_conflicts']),
+                           ("overlaps", data['top_overlaps'])):
+            for dimension in ('oid', 'class', 'line'):
+                if dimension not in top:
+                    continue
+                lines.append("")
+                lines.append("Top %s by %s:" % (title, dimension))
+                for count, key in top[dimension]:
+                    lines.append("%8d  %s" % (count, key))
+        if self.retries:
+            lines.append("")
+            lines.append("Retries: %(retries)s, wasted %(wasted).1fs "
+                         "(%(wasted_per_hour).1fs per hour)" % data)
+            for dimension in ('oid', 'class'):
+                lines.append("")
+                lines.append("Top wasted seconds per hour by %s:" % dimension)
+                for per_hour, seconds, key in data['top_wasted'][dimension]:
+                    lines.append("%8.1f  %s (%.1fs)" % (per_hour, key,
+                                                        seconds))
+        if data['rate']:
+            lines.append("")
+            lines.append("Conflicts per %s seconds:" % self.interval)
+            highest = max([count for bucket, count in data['rate']])
+            for bucket, count in data['rate']:
+                lines.append("%s %8d %s" % (format_time(bucket), count,
+                                            "#" * (count * 50 // highest)))
+        return "\n".join(lines)
+
+def format_time(ts):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+
+class LogParser(object):
+    """ Read a log file into an Analysis, one line at a time.
+    """
+
+    def __init__(self, analysis):
+        self.analysis = analysis
+        # The last parsed date, most lines share it
+        self.date = (None, None)
+        # The hotspot of each (pid, signature) of the JSON logs
+        self.stack_lines = StackCache()
+
+    def parse_time(self, date):
+        if self.date[0] != date:
+            self.date = (date, time.mktime(time.strptime(date,
+                                                         '%Y-%m-%d %H:%M:%S')))
+        return self.date[1]
+
+    def parse(self, f):
+        in_block = False
+        hotspot = None
+        for line in f:
+            if line.startswith('{'):
+                self.parse_event(line)
+                continue
+            if in_block:
+                line = line.rstrip('\n')
+                match = FRAME_RE.match(line)
+                if match is not None:
+                    frame = source_line(match.group(1), match.group(2),
+                                        match.group(3))
+                    if frame is not None:
+                        hotspot = frame
+                    continue
+                if line.startswith('    ') or line.startswith(OMITTED_PREFIX):
+                    # Source of the frame, or frames left out
+                    continue
+                # Next entry, or end of the block
+                if hotspot is not None:
+                    self.analysis.line(hotspot)
+                    hotspot = None
+                if line.startswith(BLOCK_END):
+                    in_block = False
+                continue
+
+            match = RECORD_RE.match(line)
+            if match is None:
+                if line.startswith(BLOCK_START):
+                    in_block = True
+                continue
+            message = match.group(2)
+            # [time: ..., object._p_oid: ..., ...]: message
+            text = message.split(']: ', 1)[-1]
+            if text.startswith(MSG_OBJ_CONFLICT):
+                kind = self.analysis.conflict
+            elif (text.startswith(MSG_OBJ_CONFLICT_DETECTED) or
+                  text.startswith(MSG_OBJ_CROSS_PROCESS)):
+                kind = self.analysis.overlap
+            elif text.startswith(MSG_REQUEST_RETRIED):
+                self.parse_retry(self.parse_time(match.group(1)), text)
+                continue
+            elif text.startswith(MSG_REPORT_REPEATED):
+                self.parse_repeated(self.parse_time(match.group(1)), text)
+                continue
+            else:
+                continue
+            oid = OID_RE.search(message)
+            klass = CLASS_RE.search(message)
+            kind(self.parse_time(match.group(1)),
+                 oid and oid.group(1), klass and klass.group(1))
+        if hotspot is not None:
+            self.analysis.line(hotspot)
+
+    def parse_retry(self, ts, text):
+        oid = OID_RE.search(text)
+        klass = RETRY_CLASS_RE.search(text)
+        klass = klass and klass.group(1)
+        wasted = WASTED_RE.search(text)
+        self.analysis.waste(ts, oid and oid.group(1),
+                            klass != 'None' and klass or None,
+                            wasted and float(wasted.group(1)) or 0.0)
+
+    def parse_repeated(self, ts, text):
+        match = REPEATED_RE.search(text)
+        if match is None:
+            return
+        event, oid, klass, count = match.groups()
+        self.analysis.repeated(ts, event, oid != 'None' and oid or None,
+                               klass != 'None' and klass or None, int(count))
+
+    def parse_event(self, line):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return
+        kind = event.get('event')
+        if kind == EVENT_STACK:
+            for frame in reversed(event['frames']):
+                hotspot = source_line(*frame)
+                if hotspot is not None:
+                    self.stack_lines.set((event.get('pid'), event['sig']),
+                                         hotspot)
+                    break
+        elif kind == EVENT_CONFLICT:
+            self.analysis.conflict(event['ts'], event.get('oid'),
+                                   event.get('class'))
+            for other in event.get('others', ()):
+                for record_kind, stamp, sig in other['records']:
+                    hotspot = self.stack_lines.get((event.get('pid'), sig))
+                    if hotspot is not None:
+                        self.analysis.line(hotspot)
+        elif kind == EVENT_OVERLAP:
+            self.analysis.overlap(event['ts'], event.get('oid'),
+                                  event.get('class'))
+        elif kind == EVENT_RETRY:
+            self.analysis.waste(event['ts'], event.get('oid'),
+                                event.get('class'), event.get('wasted', 0.0))
+        elif kind == EVENT_REPEATED:
+            self.analysis.repeated(event['ts'], event.get('kind'),
+                                   event.get('oid'), event.get('class'),
+                                   event.get('count', 0))
+
+def analyze(path, size=TOP_SIZE, interval=INTERVAL):
+    """ Get the Analysis of a log file
+    """
+    analysis = Analysis(size, interval)
+    f = open_log(path)
+    try:
+        LogParser(analysis).parse(f)
+    finally:
+        f.close()
+    return analysis
+
+def analyze_args(args):
+    # Pool.map passes one argument
+    return analyze(*args)
+
+def analyze_all(paths, size=TOP_SIZE, interval=INTERVAL, jobs=0):
+    """ Get the Analysis of all the log files, read by `jobs` processes
+    """
+    args = [(path, size, interval) for path in paths]
+    if jobs > 1 and len(paths) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # imap: the analyses are merged as they come
+            results = pool.imap_unordered(analyze_args, args)
+            analysis = Analysis(size, interval)
+            for result in results:
+                analysis.merge(result)
+        finally:
+            pool.close()
+            pool.join()
+        return analysis
+    analysis = Analysis(size, interval)
+    for arg in args:
+        analysis.merge(analyze_args(arg))
+    return analysis
+
+def main(args=None):
+    parser = optparse.OptionParser(
+                usage="%prog [options] LOGFILE [LOGFILE...]",
+                description="Report the conflict hotspots of CELogger log "
+                            "files (text or JSON, gzipped or not).")
+    parser.add_option('-n', '--top', type='int', default=10,
+                      help="number of hotspots to show (default: %default)")
+    parser.add_option('-i', '--interval', type='int', default=INTERVAL,
+                      help="seconds of each conflict rate interval "
+                           "(default: %default)")
+    parser.add_option('-j', '--jobs', type='int', default=0,
+                      help="read the files with a pool of processes")
+    parser.add_option('--json', action='store_true',
+                      help="write the report as JSON")
+    options, paths = parser.parse_args(args)
+    if not paths:
+        parser.error("no log file")
+
+    analysis = analyze_all(paths, interval=options.interval,
+                           jobs=options.jobs)
+    if options.json:
+        json.dump(analysis.as_dict(options.top), sys.stdout, indent=1)
+        print
+    else:
+        print analysis.report(options.top)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from cgi import escape
+from Products.Five.browser import BrowserView
+from Products.ConflictErrorLogger import patch
+from Products.ConflictErrorLogger import metrics
+
+STATS_TOP = 10
+
+PAGE = """<html>
+<head><title>ConflictErrorLogger</title></head>
+<body>
+<h1>ConflictErrorLogger</h1>
+<p>The logger is <strong>%(state)s</strong>.</p>
+<p>Objects being changed: %(objects)s, pool entries: %(entries)s
+(about %(bytes)s bytes), evicted: %(evicted)s.</p>
+<h2>Top offenders</h2>
+<pre>%(stats)s</pre>
+<form method="post" action="%(url)s">
+<input type="submit" name="activate" value="Activate" />
+<input type="submit" name="deactivate" value="Deactivate" />
+</form>
+</body>
+</html>
+"""
+
+class ControlView(BrowserView):
+    """ Show the state of the logger, activate or deactivate it.
+    """
+
+    def __call__(self):
+        # Only change the state on a POST (the form)
+        if self.request.get('REQUEST_METHOD') == 'POST':
+            if 'activate' in self.request.form:
+                patch.activate()
+            elif 'deactivate' in self.request.form:
+                patch.deactivate()
+        return self.render()
+
+    def render(self):
+        """ The state of the logger and the form.
+        """
+        conflictLogger = patch.conflictLogger
+        entries, size = conflictLogger.pool_size()
+        stats = conflictLogger.stats
+        if stats is not None:
+            stats = stats.report(STATS_TOP)
+        else:
+            stats = "(disabled, see CELogger_STATS_TOP_SIZE)"
+        evicted = ", ".join(["%s: %s" % item for item in
+                             sorted(conflictLogger.evicted.items())])
+        return PAGE % {
+            'state': patch.is_active() and "active" or "inactive",
+            'objects': len(conflictLogger.dirty_index),
+            'entries': entries,
+            'bytes': size,
+            'evicted': escape(evicted),
+            'stats': escape(stats),
+            'url': escape(self.request.get('URL', ''), True),
+        }
+
+class MetricsView(BrowserView):
+    """ The metrics of the logger, in the Prometheus text format.
+    """
+
+    def __call__(self):
+        self.request.response.setHeader('Content-Type', metrics.CONTENT_TYPE)
+        return metrics.render(patch.conflictLogger, patch.is_active())
@@ -4,7 +4,15 @@ import Signals.Signals
 import ZConfig.components.logger.loghandler
 import ZServer.BaseLogger
 import logging
+import os
 import os.path
+import re
+import time
+import gzip
+import shutil
+import threading
+import Queue
+import json
 
 try:
     from signal import SIGUSR2
@@ -22,13 +30,367 @@ class NullHandler(logging.Handler):
     def emit(self, *args, **kw):
         pass
 
+# Overflow policies of the log queue
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEW = 'drop-new'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEW, OVERFLOW_BLOCK)
+BATCH_SIZE = 100
+CLOSE_TIMEOUT = 10
+# Formats of the log file
+LOG_FORMAT_TEXT = 'text'
+LOG_FORMAT_JSON = 'json'
+LOG_FORMATS = (LOG_FORMAT_TEXT, LOG_FORMAT_JSON)
+# Rotated files kept (0 all)
+LOG_BACKUPS = 10
+# Suffix of the rotated files: logfile.20100101-100000.123456[.gz]
+ROTATED_RE = re.compile(r'^\.\d{8}-\d{6}\.\d{6}(\.gz)?$')
+
+class JSONFormatter(logging.Formatter):
+    """ Format each record as one line of JSON (see reader.py).
+
+    The monitor passes the fields of its events in the `event` attribute of
+    the record (logging `extra`); other records are written as 'message'
+    events.
+    """
+
+    def __init__(self):
+        logging.Formatter.__init__(self)
+        self.pid = os.getpid()
+
+    def format(self, record):
+        data = getattr(record, 'event', None)
+        if data is None:
+            data = {'event': 'message', 'msg': record.getMessage()}
+        else:
+            data = data.copy()
+        data['ts'] = record.created
+        data['level'] = record.levelname
+        data['pid'] = self.pid
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, sort_keys=True)
+
+class Compressor(object):
+    """ Gzip the rotated log files and remove the oldest ones, in a
+    background thread: the thread writing the log only renames the file.
+    """
+
+    def __init__(self, baseFilename, backups=LOG_BACKUPS, compress=True):
+        self.baseFilename = baseFilename
+        self.backups = backups
+        self.compress = compress
+        self.queue = Queue.Queue()
+        self.worker = threading.Thread(target=self.run,
+                                       name="CELogger compressor")
+        self.worker.setDaemon(True)
+        self.worker.start()
+
+    def run(self):
+        """ Handle the rotated files until the compressor is closed (None)
+        """
+        while True:
+            path = self.queue.get()
+            try:
+                if path is None:
+                    return
+                try:
+                    if self.compress:
+                        self.gzip(path)
+                    self.remove_old()
+                except (IOError, OSError):
+                    # The file is kept as it is, the next rotation retries
+                    # the removals
+                    pass
+            finally:
+                self.queue.task_done()
+
+    def gzip(self, path):
+        """ Compress the file to path.gz, and remove it
+        """
+        temp = path + '.gz.tmp'
+        f = open(path, 'rb')
+        try:
+            out = gzip.open(temp, 'wb')
+            try:
+                shutil.copyfileobj(f, out)
+            finally:
+                out.close()
+        finally:
+            f.close()
+        os.rename(temp, path + '.gz')
+        os.remove(path)
+
+    def rotated(self):
+        """ Get the paths of the rotated files, oldest first
+        """
+        directory, prefix = os.path.split(self.baseFilename)
+        paths = [os.path.join(directory, name)
+                 for name in os.listdir(directory)
+                 if name.startswith(prefix) and
+                    ROTATED_RE.match(name[len(prefix):])]
+        paths.sort()
+        return paths
+
+    def remove_old(self):
+        """ Remove the oldest rotated files, over the backups to keep
+        """
+        if not self.backups:
+            return
+        paths = self.rotated()
+        for path in paths[:-self.backups]:
+            os.remove(path)
+
+    def add(self, path):
+        """ Queue a rotated file
+        """
+        self.queue.put(path)
+
+    def close(self):
+        """ Handle the queued files and stop the thread
+        """
+        if self.worker.isAlive():
+            self.queue.put(None)
+            self.worker.join(CLOSE_TIMEOUT)
+
+class RotatingFileHandler(ZConfig.components.logger.loghandler.FileHandler):
+    """ Rotate the log file when it is larger than max_bytes, and every
+    `interval` seconds (from midnight UTC, e.g. 3600 rotates at each hour).
+    0 disables either. The rotated files are renamed with the time of the
+    rotation, then compressed and removed by a Compressor. The file can
+    still be reopened (SIGUSR2) after an external rotation.
+    """
+
+    def __init__(self, filename, max_bytes=0, interval=0,
+                 backups=LOG_BACKUPS, compress=True):
+        ZConfig.components.logger.loghandler.FileHandler.__init__(self,
+                                                                  filename)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.compressor = Compressor(self.baseFilename, backups, compress)
+        self.opened()
+
+    def opened(self):
+        """ Start counting the size and time of the new file
+        """
+        self.stream.seek(0, 2)
+        self.written = self.stream.tell()
+        if self.interval:
+            now = time.time()
+            self.rollover_at = now - now % self.interval + self.interval
+        else:
+            self.rollover_at = None
+
+    def check_rollover(self, size):
+        """ Rotate the file if writing size bytes makes it too large or if
+        it is time to (the lock of the handler is held)
+        """
+        if ((self.max_bytes and self.written and
+             self.written + size > self.max_bytes) or
+            (self.rollover_at is not None and
+             time.time() >= self.rollover_at)):
+            self.rollover()
+        self.written += size
+
+    def rollover(self):
+        """ Rename the file with the time, and open a new one
+        """
+        self.stream.close()
+        now = time.time()
+        path = "%s.%s.%06d" % (self.baseFilename,
+                               time.strftime('%Y%m%d-%H%M%S',
+                                             time.localtime(now)),
+                               int(now % 1 * 1000000))
+        try:
+            os.rename(self.baseFilename, path)
+        except OSError:
+            # Removed or renamed meanwhile
+            path = None
+        self.stream = open(self.baseFilename, self.mode)
+        self.opened()
+        if path is not None:
+            self.compressor.add(path)
+
+    def emit(self, record):
+        try:
+            text = self.format(record) + "\n"
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            self.check_rollover(len(text))
+            self.stream.write(text)
+            self.flush()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def reopen(self):
+        ZConfig.components.logger.loghandler.FileHandler.reopen(self)
+        self.acquire()
+        try:
+            self.opened()
+        finally:
+            self.release()
+
+    def close(self):
+        ZConfig.components.logger.loghandler.FileHandler.close(self)
+        self.compressor.close()
+
+class QueueHandler(logging.Handler):
+    """ Put the records in a bounded queue; a background thread writes them
+    in batches to the target handler, so the threads changing objects never
+    wait for the disk.
+
+    When the queue is full the record is dropped (drop-new), the oldest
+    record is dropped (drop-oldest) or the thread waits (block). Dropped
+    records are counted in `dropped`.
+    """
+
+    def __init__(self, target, size, overflow=OVERFLOW_DROP_OLDEST):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r, use one of: %s" % (
+                             overflow, ", ".join(OVERFLOW_POLICIES)))
+        logging.Handler.__init__(self)
+        self.target = target
+        self.baseFilename = getattr(target, 'baseFilename', None)
+        self.queue = Queue.Queue(size)
+        self.overflow = overflow
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write_records,
+                                       name="CELogger writer")
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def prepare(self, record):
+        """ Format the message now: the arguments may change (or be used by
+        another thread) until the record is written.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+
+    def emit(self, record):
+        try:
+            self.prepare(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+            return
+
+        if self.overflow == OVERFLOW_BLOCK:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+            return
+        except Queue.Full:
+            pass
+        if self.overflow == OVERFLOW_DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except Queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(record)
+            except Queue.Full:
+                pass
+        self.dropped += 1
+
+    def write_records(self):
+        """ Write the queued records until the queue is closed (None)
+        """
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < BATCH_SIZE and batch[-1] is not None:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if batch[-1] is None:
+                running = False
+            try:
+                self.write_batch([r for r in batch if r is not None])
+            finally:
+                for r in batch:
+                    self.queue.task_done()
+
+    def write_batch(self, records):
+        """ Write the records with one write (and flush) in the target
+        """
+        target = self.target
+        records = [r for r in records if r.levelno >= target.level]
+        if not records:
+            return
+        if not isinstance(target, logging.StreamHandler):
+            for record in records:
+                target.handle(record)
+            return
+
+        target.acquire()
+        try:
+            try:
+                text = "".join([target.format(r) + "\n" for r in records])
+                if isinstance(target, RotatingFileHandler):
+                    if isinstance(text, unicode):
+                        text = text.encode('utf-8')
+                    target.check_rollover(len(text))
+                target.stream.write(text)
+                target.flush()
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                target.handleError(records[0])
+        finally:
+            target.release()
+
+    def flush(self):
+        """ Wait until the queued records are written
+        """
+        if self.writer.isAlive():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        """ Write the queued records and close the target
+        """
+        if self.writer.isAlive():
+            self.queue.put(None)
+            self.writer.join(CLOSE_TIMEOUT)
+        self.target.close()
+        logging.Handler.close(self)
+
+    # Log rotation (SIGUSR2)
+    def reopen(self):
+        self.target.reopen()
+
+    def rotate(self):
+        self.target.rotate()
+
 log = logging.getLogger("CELogger")
 #log.propagate = False
 #handler = NullHandler()
 #log.addHandler(handler)
 formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 
-def do_enable(logfile):
+def do_enable(logfile, queue_size=0, overflow=OVERFLOW_DROP_OLDEST,
+              log_format=LOG_FORMAT_TEXT, max_bytes=0, interval=0,
+              backups=LOG_BACKUPS, compress=True):
+    """ Log to the logfile. With a queue_size, the records are written by a
+    background thread (see QueueHandler). The 'json' log_format writes one
+    JSON event per line (see JSONFormatter). With max_bytes or an interval
+    (seconds) the file is rotated, and the rotated files are compressed and
+    the oldest ones removed (see RotatingFileHandler).
+    """
+    if log_format not in LOG_FORMATS:
+        raise ValueError("Unknown log format %r, use one of: %s" % (
+                         log_format, ", ".join(LOG_FORMATS)))
     global handler
     # this function is not exactly thread-safe, but it shouldn't matter.
     # The worse that can happen is that a change in longrequestlogger_file
@@ -44,11 +406,21 @@ def do_enable(logfile):
             rotate = Signals.Signals.LogfileRotateHandler
             handler = ZConfig.components.logger.loghandler.Win32FileHandler(
                 logfile)
+        elif max_bytes or interval:
+            rotate = Signals.Signals.LogfileReopenHandler
+            handler = RotatingFileHandler(logfile, max_bytes, interval,
+                                          backups, compress)
         else:
             rotate = Signals.Signals.LogfileReopenHandler
             handler = ZConfig.components.logger.loghandler.FileHandler(
                 logfile)
-        handler.formatter = formatter
+        if log_format == LOG_FORMAT_JSON:
+            handler.formatter = JSONFormatter()
+        else:
+            handler.formatter = formatter
+        if queue_size:
+            # logging.shutdown (atexit) closes it, writing what is queued
+            handler = QueueHandler(handler, queue_size, overflow)
         log.addHandler(handler)
 
     # Register with Zope 2 signal handlers to support log rotation
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+""" The messages of the text log and the event types of the JSON log.
+
+Shared by the logger and the offline tools (reader.py, analyzer.py): this
+module imports nothing, the tools don't install the patches.
+"""
+
+MSG_OBJ_EDITING = "Start editing the object."
+MSG_OBJ_CONTINUE_EDITING = "Continuing to edit the object."
+MSG_OBJ_ALREADY_EDITED = "The object is already been edited."
+MSG_OBJ_CONFLICT_DETECTED = "A potential conflictError was detected for this object."
+MSG_OBJ_CONFLICT = "A ConflictError is been raised for the object."
+MSG_OBJ_CROSS_PROCESS = "A potential conflictError was detected for this object in another process."
+MSG_OBJ_OVERLAP_ENDED = "The connections stopped changing the object together."
+MSG_REQUEST_RETRIED = "The request is retried after a ConflictError."
+MSG_REPORT_REPEATED = "The report was repeated."
+# Event types of the JSON log (see dumper.JSONFormatter and reader.py)
+EVENT_EDIT = 'edit'
+EVENT_CONTINUE = 'continue'
+EVENT_ALREADY_EDITED = 'already-edited'
+EVENT_OVERLAP = 'overlap'
+EVENT_OVERLAP_END = 'overlap-end'
+EVENT_RETRY = 'retry'
+EVENT_REPEATED = 'repeated'
+EVENT_CONFLICT = 'conflict'
+EVENT_STACK = 'stack'
+EVENT_DEBUG = 'debug'
+MSG_EVENTS = {
+    MSG_OBJ_EDITING: EVENT_EDIT,
+    MSG_OBJ_CONTINUE_EDITING: EVENT_CONTINUE,
+    MSG_OBJ_ALREADY_EDITED: EVENT_ALREADY_EDITED,
+    MSG_OBJ_CONFLICT_DETECTED: EVENT_OVERLAP,
+    MSG_OBJ_CROSS_PROCESS: EVENT_OVERLAP,
+    MSG_OBJ_OVERLAP_ENDED: EVENT_OVERLAP_END,
+    MSG_REQUEST_RETRIED: EVENT_RETRY,
+    MSG_REPORT_REPEATED: EVENT_REPEATED,
+    MSG_OBJ_CONFLICT: EVENT_CONFLICT,
+}
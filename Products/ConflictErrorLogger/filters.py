@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+""" Include/exclude rules: the registers of the excluded objects skip the
+logger entirely (no lock, no stack, no pool entry).
+
+The rules (CELogger_FILTERS) are separated by commas or spaces; each one
+starts with + (include) or - (exclude) and matches:
+
+    -BTrees.Length.Length       the class (dotted name)
+    -Products.Sessions.*        the classes of the module and its submodules
+    -_p_resolveConflict         the classes resolving their own conflicts
+    +0x3f2a                     the object (oid)
+
+The first matching rule decides, an object matching no rule is included:
+
+    +BTrees.OOBTree.OOBucket -_p_resolveConflict
+
+logs the OOBuckets but not the other buckets and trees. The rules of a class
+are evaluated once; then each register costs a dict lookup (and another one
+if there are oid rules).
+"""
+
+from ZODB.utils import p64
+
+RESOLVE_CONFLICT = '_p_resolveConflict'
+
+class Filter(object):
+    """ The compiled rules and the decision of each class.
+    """
+
+    def __init__(self, rules=()):
+        if isinstance(rules, basestring):
+            rules = rules.replace(',', ' ').split()
+        # (include, class name or module prefix or None for
+        # _p_resolveConflict, is a prefix)
+        self.rules = []
+        # oid -> include, the oid rules win over the class rules
+        self.oids = {}
+        for rule in rules:
+            self.add(rule)
+        # class -> include
+        self.decisions = {}
+
+    def add(self, rule):
+        """ Compile a rule (+... or -...)
+        """
+        if rule[:1] not in ('+', '-') or len(rule) < 2:
+            raise ValueError("Invalid filter %r: start it with + (include) "
+                             "or - (exclude)" % rule)
+        include = rule[0] == '+'
+        target = rule[1:]
+        if target.startswith('0x'):
+            try:
+                oid = p64(int(target, 16))
+            except ValueError:
+                raise ValueError("Invalid oid in the filter %r" % rule)
+            # The first rule of an oid decides
+            self.oids.setdefault(oid, include)
+        elif target == RESOLVE_CONFLICT:
+            self.rules.append((include, None, False))
+        elif target.endswith('.*'):
+            self.rules.append((include, target[:-1], True))
+        else:
+            self.rules.append((include, target, False))
+
+    def decide(self, klass):
+        """ Evaluate the rules for the class, and cache the decision
+        """
+        name = "%s.%s" % (klass.__module__, klass.__name__)
+        include = True
+        for rule_include, target, prefix in self.rules:
+            if target is None:
+                matched = hasattr(klass, RESOLVE_CONFLICT)
+            elif prefix:
+                matched = name.startswith(target)
+            else:
+                matched = name == target
+            if matched:
+                include = rule_include
+                break
+        self.decisions[klass] = include
+        return include
+
+    def included(self, oid, klass):
+        """ Check if the registers of the object are logged
+        """
+        if self.oids:
+            include = self.oids.get(oid)
+            if include is not None:
+                return include
+        include = self.decisions.get(klass)
+        if include is None:
+            include = self.decide(klass)
+        return include
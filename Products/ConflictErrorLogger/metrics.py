@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+""" Metrics of the logger, in the Prometheus text format.
+
+The counters and the histogram of the time spent in the patched
+Connection.register are kept per thread: each thread only adds to its own
+shard, without lock and without losing updates, and the shards are summed
+when the metrics are read. The gauges (pool size, queues...) are read at
+that time.
+
+They are served by the @@conflict-error-logger-metrics view of the
+application root, and optionally by a small HTTP listener
+(CELogger_METRICS_PORT).
+"""
+
+import thread
+import threading
+import bisect
+import BaseHTTPServer
+from Products.ConflictErrorLogger.stats import DURATION_BUCKETS
+from Products.ConflictErrorLogger.stats import DURATION_OVERLAP
+from Products.ConflictErrorLogger.stats import DURATION_CONFLICT
+
+METRICS_HOST = '127.0.0.1'
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Counters
+REGISTERS = 0
+OVERLAPS = 1
+CONFLICTS = 2
+PREVIEWS = 3
+RETRIES = 4
+WASTED_SECONDS = 5
+WASTED_CPU_SECONDS = 6
+FILTERED = 7
+SUPPRESSED = 8
+COUNTERS = (
+    ('celogger_registers_total', "Calls of Connection.register"),
+    ('celogger_overlaps_total', "Objects changed by a second connection"),
+    ('celogger_conflicts_total', "ConflictErrors raised"),
+    ('celogger_previews_total', "ConflictErrorPreviews raised"),
+    ('celogger_retries_total', "Requests retried after a ConflictError"),
+    ('celogger_wasted_seconds_total',
+     "Time of the attempts discarded by the retries"),
+    ('celogger_wasted_cpu_seconds_total',
+     "CPU time of the attempts discarded by the retries"),
+    ('celogger_filtered_total', "Registers of excluded objects (filters)"),
+    ('celogger_reports_suppressed_total',
+     "Repeated reports only counted (reporting.py)"),
+)
+# Histograms of the durations (see stats.ConflictStats.observe), by class
+DURATION_HISTOGRAMS = (
+    (DURATION_OVERLAP, 'celogger_overlap_seconds',
+     "Time two connections changed the same object"),
+    (DURATION_CONFLICT, 'celogger_time_to_conflict_seconds',
+     "Time the transaction ran before its ConflictError"),
+)
+# Upper bounds (seconds) of the buckets of the register time histogram
+REGISTER_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025,
+                    0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+class Metrics(object):
+    """ Counters and register time histogram, sharded by thread.
+
+    A shard is [counters..., buckets..., +Inf bucket, sum of the times].
+    """
+
+    def __init__(self, buckets=REGISTER_BUCKETS):
+        self.buckets = buckets
+        self.first_bucket = len(COUNTERS)
+        self.sum_index = self.first_bucket + len(buckets) + 1
+        # thread id -> shard
+        self.shards = {}
+
+    def shard(self):
+        ident = thread.get_ident()
+        shard = self.shards.get(ident)
+        if shard is None:
+            shard = self.shards[ident] = [0] * (self.sum_index + 1)
+        return shard
+
+    def inc(self, counter, n=1):
+        """ Add n to the counter (REGISTERS, OVERLAPS...)
+        """
+        self.shard()[counter] += n
+
+    def observe_register(self, seconds):
+        """ Count a register and the time spent in the logger
+        """
+        shard = self.shard()
+        shard[REGISTERS] += 1
+        shard[self.first_bucket +
+              bisect.bisect_left(self.buckets, seconds)] += 1
+        shard[self.sum_index] += seconds
+
+    def values(self):
+        """ Get the sum of the shards
+        """
+        total = [0] * (self.sum_index + 1)
+        for shard in self.shards.values():
+            for i, value in enumerate(shard):
+                total[i] += value
+        return total
+
+    def clear(self):
+        self.shards = {}
+
+def queue_gauges(conflictLogger):
+    """ Get the (queued, dropped) of the log queues
+    """
+    queued = dropped = 0
+    log = conflictLogger.log
+    for handler in log is not None and log.handlers or ():
+        queue = getattr(handler, 'queue', None)
+        if queue is not None:
+            queued += queue.qsize()
+            dropped += handler.dropped
+    return queued, dropped
+
+def render(conflictLogger, active=True):
+    """ Get the metrics of the logger (text format)
+    """
+    lines = []
+    def metric(name, kind, help, value, labels=''):
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, kind))
+        lines.append("%s%s %s" % (name, labels, value))
+
+    metric('celogger_active', 'gauge', "The patches are installed",
+           int(bool(active)))
+    metrics = conflictLogger.metrics
+    if metrics is not None:
+        values = metrics.values()
+        for i, (name, help) in enumerate(COUNTERS):
+            metric(name, 'counter', help, values[i])
+
+        name = 'celogger_register_seconds'
+        lines.append("# HELP %s Time spent in the logger by "
+                     "Connection.register" % name)
+        lines.append("# TYPE %s histogram" % name)
+        count = 0
+        bounds = [repr(b) for b in metrics.buckets] + ['+Inf']
+        for i, bound in enumerate(bounds):
+            count += values[metrics.first_bucket + i]
+            lines.append('%s_bucket{le="%s"} %s' % (name, bound, count))
+        lines.append("%s_sum %r" % (name, values[metrics.sum_index]))
+        lines.append("%s_count %s" % (name, count))
+
+    stats = conflictLogger.stats
+    if stats is not None:
+        bounds = [repr(float(b)) for b in DURATION_BUCKETS] + ['+Inf']
+        for kind, name, help in DURATION_HISTOGRAMS:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s histogram" % name)
+            for (k, klass), histogram in sorted(stats.durations.items()):
+                if k != kind:
+                    continue
+                count = 0
+                for i, bound in enumerate(bounds):
+                    count += histogram[i]
+                    lines.append('%s_bucket{class="%s",le="%s"} %s' % (
+                                 name, klass, bound, count))
+                lines.append('%s_sum{class="%s"} %r' % (name, klass,
+                                                        histogram[-1]))
+                lines.append('%s_count{class="%s"} %s' % (name, klass,
+                                                          histogram[-2]))
+
+    entries, size = conflictLogger.pool_size()
+    metric('celogger_pool_entries', 'gauge',
+           "Entries (object, connection) in the pool", entries)
+    metric('celogger_pool_bytes', 'gauge',
+           "Approximate size of the pool", size)
+    metric('celogger_dirty_objects', 'gauge',
+           "Objects being changed", len(conflictLogger.dirty_index))
+    name = 'celogger_pool_evicted_total'
+    lines.append("# HELP %s Entries evicted from the pool" % name)
+    lines.append("# TYPE %s counter" % name)
+    for reason, value in sorted(conflictLogger.evicted.items()):
+        lines.append('%s{reason="%s"} %s' % (name, reason, value))
+
+    queued, dropped = queue_gauges(conflictLogger)
+    metric('celogger_log_queue_depth', 'gauge',
+           "Log records waiting to be written", queued)
+    metric('celogger_log_dropped_total', 'counter',
+           "Log records dropped (queue full)", dropped)
+    aggregator = conflictLogger.aggregator
+    if aggregator is not None:
+        metric('celogger_aggregator_queue_depth', 'gauge',
+               "Registers waiting to be published", aggregator.queue.qsize())
+        metric('celogger_aggregator_dropped_total', 'counter',
+               "Registers not published (queue full)", aggregator.dropped)
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serve the metrics (any path)
+    """
+
+    def do_GET(self):
+        # Imported here, patch imports this module
+        from Products.ConflictErrorLogger import patch
+        body = render(patch.conflictLogger, patch.is_active())
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't write the scrapes to stderr
+        pass
+
+def serve(port, host=METRICS_HOST):
+    """ Serve the metrics from a background thread, get the server
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    listener = threading.Thread(target=server.serve_forever,
+                                name="CELogger metrics")
+    listener.setDaemon(True)
+    listener.start()
+    return server
@@ -1,46 +1,304 @@
 # -*- coding: utf-8 -*-
 
-import os
-import traceback
+import sys
 import logging
 import time
 import thread
-from ZODB.utils import p64, u64, tid_repr
+import threading
+import weakref
+from collections import deque
+from ZODB.utils import p64, u64, tid_repr, oid_repr
 from ZODB.Connection import Connection
 from ZODB.POSException import TransactionError
+from Products.ConflictErrorLogger.stacks import capture_stack
+from Products.ConflictErrorLogger.stacks import format_stack
+from Products.ConflictErrorLogger.stacks import StackTable
+from Products.ConflictErrorLogger.stacks import FrameFilter
+from Products.ConflictErrorLogger.sampling import Sampler
+from Products.ConflictErrorLogger.filters import Filter
+from Products.ConflictErrorLogger.reporting import Deduplicator
+from Products.ConflictErrorLogger.reporting import REPORT_SWEEP_INTERVAL
+from Products.ConflictErrorLogger.aggregator import Aggregator
+from Products.ConflictErrorLogger.stats import ConflictStats
+from Products.ConflictErrorLogger.stats import EVENT_REGISTERS
+from Products.ConflictErrorLogger.stats import EVENT_OVERLAPS
+from Products.ConflictErrorLogger.stats import EVENT_CONFLICTS
+from Products.ConflictErrorLogger.stats import EVENT_PREVIEWS
+from Products.ConflictErrorLogger.stats import DURATION_OVERLAP
+from Products.ConflictErrorLogger.stats import DURATION_CONFLICT
+from Products.ConflictErrorLogger import metrics
+from Products.ConflictErrorLogger.dumper import LOG_FORMAT_TEXT
+from Products.ConflictErrorLogger.dumper import LOG_FORMAT_JSON
+from Products.ConflictErrorLogger.events import MSG_OBJ_EDITING
+from Products.ConflictErrorLogger.events import MSG_OBJ_CONTINUE_EDITING
+from Products.ConflictErrorLogger.events import MSG_OBJ_ALREADY_EDITED
+from Products.ConflictErrorLogger.events import MSG_OBJ_CONFLICT_DETECTED
+from Products.ConflictErrorLogger.events import MSG_OBJ_CONFLICT
+from Products.ConflictErrorLogger.events import MSG_OBJ_CROSS_PROCESS
+from Products.ConflictErrorLogger.events import MSG_OBJ_OVERLAP_ENDED
+from Products.ConflictErrorLogger.events import MSG_REQUEST_RETRIED
+from Products.ConflictErrorLogger.events import MSG_REPORT_REPEATED
+from Products.ConflictErrorLogger.events import EVENT_EDIT
+from Products.ConflictErrorLogger.events import EVENT_CONTINUE
+from Products.ConflictErrorLogger.events import EVENT_ALREADY_EDITED
+from Products.ConflictErrorLogger.events import EVENT_OVERLAP
+from Products.ConflictErrorLogger.events import EVENT_OVERLAP_END
+from Products.ConflictErrorLogger.events import EVENT_RETRY
+from Products.ConflictErrorLogger.events import EVENT_REPEATED
+from Products.ConflictErrorLogger.events import EVENT_CONFLICT
+from Products.ConflictErrorLogger.events import EVENT_STACK
+from Products.ConflictErrorLogger.events import EVENT_DEBUG
+from Products.ConflictErrorLogger.events import MSG_EVENTS
 
-MSG_OBJ_EDITING = "Start editing the object."
-MSG_OBJ_CONTINUE_EDITING = "Continuing to edit the object."
-MSG_OBJ_ALREADY_EDITED = "The object is already been edited."
-MSG_OBJ_CONFLICT_DETECTED = "A potential conflictError was detected for this object."
-MSG_OBJ_CONFLICT = "A ConflictError is been raised for the object."
 TRACEBACK_SEP = "\n============\n"
+LOCK_STRIPES = 64
+POOL_MAX_ENTRIES = 100000
+# Registers buffered by a thread before they are published to the aggregator
+PUBLISH_BATCH = 1
+# Approximate size of an entry of the pool, and of each (msg, time, signature)
+ENTRY_BYTES = sys.getsizeof([]) + sys.getsizeof((0.0, None, None)) + 3 * 8
+RECORD_BYTES = sys.getsizeof((None, 0.0, 0)) + sys.getsizeof(0.0) + 8
+
+if sys.platform.startswith('linux'):
+    from resource import getrusage
+    # RUSAGE_THREAD, missing from the resource module of Python 2
+    RUSAGE_THREAD = 1
+
+    def thread_cpu():
+        """ Get the CPU time (seconds) of the calling thread
+        """
+        usage = getrusage(RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+else:
+    def thread_cpu():
+        """ The CPU time of a thread is not available here (time.clock is
+        the wall time or the CPU time of the process): None
+        """
+        return None
+
+def format_cpu(seconds):
+    """ Format a CPU time, None if it is not available
+    """
+    if seconds is None:
+        return "n/a"
+    return "%.3fs" % seconds
 
 class ConflictErrorPreview(TransactionError):
     """ A "possible" transaction error was detected. (One second threads start
     to edit the same object).
     """
 
+class StripedLock(object):
+    """ A fixed set of locks. Each oid is guarded by the lock of its stripe, so
+    threads changing unrelated objects do not wait for each other.
+    """
+
+    def __init__(self, stripes=LOCK_STRIPES):
+        self.locks = tuple([thread.allocate_lock() for i in range(stripes)])
+
+    def __len__(self):
+        return len(self.locks)
+
+    def index(self, oid):
+        """ Get the stripe of the object with this oid.
+        """
+        return hash(oid) % len(self.locks)
+
+    def get(self, oid):
+        """ Get the lock guarding the object with this oid.
+        """
+        return self.locks[hash(oid) % len(self.locks)]
+
 class ConflictLogger(object):
+    # The connections are keyed by id (see index_add): the logger doesn't
+    # keep them alive
+    # Oid -> {connection: [(msg, time, signature)...]}
     obj_pool = {}
+    # Connection -> oids it changes
+    conn_index = {}
+    # Connection -> time of its first change in the transaction
+    conn_started = {}
+    # Connection -> weak reference to it
+    conn_refs = {}
+    # Connections garbage collected before the end of their transaction
+    dead_conns = deque()
+    dead_lock = thread.allocate_lock()
+    # Oid -> {connection: time of its first change}
+    dirty_index = {}
+    # Oid -> [class, start, end] of the overlap of the connections changing
+    # it, kept until they all ended
+    overlaps = {}
     log = None
+    FIRST_CHANGE_ONLY = True
+    RAISE_CONFLICTERRORPREVIEW = False
+    # The patches are installed (see patch.activate and patch.deactivate)
     is_active = True
+    locks = StripedLock()
+    stack_table = StackTable()
+    # Depth and collapsed modules of the captured stacks
+    frame_filter = FrameFilter()
+    sampler = Sampler()
+    # Include/exclude rules (see filters.py), None when there are none
+    filter = None
+    # Pool entries in the order they were changed, (time, oid, connection)
+    pool_queue = deque()
+    # Entries and (msg, time, signature) in the pool, per lock stripe
+    pool_entries = [0] * LOCK_STRIPES
+    pool_records = [0] * LOCK_STRIPES
+    evict_lock = thread.allocate_lock()
+    evicted = {'entries': 0, 'bytes': 0, 'ttl': 0, 'collected': 0}
+    POOL_MAX_ENTRIES = POOL_MAX_ENTRIES
+    POOL_MAX_BYTES = 0
+    POOL_TTL = 0
+    LOG_FORMAT = LOG_FORMAT_TEXT
+    # Signatures whose stack was written to the JSON log
+    logged_sigs = set()
+    # Objects changed by the other processes (see aggregator.py)
+    aggregator = None
+    PUBLISH_BATCH = PUBLISH_BATCH
+    # Registers of the thread not published yet (see publish_register)
+    buffers = threading.local()
+    # The publishing attempt of the thread (see notify_publish)
+    attempts = threading.local()
+    # Top offenders (see stats.py), None when disabled
+    stats = ConflictStats()
+    # Counters and register times (see metrics.py), None when disabled
+    metrics = None
+    # Reports written once per window (see reporting.py), None when disabled
+    reports = Deduplicator()
+    # Expires the windows of the reports (see start_reports_timer)
+    reports_timer = None
 
     def config(self,
                  log,
-                 FIRST_CHANGE_ONLY=True,
-                 RAISE_CONFLICTERRORPREVIEW=False):
+                 FIRST_CHANGE_ONLY=None,
+                 RAISE_CONFLICTERRORPREVIEW=None,
+                 LOCK_STRIPES=None,
+                 STACK_TABLE_SIZE=None,
+                 STACK_MAX_DEPTH=None,
+                 STACK_COLLAPSE=None,
+                 POOL_MAX_ENTRIES=None,
+                 POOL_MAX_BYTES=None,
+                 POOL_TTL=None,
+                 CAPTURE_MODE=None,
+                 CAPTURE_SAMPLE_RATE=None,
+                 CAPTURE_BUDGET=None,
+                 CAPTURE_HOT_TTL=None,
+                 WATCHLIST_FILE=None,
+                 LOG_FORMAT=None,
+                 AGGREGATOR_DB=None,
+                 AGGREGATOR_QUEUE_SIZE=None,
+                 STATS_TOP_SIZE=None,
+                 STATS_HALF_LIFE=None,
+                 METRICS=None,
+                 PUBLISH_BATCH=None,
+                 FILTERS=None,
+                 REPORT_WINDOW=None,
+                 REPORT_MAX_KEYS=None):
 
         self.log = log
         # Do not cache all changes in the object, just the first conflict detection
-        self.FIRST_CHANGE_ONLY = FIRST_CHANGE_ONLY
+        if FIRST_CHANGE_ONLY is not None:
+            self.FIRST_CHANGE_ONLY = FIRST_CHANGE_ONLY
         # Raise an exception when a conflict error is detected
-        self.RAISE_CONFLICTERRORPREVIEW = RAISE_CONFLICTERRORPREVIEW
+        if RAISE_CONFLICTERRORPREVIEW is not None:
+            self.RAISE_CONFLICTERRORPREVIEW = RAISE_CONFLICTERRORPREVIEW
+        # Number of locks sharing the obj_pool (1 serializes all the threads)
+        if LOCK_STRIPES:
+            self.locks = StripedLock(LOCK_STRIPES)
+            self.reset()
+        # Number of distinct stacks (code paths) to keep, the ones of the
+        # pool are never dropped
+        if STACK_TABLE_SIZE or 'stack_table' not in self.__dict__:
+            self.stack_table = StackTable(STACK_TABLE_SIZE or
+                                          self.stack_table.size,
+                                          self.pool_sigs)
+        # Frames kept (0 all) and modules collapsed in the stacks
+        if STACK_MAX_DEPTH is not None or STACK_COLLAPSE is not None:
+            if STACK_MAX_DEPTH is None:
+                STACK_MAX_DEPTH = self.frame_filter.max_depth
+            if STACK_COLLAPSE is None:
+                STACK_COLLAPSE = self.frame_filter.collapse
+            self.frame_filter = FrameFilter(STACK_MAX_DEPTH, STACK_COLLAPSE)
+        # Budget of the pool: number of entries, approximate size (bytes) and
+        # time to live (seconds) of an entry. 0 is unlimited.
+        if POOL_MAX_ENTRIES is not None:
+            self.POOL_MAX_ENTRIES = POOL_MAX_ENTRIES
+        if POOL_MAX_BYTES is not None:
+            self.POOL_MAX_BYTES = POOL_MAX_BYTES
+        if POOL_TTL is not None:
+            self.POOL_TTL = POOL_TTL
+        # Which registers capture the stack (see sampling.py)
+        if CAPTURE_MODE:
+            kw = {}
+            if CAPTURE_SAMPLE_RATE:
+                kw['rate'] = CAPTURE_SAMPLE_RATE
+            if CAPTURE_BUDGET:
+                kw['budget'] = CAPTURE_BUDGET
+            if CAPTURE_HOT_TTL:
+                kw['hot_ttl'] = CAPTURE_HOT_TTL
+            self.sampler = Sampler(CAPTURE_MODE, **kw)
+        # Objects and classes known to conflict, from a previous run
+        if WATCHLIST_FILE:
+            self.sampler.watchlist.load(WATCHLIST_FILE)
+        # Write structured events instead of text (see dumper.JSONFormatter)
+        if LOG_FORMAT:
+            self.LOG_FORMAT = LOG_FORMAT
+            self.logged_sigs = set()
+        # Share the objects being changed with the other processes
+        if AGGREGATOR_DB:
+            if self.aggregator is not None:
+                self.aggregator.close()
+            kw = {}
+            if AGGREGATOR_QUEUE_SIZE:
+                kw['queue_size'] = AGGREGATOR_QUEUE_SIZE
+            self.aggregator = Aggregator(AGGREGATOR_DB, self.stack_table,
+                                         self.notify_cross_process, **kw)
+        # Registers sent to the aggregator at once (the transaction end
+        # sends the rest). The other processes see them later.
+        if PUBLISH_BATCH:
+            self.PUBLISH_BATCH = PUBLISH_BATCH
+        # Objects whose registers are not logged ('' removes the rules)
+        if FILTERS is not None:
+            self.filter = FILTERS and Filter(FILTERS) or None
+        # Size of the top of each counter (0 disables them) and how often
+        # the counts are halved (seconds, 0 never)
+        if STATS_TOP_SIZE is not None or STATS_HALF_LIFE is not None:
+            kw = {}
+            if STATS_TOP_SIZE is not None:
+                kw['size'] = STATS_TOP_SIZE
+            if STATS_HALF_LIFE is not None:
+                kw['half_life'] = STATS_HALF_LIFE
+            if STATS_TOP_SIZE == 0:
+                self.stats = None
+            else:
+                self.stats = ConflictStats(**kw)
+        # Count the events and time the registers
+        if METRICS is not None:
+            if METRICS:
+                self.metrics = metrics.Metrics()
+            else:
+                self.metrics = None
+        # Seconds the repeated reports of an object and code path are only
+        # counted (0 reports them all), and number of them kept
+        if REPORT_WINDOW is not None or REPORT_MAX_KEYS is not None:
+            kw = {}
+            if REPORT_WINDOW is not None:
+                kw['window'] = REPORT_WINDOW
+            elif self.reports is not None:
+                kw['window'] = self.reports.window
+            if REPORT_MAX_KEYS:
+                kw['size'] = REPORT_MAX_KEYS
+            if REPORT_WINDOW == 0:
+                self.reports = None
+            else:
+                self.reports = Deduplicator(**kw)
 
-    def frm(self, msg, thread=None, connection=None, obj=None, traceback=None):
+    def frm(self, msg, thread=None, connection=None, obj=None, traceback=None,
+            stamp=None):
         """ Format the message to the log.
         """
-        msg_h = ["time: %s" % time.strftime('%H:%M:%S')]
+        msg_h = ["time: %s" % time.strftime('%H:%M:%S', time.localtime(stamp))]
         if  thread:
             msg_h.append("thread: %s" % thread.get_ident())
         if  connection:
@@ -58,115 +316,415 @@ class ConflictLogger(object):
         return msg
 
     def appendLog(self, msg, level=logging.WARNING, thread=None,
-                 connection=None, obj=None, traceback=None):
-        """ Append a message to the log.
+                 connection=None, obj=None, traceback=None, event=None,
+                 **fields):
+        """ Append a message to the log. The extra fields are only written
+        to the JSON log.
         """
+        # Don't format (and str() the object) for nothing
+        if not self.log.isEnabledFor(level):
+            return
+        if self.LOG_FORMAT == LOG_FORMAT_JSON:
+            if event is None:
+                event = MSG_EVENTS.get(msg, EVENT_DEBUG)
+            if event == EVENT_DEBUG:
+                fields['msg'] = msg
+            data = self.event_data(event, level, thread, connection, obj,
+                                   fields)
+            self.log.log(level, msg, extra={'event': data})
+            return
         msg = self.frm(msg, thread, connection, obj, traceback)
         self.log.log(level, msg)
 
+    def event_data(self, event, level, thread=None, connection=None,
+                   obj=None, fields=None):
+        """ Get the fields of an event of the JSON log
+        """
+        data = {'event': event}
+        if thread:
+            data['thread'] = thread.get_ident()
+        if connection:
+            data['conn'] = id(connection)
+            txn_manager = getattr(connection, 'transaction_manager', None)
+            if txn_manager is not None:
+                data['txn'] = id(txn_manager.get())
+        if obj is not None:
+            data['oid'] = oid_repr(obj._p_oid)
+            data['class'] = self.sampler.watchlist.class_name(obj.__class__)
+        if fields:
+            data.update(fields)
+        # The stacks are written once, the events refer to their signature
+        sigs = [data.get('sig')]
+        for other in data.get('others', ()):
+            sigs.extend([record[2] for record in other['records']])
+        for sig in sigs:
+            if sig is not None and sig not in self.logged_sigs:
+                self.log_stack(sig, level)
+        return data
+
+    def log_stack(self, sig, level):
+        """ Write the stack of the signature to the JSON log
+        """
+        stack = self.stack_table.get(sig)
+        if stack is None:
+            return
+        if len(self.logged_sigs) >= 2 * self.stack_table.size:
+            self.logged_sigs = set()
+        self.logged_sigs.add(sig)
+        frames = [(code.co_filename, lineno, code.co_name)
+                  for code, lineno in stack]
+        data = {'event': EVENT_STACK, 'sig': sig, 'frames': frames}
+        self.log.log(level, EVENT_STACK, extra={'event': data})
+
     def get_traceback(self):
-        """ Get the traceback (string)
+        """ Get the traceback of the caller (see stacks.format_stack)
+        """
+        return capture_stack(1, self.frame_filter)
+
+    def format_entries(self, actual_conn, actual_obj, entries):
+        """ Format the (msg, time, signature) entries of a connection in the
+        pool
+        """
+        result = []
+        for msg, stamp, sig in entries:
+            tb_info = self.frm(msg, connection=actual_conn, obj=actual_obj,
+                               stamp=stamp)
+            stack = self.stack_table.get(sig)
+            if sig is None:
+                traceback = "(the stack was not captured, see CELogger_CAPTURE_MODE)\n"
+            elif stack is None:
+                traceback = "(the stack was dropped from the table)\n"
+            else:
+                traceback = format_stack(stack)
+            result.append("%s traceback (signature: %s, hits: %s):\n%s" % (
+                          tb_info, sig, self.stack_table.hits(sig), traceback))
+        return "\n".join(result)
+
+    def connection(self, conn_id):
+        """ Get the connection with this id, or a description of it if it
+        was garbage collected
+        """
+        ref = self.conn_refs.get(conn_id)
+        conn = ref is not None and ref() or None
+        if conn is None:
+            return "<Connection at %x (collected)>" % conn_id
+        return conn
+
+    def index_add(self, actual_conn, poid, stamp):
+        """ Index the object as being edited in the connection (True if
+        the connection was not editing it yet)
         """
-        return "".join(traceback.format_stack())
+        conn_id = id(actual_conn)
+        # Connections editing the object
+        connections = self.dirty_index.get(poid)
+        if connections is None:
+            connections = self.dirty_index[poid] = {}
+        if conn_id not in connections:
+            connections[conn_id] = stamp
 
-    def objpool_add(self, actual_conn, actual_obj, traceback):
+        # Objects to remove from the indexes when the transaction ends
+        conn_oids = self.conn_index.get(conn_id)
+        if conn_oids is None:
+            conn_oids = self.conn_index[conn_id] = set()
+            self.conn_started[conn_id] = stamp
+            # Called when the connection is garbage collected, maybe with
+            # a stripe lock held: just queue it (see collect_dead)
+            dead_conns = self.dead_conns
+            self.conn_refs[conn_id] = weakref.ref(
+                actual_conn, lambda ref: dead_conns.append(conn_id))
+        elif poid in conn_oids:
+            return False
+        conn_oids.add(poid)
+        return True
+
+    def overlap_start(self, poid, klass, stamp):
+        """ A second connection started changing the object (the lock of
+        the object must be held), get the time since the others changed it
+        """
+        overlap = self.overlaps.get(poid)
+        if overlap is None or overlap[2] is not None:
+            self.overlaps[poid] = [self.sampler.watchlist.class_name(klass),
+                                   stamp, None]
+        return stamp - min(self.dirty_index[poid].values())
+
+    def conflict_timing(self, poid):
+        """ Get the class, the duration of the overlap and the time the
+        transactions still changing the object have been running
+        """
+        lock = self.locks.get(poid)
+        lock.acquire()
+        try:
+            overlap = self.overlaps.get(poid)
+            connections = self.dirty_index.get(poid, {})
+            started = [self.conn_started[conn] for conn in connections
+                       if conn in self.conn_started]
+        finally:
+            lock.release()
+        now = time.time()
+        klass = overlap_seconds = running_seconds = None
+        if overlap is not None:
+            klass, start, end = overlap
+            overlap_seconds = (end or now) - start
+        if started:
+            running_seconds = now - min(started)
+        return klass, overlap_seconds, running_seconds
+
+    def objpool_add(self, actual_conn, actual_obj, sig):
         """ Add an object and connection to the pool
         """
         # Get connections pool 
         poid = actual_obj._p_oid
-        if poid in self.obj_pool.keys():
+        conn_id = id(actual_conn)
+        if poid in self.obj_pool:
             connections_pool = self.obj_pool[poid]
         else:
             connections_pool = {}
-            self.appendLog("objpool_add, added: %s, %s" % (actual_obj, tid_repr(poid)), level=logging.DEBUG)
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.appendLog("objpool_add, added: %s, %s" % (actual_obj, tid_repr(poid)), level=logging.DEBUG)
             self.obj_pool[poid] = connections_pool
 
+        stripe = self.locks.index(poid)
+        stamp = time.time()
+
         # The object is already been edit in ...
-        if connections_pool.keys():
+        if connections_pool:
 
-            if actual_conn in connections_pool.keys():
+            if conn_id in connections_pool:
                 # ... this connection
+                entries = connections_pool[conn_id]
+                if entries[-1][2] is None and sig is not None:
+                    # The first change was not sampled, keep this stack
+                    entries[-1] = (entries[-1][0], entries[-1][1], sig)
                 if not self.FIRST_CHANGE_ONLY:
-                    self.appendLog(MSG_OBJ_CONTINUE_EDITING, level=logging.DEBUG, connection=actual_conn, obj=actual_obj)
-                    tb_info = self.frm(MSG_OBJ_CONTINUE_EDITING)
-                    connections_pool[actual_conn] += "\n%s traceback:\n%s" % (tb_info, traceback)
+                    self.appendLog(MSG_OBJ_CONTINUE_EDITING, level=logging.DEBUG, connection=actual_conn, obj=actual_obj, sig=sig)
+                    entries.append((MSG_OBJ_CONTINUE_EDITING, stamp, sig))
+                    self.pool_records[stripe] += 1
+                    self.pool_queue.append((stamp, poid, conn_id))
                     return True
+                return
             else:
                 # ... another connection
-                self.appendLog(MSG_OBJ_ALREADY_EDITED, level=logging.DEBUG, connection=actual_conn, obj=actual_obj)
-                tb_info = self.frm(MSG_OBJ_ALREADY_EDITED, connection=actual_conn, obj=actual_obj)
-                connections_pool[actual_conn] = "%s traceback:\n%s" % (tb_info , traceback)
-                return True
+                self.appendLog(MSG_OBJ_ALREADY_EDITED, level=logging.DEBUG, connection=actual_conn, obj=actual_obj, sig=sig)
+                connections_pool[conn_id] = [(MSG_OBJ_ALREADY_EDITED, stamp, sig)]
         else:
             # The object start to is already been edit in ..
-            self.appendLog(MSG_OBJ_EDITING, level=logging.DEBUG, connection=actual_conn, obj=actual_obj)
-            tb_info = self.frm(MSG_OBJ_EDITING, connection=actual_conn, obj=actual_obj)
-            connections_pool[actual_conn] = "%s traceback:\n%s" % (tb_info , traceback)
-            return True
+            self.appendLog(MSG_OBJ_EDITING, level=logging.DEBUG, connection=actual_conn, obj=actual_obj, sig=sig)
+            connections_pool[conn_id] = [(MSG_OBJ_EDITING, stamp, sig)]
+
+        self.pool_entries[stripe] += 1
+        self.pool_records[stripe] += 1
+        self.pool_queue.append((stamp, poid, conn_id))
+        return True
 
-    def search_conflicting_data(self, actual_conn, actual_obj):
+    def objpool_pop(self, poid, conn_id):
+        """ Remove the entry of the connection (id) from the pool (the lock
+        of the object must be held)
+        """
+        connections_pool = self.obj_pool.get(poid)
+        if connections_pool is None:
+            return None
+        entries = connections_pool.pop(conn_id, None)
+        if not connections_pool:
+            self.obj_pool.pop(poid)
+        if entries is not None:
+            stripe = self.locks.index(poid)
+            self.pool_entries[stripe] -= 1
+            self.pool_records[stripe] -= len(entries)
+        return entries
+
+    def pool_sigs(self):
+        """ Get the signatures of the entries in the pool (called by the
+        stack table when it drops signatures)
+        """
+        sigs = set()
+        # values() copies (the other threads may change the pool)
+        for connections_pool in self.obj_pool.values():
+            for entries in connections_pool.values():
+                for msg, stamp, sig in entries:
+                    sigs.add(sig)
+        return sigs
+
+    def pool_size(self):
+        """ Get the number of entries in the pool and their approximate size
+        (bytes)
+        """
+        entries = sum(self.pool_entries)
+        return entries, (entries * ENTRY_BYTES +
+                         sum(self.pool_records) * RECORD_BYTES)
+
+    def evict_entries(self):
+        """ Remove the oldest entries from the pool while it is over the
+        budget, and the entries older than POOL_TTL
+        """
+        # Just one thread evicts, the others don't wait for it
+        if not self.evict_lock.acquire(0):
+            return
+        try:
+            queue = self.pool_queue
+            entries, size = self.pool_size()
+            # Most of the queue are entries already removed with their
+            # transaction
+            if len(queue) > 2 * entries + 1000:
+                self.compact_queue()
+            expired = self.POOL_TTL and time.time() - self.POOL_TTL
+
+            while queue:
+                stamp, poid, conn = queue[0]
+                if expired and stamp < expired:
+                    reason = 'ttl'
+                elif self.POOL_MAX_ENTRIES and entries > self.POOL_MAX_ENTRIES:
+                    reason = 'entries'
+                elif self.POOL_MAX_BYTES and size > self.POOL_MAX_BYTES:
+                    reason = 'bytes'
+                else:
+                    break
+                queue.popleft()
+
+                lock = self.locks.get(poid)
+                lock.acquire()
+                try:
+                    pool_entries = self.obj_pool.get(poid, {}).get(conn)
+                    # Removed or changed again after this item was queued
+                    if pool_entries is None or pool_entries[-1][1] != stamp:
+                        continue
+                    self.objpool_pop(poid, conn)
+                finally:
+                    lock.release()
+                self.evicted[reason] += 1
+                entries -= 1
+                size -= ENTRY_BYTES + len(pool_entries) * RECORD_BYTES
+        finally:
+            self.evict_lock.release()
+
+    def compact_queue(self):
+        """ Remove the items of entries no more in the pool from the queue
+        """
+        queue = self.pool_queue
+        # Items queued meanwhile by other threads are behind these
+        for i in xrange(len(queue)):
+            item = queue.popleft()
+            stamp, poid, conn = item
+            pool_entries = self.obj_pool.get(poid, {}).get(conn)
+            if pool_entries and pool_entries[-1][1] == stamp:
+                queue.append(item)
+
+    def conflicting_entries(self, actual_conn, poid):
+        """ Get the (connection id, entries) of the other connections
+        changing the object (a copy, taken under the lock)
+        """
+        actual_id = actual_conn is not None and id(actual_conn) or None
+        lock = self.locks.get(poid)
+        lock.acquire()
+        try:
+            connections_pool = self.obj_pool.get(poid, {})
+            return [(conn_id, list(entries))
+                    for conn_id, entries in connections_pool.items()
+                    if conn_id != actual_id]
+        finally:
+            lock.release()
+
+    def search_conflicting_data(self, actual_conn, actual_obj, poid=None):
         """ Search for an conflicting data (not the actual_conn) in the pool
         """
-        poid = actual_obj._p_oid
+        if poid is None:
+            poid = actual_obj._p_oid
         result_tb = []
 
-        # Check if ZODB is changing this object
-        if poid in self.obj_pool.keys():
-            connections_pool = self.obj_pool[poid]
-        else:
-            connections_pool = {}
-            self.obj_pool[poid] = connections_pool
+        # Check if ZODB is changing this object, the tracebacks are formatted
+        # after releasing the lock
+        pool_entries = self.conflicting_entries(actual_conn, poid)
 
         # Get traceback pool 
-        for conn in connections_pool.keys():
-            # just get the data from other connections
-            if conn != actual_conn:
-                result_tb.append(connections_pool[conn])
+        for conn_id, entries in pool_entries:
+            result_tb.append(self.format_entries(self.connection(conn_id),
+                                                 actual_obj, entries))
         return TRACEBACK_SEP.join(result_tb)
 
-    def sanitize_cache(self):
-        """ Remove the obj_pool if no more references
-        """
-        # Remove connections from pool
-        for poid, connections_pool in self.obj_pool.items():
-            conn_todel = []
-            for conn in connections_pool:
-                registered_obj_oids = [o._p_oid for o in conn._registered_objects]
-                if poid not in registered_obj_oids:
-                    conn_todel.append(conn)
-
-            # Removed objects 
-            for conn in conn_todel:
-                self.appendLog("sanitize_cache, Removed connection: %s" % conn, level=logging.DEBUG)
-                self.obj_pool[poid].pop(conn)
-
-        # find objects with no information 
-        obj_todel = []
-        for poid, connections_pool in self.obj_pool.items():
-            if not connections_pool:
-                obj_todel.append(poid)
-
-        # Removed objects 
-        for poid in obj_todel:
-            self.appendLog("sanitize_cache, Removed object: %s" % tid_repr(poid), level=logging.DEBUG)
-            self.obj_pool.pop(poid)
+    def reset(self):
+        """ Forget all the objects being edited
+        """
+        self.obj_pool = {}
+        self.conn_index = {}
+        self.conn_started = {}
+        self.conn_refs = {}
+        self.dead_conns = deque()
+        self.dirty_index = {}
+        self.overlaps = {}
+        self.pool_queue = deque()
+        self.pool_entries = [0] * len(self.locks)
+        self.pool_records = [0] * len(self.locks)
+        self.evicted = {'entries': 0, 'bytes': 0, 'ttl': 0, 'collected': 0}
+        # The occurrences counted are written, not lost
+        self.flush_reports()
+
+    def should_report(self, event, poid, klass, sig):
+        """ Check if the event of the object (or class) and code path is
+        reported, or only counted until the end of the window
+        """
+        reports = self.reports
+        if reports is None:
+            return True
+        report, summaries = reports.check((event, poid, klass, sig))
+        for key, count, seconds in summaries:
+            self.log_repeated(key, count, seconds)
+        if not report and self.metrics is not None:
+            self.metrics.inc(metrics.SUPPRESSED)
+        return report
+
+    def flush_reports(self):
+        """ Write the summaries of the reports not written yet
+        """
+        if self.reports is not None:
+            for key, count, seconds in self.reports.flush():
+                self.log_repeated(key, count, seconds)
+
+    def expire_reports(self):
+        """ Write the summaries of the windows over
+        """
+        reports = self.reports
+        if reports is not None:
+            for key, count, seconds in reports.expire():
+                self.log_repeated(key, count, seconds)
+
+    def start_reports_timer(self):
+        """ Expire the windows of the reports in a background thread, once
+        started: a burst followed by silence is summarized too
+        """
+        if self.reports_timer is not None:
+            return
+        self.reports_timer = threading.Thread(target=self.expire_reports_loop,
+                                              name="CELogger reports")
+        self.reports_timer.setDaemon(True)
+        self.reports_timer.start()
+
+    def expire_reports_loop(self):
+        while True:
+            time.sleep(REPORT_SWEEP_INTERVAL)
+            try:
+                self.expire_reports()
+            except Exception:
+                self.log.exception("Error writing the summaries of the "
+                                   "reports")
+
+    def log_repeated(self, key, count, seconds):
+        """ Write the summary of the reports not written in a window
+        """
+        event, poid, klass, sig = key
+        oid = poid is not None and oid_repr(poid) or None
+        self.appendLog("%s (event: %s, object._p_oid: %s, class: %s, "
+                       "signature: %s, occurrences: %d in %.0fs)" % (
+                       MSG_REPORT_REPEATED, event, oid, klass, sig, count,
+                       seconds), event=EVENT_REPEATED, kind=event, oid=oid,
+                       sig=sig, count=count, seconds=seconds,
+                       **{'class': klass})
 
     def check_alreadychanged_obj(self, actual_conn, actual_obj):
-        """ Check in the connection if the object is been edited
+        """ Check if the object is been edited in another connection
         """
-        registered_obj_oids = []
-        poid = actual_obj._p_oid
-        # Get all objects been edited
-        if poid in self.obj_pool.keys():
-            connections_pool = self.obj_pool[poid]
-            
-            # Get traceback pool 
-            for conn in connections_pool.keys():
-                # just get the data from other connections
-                if conn != actual_conn:
-                    objs = [o._p_oid for o in conn._registered_objects]
-                    registered_obj_oids += objs
-        return poid in registered_obj_oids
+        connections = self.dirty_index.get(actual_obj._p_oid)
+        if not connections:
+            return False
+        return len(connections) > 1 or id(actual_conn) not in connections
 
 #------------------------------------------------------------------------------
 #   Notifications from ZODB
@@ -174,49 +732,397 @@ class ConflictLogger(object):
     def notify_register(self, actual_conn, actual_obj):
         """ Some objective is been edited in ZODB.
         """
-        if os.environ.get('CELogger_ACTIVE', "true") == "true":
-            # restarting
-            if not self.is_active:
-                self.obj_pool = {}
-            self.is_active = True
+        poid = actual_obj._p_oid
+        klass = actual_obj.__class__
+        # Excluded objects cost a dict lookup (the decision of the class)
+        rules = self.filter
+        if rules is not None:
+            include = rules.decisions.get(klass)
+            if include is None or rules.oids:
+                include = rules.included(poid, klass)
+            if not include:
+                if self.metrics is not None:
+                    self.metrics.inc(metrics.FILTERED)
+                return
+        # Forget the connections collected meanwhile, before their id is
+        # reused
+        if self.dead_conns:
+            self.collect_dead()
+        # The connection already changed the object in this transaction
+        # (e.g. again after a savepoint): its set of oids is only changed
+        # by its own thread, nothing shared is needed to know it. Unless
+        # another connection changes the object too (the overlap is
+        # detected again), or the stack of the first change is missing.
+        if self.FIRST_CHANGE_ONLY and actual_conn:
+            conn_id = id(actual_conn)
+            conn_oids = self.conn_index.get(conn_id)
+            if conn_oids is not None and poid in conn_oids:
+                connections = self.dirty_index.get(poid)
+                entries = self.obj_pool.get(poid, {}).get(conn_id)
+                if (connections is not None and len(connections) == 1 and
+                        entries and entries[-1][2] is not None):
+                    if self.stats is not None:
+                        self.stats.count(EVENT_REGISTERS, poid,
+                                self.sampler.watchlist.class_name(klass))
+                    return
+        if self.sampler.should_capture(poid, klass):
+            sig = self.stack_table.intern(self.get_traceback())
+            fast_path = False
         else:
-            self.is_active = False
-            return
-
-        traceback = self.get_traceback()
+            sig = None
+            fast_path = self.sampler.fast_path()
         raise_exception = False
-        if actual_conn and self.check_alreadychanged_obj(actual_conn, actual_obj):
-            self.appendLog(MSG_OBJ_CONFLICT_DETECTED, thread=thread, connection=actual_conn, obj=actual_obj)
+        added = False
+        overlap = False
+        stamp = time.time()
+
+        lock = self.locks.get(poid)
+        lock.acquire()
+        try:
+            if actual_conn and self.check_alreadychanged_obj(actual_conn, actual_obj):
+                if sig is None:
+                    sig = self.stack_table.intern(self.get_traceback())
+                    fast_path = False
+                held = self.overlap_start(poid, klass, stamp)
+                if self.should_report(EVENT_OVERLAP, poid,
+                        self.sampler.watchlist.class_name(klass), sig):
+                    self.appendLog("%s (changed by another connection "
+                                   "%.3fs ago)" % (MSG_OBJ_CONFLICT_DETECTED,
+                                   held), thread=thread,
+                                   connection=actual_conn, obj=actual_obj,
+                                   event=EVENT_OVERLAP, sig=sig, held=held)
+                self.sampler.mark_hot(poid, klass)
+                overlap = True
+
+                if self.RAISE_CONFLICTERRORPREVIEW:
+                    raise_exception = True
 
-            if self.RAISE_CONFLICTERRORPREVIEW:
-                raise_exception = True
+            if actual_conn:
+                added = self.index_add(actual_conn, poid, stamp)
+            # Objects not watched just record the connection changing them
+            if not fast_path:
+                self.objpool_add(actual_conn, actual_obj, sig)
+        finally:
+            lock.release()
 
-        # Remove old refs
-        self.sanitize_cache()
+        if not fast_path:
+            self.evict_entries()
 
-        #tb_info = self.frm(MSG_OBJ_EDITING, thread=thread, connection=actual_conn, obj=actual_obj)
-        #self.objpool_add(actual_conn, actual_obj, "%s Traceback:\n%s"%(tb_info,traceback))
-        self.objpool_add(actual_conn, actual_obj, traceback)
+        if added and self.aggregator is not None:
+            self.publish_register(poid, actual_conn, sig)
+
+        stats = self.stats
+        if stats is not None:
+            klass_name = self.sampler.watchlist.class_name(klass)
+            stats.count(EVENT_REGISTERS, poid, klass_name, sig)
+            if overlap:
+                stats.count(EVENT_OVERLAPS, poid, klass_name, sig)
+            if raise_exception:
+                stats.count(EVENT_PREVIEWS, poid, klass_name, sig)
+
+        if overlap and self.metrics is not None:
+            self.metrics.inc(metrics.OVERLAPS)
+            if raise_exception:
+                self.metrics.inc(metrics.PREVIEWS)
 
         if raise_exception:
             raise ConflictErrorPreview("A potential conflictError was "
                                        "detected. Check log for details.")
 
+    def publish_register(self, poid, actual_conn, sig):
+        """ Buffer the register in the thread, send the buffer to the
+        aggregator when it is full
+        """
+        pending = getattr(self.buffers, 'pending', None)
+        if pending is None:
+            pending = self.buffers.pending = []
+        pending.append((poid, id(actual_conn), sig, time.time()))
+        if len(pending) >= self.PUBLISH_BATCH:
+            self.publish_pending()
+
+    def publish_pending(self):
+        """ Send the registers buffered by the thread to the aggregator
+        """
+        pending = getattr(self.buffers, 'pending', None)
+        if pending:
+            self.buffers.pending = []
+            self.aggregator.publish_registers(pending)
+
+    def notify_transaction_end(self, actual_conn):
+        """ The transaction of the connection was committed or aborted.
+        """
+        # Remove the connection from the indexes and pool of each object it
+        # changed
+        conn_id = id(actual_conn)
+        if conn_id not in self.conn_index:
+            return
+        if self.aggregator is not None:
+            self.publish_pending()
+        poids = self.end_connection(conn_id)
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.appendLog("notify_transaction_end, Removed connection: %s (%s objects)" % (actual_conn, len(poids)), level=logging.DEBUG)
+
+    def collect_dead(self):
+        """ Forget the connections garbage collected before the end of
+        their transaction
+        """
+        # Blocking: a new connection may get the id of a dead one
+        self.dead_lock.acquire()
+        try:
+            dead_conns = self.dead_conns
+            while dead_conns:
+                # Removed once forgotten, the other threads wait meanwhile
+                conn_id = dead_conns[0]
+                poids = self.end_connection(conn_id)
+                dead_conns.popleft()
+                self.evicted['collected'] += len(poids)
+                if self.log.isEnabledFor(logging.DEBUG):
+                    self.appendLog("collect_dead, Removed connection: %x "
+                                   "(%s objects)" % (conn_id, len(poids)),
+                                   level=logging.DEBUG)
+        finally:
+            self.dead_lock.release()
+
+    def end_connection(self, conn_id):
+        """ Remove the connection (id) from the indexes and pool of each
+        object it changed, get these oids
+        """
+        poids = self.conn_index.pop(conn_id, None) or ()
+        self.conn_started.pop(conn_id, None)
+        self.conn_refs.pop(conn_id, None)
+        if poids and self.aggregator is not None:
+            self.aggregator.publish_end(conn_id)
+
+        ended = []
+        stamp = time.time()
+        for poid in poids:
+            lock = self.locks.get(poid)
+            lock.acquire()
+            try:
+                connections = self.dirty_index.get(poid)
+                if connections is not None:
+                    connections.pop(conn_id, None)
+                    overlap = self.overlaps.get(poid)
+                    # Just one connection left: the overlap is over
+                    if (overlap is not None and overlap[2] is None and
+                        len(connections) < 2):
+                        overlap[2] = stamp
+                        ended.append((poid, overlap))
+                    if not connections:
+                        self.dirty_index.pop(poid)
+                        self.overlaps.pop(poid, None)
+
+                self.objpool_pop(poid, conn_id)
+            finally:
+                lock.release()
+
+        for poid, (klass, start, end) in ended:
+            self.overlap_ended(poid, klass, end - start)
+        return poids
+
+    def overlap_ended(self, poid, klass, seconds):
+        """ Count and log the duration of the overlap of the connections
+        changing the object
+        """
+        if self.stats is not None:
+            self.stats.observe(DURATION_OVERLAP, klass, seconds)
+        self.appendLog("%s (object._p_oid: %s, class: %s, overlap: %.3fs)" % (
+                       MSG_OBJ_OVERLAP_ENDED, tid_repr(poid), klass, seconds),
+                       level=logging.INFO, event=EVENT_OVERLAP_END,
+                       oid=oid_repr(poid), overlap=seconds, **{'class': klass})
+
     def notify_ConflictError(self, conflict_error_exc, message=None,
             pobject=None, oid=None, serials=None, data=None):
         """ A ConflictError is been raised.
         """
-        if os.environ.get('CELogger_ACTIVE', "true") == "true":
+        if pobject is not None:
+            klass = pobject.__class__
+        else:
+            klass = getattr(conflict_error_exc, 'class_name', None)
+        self.sampler.mark_hot(conflict_error_exc.oid, klass)
+        poid = conflict_error_exc.oid
+        if poid is None and pobject is not None:
+            poid = pobject._p_oid
+        timing = None, None, None
+        if poid is not None:
+            timing = self.conflict_timing(poid)
+        if klass is not None:
+            klass = self.sampler.watchlist.class_name(klass)
+        sig = self.first_sig(poid)
+        if self.stats is not None:
+            self.stats.count(EVENT_CONFLICTS, poid, klass, sig)
+            if timing[2] is not None:
+                self.stats.observe(DURATION_CONFLICT, klass or timing[0],
+                                   timing[2])
+        # The cost of the attempt is known if the request is retried
+        attempt = self.attempts
+        if getattr(attempt, 'start', None) is not None:
+            attempt.conflict = (poid, klass or timing[0], sig, time.time(),
+                                thread_cpu())
+        if self.metrics is not None:
+            self.metrics.inc(metrics.CONFLICTS)
+        if not self.should_report(EVENT_CONFLICT, poid, klass or timing[0],
+                                  sig):
             return
 
-        conflict_trace = self.search_conflicting_data(None, pobject)
+        if self.LOG_FORMAT == LOG_FORMAT_JSON:
+            self.log_conflict(conflict_error_exc, pobject, timing)
+            return
 
-        if conflict_trace:
-            self.appendLog("%s This object was initially changed here (traceback):\n" % MSG_OBJ_CONFLICT, thread=thread, obj=pobject, traceback=conflict_trace)
-        else:
-            self.appendLog("%s There is no traceback info.\n" % MSG_OBJ_CONFLICT, thread=thread, obj=pobject)
+        if self.log.isEnabledFor(logging.WARNING):
+            # A bare ConflictError (raised to retry the request) has no
+            # object to search
+            conflict_trace = None
+            if poid is not None:
+                conflict_trace = self.search_conflicting_data(
+                                    None, pobject, poid=poid)
+            if self.aggregator is not None and poid is not None:
+                processes = self.format_processes(
+                            self.aggregator.other_processes(poid))
+                conflict_trace = TRACEBACK_SEP.join(
+                            filter(None, [conflict_trace, processes]))
+            msg = MSG_OBJ_CONFLICT + self.format_timing(timing)
+            if conflict_trace:
+                self.appendLog("%s This object was initially changed here (traceback):\n" % msg, thread=thread, obj=pobject, traceback=conflict_trace)
+            else:
+                self.appendLog("%s There is no traceback info.\n" % msg, thread=thread, obj=pobject)
 
         # If logging in another file, append also the actual traceback.
-        if self.log.name == "CELogger":
+        if self.log.name == "CELogger" and self.log.isEnabledFor(logging.ERROR):
             self.log.exception(conflict_error_exc)
-            self.log.error(self.get_traceback())
+            self.log.error(format_stack(self.get_traceback()))
+
+    def format_timing(self, timing):
+        """ Format the overlap and running time of a conflict
+        """
+        klass, overlap_seconds, running_seconds = timing
+        result = []
+        if overlap_seconds is not None:
+            result.append("overlap: %.3fs" % overlap_seconds)
+        if running_seconds is not None:
+            result.append("transaction running for %.3fs" % running_seconds)
+        if not result:
+            return ""
+        return " (%s)" % ", ".join(result)
+
+    def log_conflict(self, conflict_error_exc, pobject=None,
+                     timing=(None, None, None)):
+        """ Write the conflict event, with the entries of the connections
+        changing the object, to the JSON log
+        """
+        if not self.log.isEnabledFor(logging.WARNING):
+            return
+        poid = conflict_error_exc.oid
+        if poid is None and pobject is not None:
+            poid = pobject._p_oid
+        others = []
+        for conn_id, entries in self.conflicting_entries(None, poid):
+            records = [(MSG_EVENTS.get(msg, EVENT_DEBUG), stamp, sig)
+                       for msg, stamp, sig in entries]
+            others.append({'conn': conn_id, 'records': records})
+        fields = {
+            'error': str(conflict_error_exc),
+            'sig': self.stack_table.intern(self.get_traceback()),
+            'others': others,
+        }
+        if pobject is None and poid is not None:
+            fields['oid'] = oid_repr(poid)
+            klass = getattr(conflict_error_exc, 'class_name', None)
+            if klass:
+                fields['class'] = klass
+        if self.aggregator is not None and poid is not None:
+            fields['processes'] = [
+                {'pid': pid, 'conn': conn, 'ts': stamp, 'ended': ended,
+                 'stack': stack} for pid, conn, stamp, ended, stack
+                in self.aggregator.other_processes(poid)]
+        serials = conflict_error_exc.serials
+        if serials:
+            fields['serials'] = [tid_repr(serial) for serial in serials]
+        if timing[1] is not None:
+            fields['overlap'] = timing[1]
+        if timing[2] is not None:
+            fields['running'] = timing[2]
+        self.appendLog(MSG_OBJ_CONFLICT, thread=thread, obj=pobject,
+                       event=EVENT_CONFLICT, **fields)
+
+    def format_processes(self, rows):
+        """ Format the (pid, connection, time, ended, stack) of the other
+        processes changing an object
+        """
+        result = []
+        for pid, conn, stamp, ended, stack in rows:
+            state = ended and "ended" or "running"
+            tb_info = self.frm("Changed in the process %s (transaction %s)" %
+                               (pid, state), connection="%s:%s" % (pid, conn),
+                               stamp=stamp)
+            result.append("%s traceback:\n%s" % (
+                          tb_info, stack or "(the stack was not captured)\n"))
+        return TRACEBACK_SEP.join(result)
+
+    def notify_cross_process(self, poid, others):
+        """ The object changed in this process is being changed in another
+        process (called by the aggregator thread)
+        """
+        self.sampler.mark_hot(poid)
+        if not self.should_report(EVENT_OVERLAP, poid, None, None):
+            return
+        processes = ", ".join(["%s:%s" % (pid, conn)
+                               for pid, conn, stamp in others])
+        self.appendLog("%s (object._p_oid: %s, process:connection: %s)" % (
+                       MSG_OBJ_CROSS_PROCESS, tid_repr(poid), processes),
+                       event=EVENT_OVERLAP, oid=oid_repr(poid),
+                       processes=[list(other) for other in others])
+
+    def first_sig(self, poid):
+        """ Get the signature of the code path that first changed the
+        object, None if unknown
+        """
+        if poid is None:
+            return None
+        first = None
+        for conn, entries in self.conflicting_entries(None, poid):
+            if entries and (first is None or entries[0][1] < first[1]):
+                first = entries[0]
+        return first and first[2] or None
+
+#------------------------------------------------------------------------------
+#   Notifications from ZPublisher
+
+    def notify_publish(self, request):
+        """ The thread starts publishing the request (or retrying it)
+        """
+        attempt = self.attempts
+        attempt.start = time.time()
+        attempt.cpu = thread_cpu()
+        attempt.conflict = None
+
+    def notify_retry(self, request):
+        """ The request is retried: the time of the attempt up to its last
+        ConflictError is wasted
+        """
+        attempt = self.attempts
+        start = getattr(attempt, 'start', None)
+        conflict = getattr(attempt, 'conflict', None)
+        attempt.start = attempt.conflict = None
+        if start is None or conflict is None:
+            # Not retried because of a ConflictError
+            return
+        poid, klass, sig, stamp, cpu = conflict
+        wall = stamp - start
+        if cpu is not None:
+            cpu -= attempt.cpu
+        if self.stats is not None:
+            self.stats.waste(poid, klass, sig, wall, cpu)
+        if self.metrics is not None:
+            self.metrics.inc(metrics.RETRIES)
+            self.metrics.inc(metrics.WASTED_SECONDS, wall)
+            if cpu is not None:
+                self.metrics.inc(metrics.WASTED_CPU_SECONDS, cpu)
+        retry_count = getattr(request, 'retry_count', 0) + 1
+        oid = poid is not None and oid_repr(poid) or None
+        self.appendLog("%s (object._p_oid: %s, class: %s, retry: %s, wasted: "
+                       "%.3fs, CPU: %s)" % (MSG_REQUEST_RETRIED, oid,
+                       klass, retry_count, wall, format_cpu(cpu)),
+                       level=logging.INFO,
+                       event=EVENT_RETRY, oid=oid, sig=sig, retry=retry_count,
+                       wasted=wall, cpu=cpu, **{'class': klass})
@@ -1,19 +1,29 @@
 # -*- coding: utf-8 -*-
 
-import os
+import time
+import atexit
+import signal
+import socket
 import logging
 import thread
+import Signals.Signals
 
 from App.config import getConfiguration
 from ZODB.utils import p64, u64, tid_repr
 from ZODB.Connection import Connection
 from ZODB.POSException import ConflictError
+from ZPublisher import Publish
+from ZPublisher.HTTPRequest import HTTPRequest
 from Products.ConflictErrorLogger.monitor import ConflictLogger
 from Products.ConflictErrorLogger.dumper import do_enable
+from Products.ConflictErrorLogger.settings import Settings
+from Products.ConflictErrorLogger import metrics
 
-lock = thread.allocate_lock()
 _enabled = []
 conflictLogger = None
+settings = None
+# Serializes activate and deactivate
+control_lock = thread.allocate_lock()
 
 def AlreadyApplied(patch):
     if patch in _enabled:
@@ -21,36 +31,17 @@ def AlreadyApplied(patch):
     _enabled.append(patch)
     return False
 
-if not AlreadyApplied('ConflictLogger.__init__'):
-    ACTIVE = os.environ.get('CELogger_ACTIVE', True)
-    LOGFILE = os.environ.get('CELogger_LOGFILE', '')
-    FIRST_CHANGE_ONLY = os.environ.get('CELogger_FIRST_CHANGE_ONLY', True)
-    RAISE_CONFLICTERRORPREVIEW = os.environ.get(
-                                'CELogger_RAISE_CONFLICTERRORPREVIEW', False)
-
-    if LOGFILE:
-        log = do_enable(LOGFILE)
-    else:
-        log = logging.getLogger("CELogger")
-    config = getConfiguration()
-    if not config.debug_mode:
-        log.critical("Attention: You are not running in debug-mode. "
-                     "Do not use Products.ConflictErrorLogger for "
-                     "Productive systems!")
-
-    if (not LOGFILE) and (log.level > logging.WARNING):
-        log.critical("Set the 'LOG_LEVEL' to 'WARNING' or use the "
-                     "'CELogger_LOGFILE' option in order to get the messages "
-                     "properly")
-
-    log.warning("Please, be warned that 'Products.ConflictErrorLogger' will "
-                "not work properly with more than 1 instance (ZEO).")
+def Unapplied(patch):
+    if patch not in _enabled:
+        return True
+    _enabled.remove(patch)
+    return False
 
-    conflictLogger = ConflictLogger()
-    conflictLogger.config(
-                        log,
-                        FIRST_CHANGE_ONLY=FIRST_CHANGE_ONLY,
-                        RAISE_CONFLICTERRORPREVIEW=RAISE_CONFLICTERRORPREVIEW)
+# Not patched until initialize (or activate) is called: importing the
+# package (e.g. by the offline tools) changes nothing
+conflictLogger = ConflictLogger()
+conflictLogger.is_active = False
+conflictLogger.config(logging.getLogger("CELogger"))
 
 def doConnectionMonkeyPatch():
     if AlreadyApplied('ZODB.Connection.register'):
@@ -58,14 +49,26 @@ def doConnectionMonkeyPatch():
 
     Connection.ORIG_register = Connection.register
     def new_register(self, obj):
-        lock.acquire()
-        try:
+        # conflictLogger locks the object itself, per oid
+        register_metrics = conflictLogger.metrics
+        if register_metrics is None:
             conflictLogger.notify_register(self, obj)
-            return self.ORIG_register(obj)
-        finally:
-            lock.release()
+        else:
+            start = time.time()
+            try:
+                conflictLogger.notify_register(self, obj)
+            finally:
+                register_metrics.observe_register(time.time() - start)
+        return self.ORIG_register(obj)
     Connection.register = new_register
 
+    # The connection is a synchronizer of its transaction manager
+    Connection.ORIG_afterCompletion = Connection.afterCompletion
+    def new_afterCompletion(self, txn):
+        conflictLogger.notify_transaction_end(self)
+        return self.ORIG_afterCompletion(txn)
+    Connection.afterCompletion = new_afterCompletion
+
 def doConflictErrorMonkeyPatch():
     if AlreadyApplied('ZODB.POSException.ConflictError'):
         return
@@ -73,14 +76,165 @@ def doConflictErrorMonkeyPatch():
     ConflictError.__ORIG_init__ = ConflictError.__init__
     def __NEW_init__(self, message=None, object=None, oid=None, serials=None,
                  data=None):
-        lock.acquire()
-        try:
-            ret = self.__ORIG_init__(message, object, oid, serials, data)
-            conflictLogger.notify_ConflictError(self, message, object, oid, serials, data)
-            return ret
-        finally:
-            lock.release()
+        ret = self.__ORIG_init__(message, object, oid, serials, data)
+        conflictLogger.notify_ConflictError(self, message, object, oid, serials, data)
+        return ret
     ConflictError.__init__ = __NEW_init__
 
-doConnectionMonkeyPatch()
-doConflictErrorMonkeyPatch()
+def doPublisherMonkeyPatch():
+    if AlreadyApplied('ZPublisher.Publish.publish'):
+        return
+
+    # Called again by itself (module global) for each retry
+    Publish.ORIG_publish = Publish.publish
+    def new_publish(request, *args, **kw):
+        conflictLogger.notify_publish(request)
+        return Publish.ORIG_publish(request, *args, **kw)
+    Publish.publish = new_publish
+
+    HTTPRequest.ORIG_retry = HTTPRequest.retry
+    def new_retry(self):
+        conflictLogger.notify_retry(self)
+        return self.ORIG_retry()
+    HTTPRequest.retry = new_retry
+
+def undoConnectionMonkeyPatch():
+    if Unapplied('ZODB.Connection.register'):
+        return
+
+    Connection.register = Connection.ORIG_register.im_func
+    Connection.afterCompletion = Connection.ORIG_afterCompletion.im_func
+    del Connection.ORIG_register
+    del Connection.ORIG_afterCompletion
+
+def undoConflictErrorMonkeyPatch():
+    if Unapplied('ZODB.POSException.ConflictError'):
+        return
+
+    ConflictError.__init__ = ConflictError.__ORIG_init__.im_func
+    del ConflictError.__ORIG_init__
+
+def undoPublisherMonkeyPatch():
+    if Unapplied('ZPublisher.Publish.publish'):
+        return
+
+    Publish.publish = Publish.ORIG_publish
+    HTTPRequest.retry = HTTPRequest.ORIG_retry.im_func
+    del Publish.ORIG_publish
+    del HTTPRequest.ORIG_retry
+
+#------------------------------------------------------------------------------
+#   Runtime control
+
+def activate():
+    """ Install the patches and start monitoring the changes.
+    """
+    control_lock.acquire()
+    try:
+        if conflictLogger.is_active:
+            return
+        # The pool missed the transactions ended while inactive
+        conflictLogger.reset()
+        doConnectionMonkeyPatch()
+        doConflictErrorMonkeyPatch()
+        doPublisherMonkeyPatch()
+        conflictLogger.is_active = True
+        conflictLogger.start_reports_timer()
+    finally:
+        control_lock.release()
+    conflictLogger.log.info("ConflictErrorLogger activated.")
+
+def deactivate():
+    """ Restore the original methods, an inactive logger costs nothing.
+    """
+    control_lock.acquire()
+    try:
+        if not conflictLogger.is_active:
+            return
+        undoConnectionMonkeyPatch()
+        undoConflictErrorMonkeyPatch()
+        undoPublisherMonkeyPatch()
+        conflictLogger.is_active = False
+        conflictLogger.reset()
+    finally:
+        control_lock.release()
+    conflictLogger.log.info("ConflictErrorLogger deactivated.")
+
+def toggle():
+    """ Activate the logger if inactive, deactivate it otherwise.
+    """
+    if conflictLogger.is_active:
+        deactivate()
+    else:
+        activate()
+
+def signalToggle():
+    """ Toggle the logger in another thread: the signal handler runs in the
+    main thread, which may hold control_lock or a lock of logging.
+    """
+    thread.start_new_thread(toggle, ())
+
+def is_active():
+    return conflictLogger.is_active
+
+def registerToggleSignal(name):
+    """ Toggle the logger when the process gets the signal (SIGUSR1...)
+    """
+    signum = getattr(signal, name, None)
+    if signum is None:
+        conflictLogger.log.warning("Unknown signal %r, the logger can't be "
+                                   "toggled by a signal." % name)
+        return
+    if Signals.Signals.SignalHandler:
+        Signals.Signals.SignalHandler.registerHandler(signum, signalToggle)
+
+def initialize():
+    """ Configure the logger from the environment (see settings.py) and
+    install the patches, once (called when Zope initializes the product).
+    """
+    global settings
+    if AlreadyApplied('ConflictLogger.initialize'):
+        return
+    settings = Settings()
+
+    if settings.LOGFILE:
+        log = do_enable(settings.LOGFILE, settings.LOG_QUEUE_SIZE,
+                        settings.LOG_QUEUE_OVERFLOW, settings.LOG_FORMAT,
+                        settings.LOG_MAX_BYTES, settings.LOG_ROTATE_INTERVAL,
+                        settings.LOG_BACKUPS, settings.LOG_COMPRESS)
+    else:
+        log = logging.getLogger("CELogger")
+    config = getConfiguration()
+    if not config.debug_mode:
+        log.critical("Attention: You are not running in debug-mode. "
+                     "Do not use Products.ConflictErrorLogger for "
+                     "Productive systems!")
+
+    if (not settings.LOGFILE) and (log.level > logging.WARNING):
+        log.critical("Set the 'LOG_LEVEL' to 'WARNING' or use the "
+                     "'CELogger_LOGFILE' option in order to get the messages "
+                     "properly")
+
+    if not settings.AGGREGATOR_DB:
+        log.warning("Please, be warned that 'Products.ConflictErrorLogger' "
+                    "will not work properly with more than 1 instance (ZEO) "
+                    "unless 'CELogger_AGGREGATOR_DB' is set.")
+
+    conflictLogger.config(log, **settings.monitor_config())
+    # Before logging.shutdown (registered first) closes the handlers
+    atexit.register(conflictLogger.flush_reports)
+
+    if settings.ACTIVE:
+        activate()
+    if settings.TOGGLE_SIGNAL:
+        registerToggleSignal(settings.TOGGLE_SIGNAL)
+    if settings.METRICS_PORT:
+        # Nothing to serve without the counters
+        if conflictLogger.metrics is None:
+            conflictLogger.config(conflictLogger.log, METRICS=True)
+        try:
+            metrics.serve(settings.METRICS_PORT, settings.METRICS_HOST)
+        except socket.error, e:
+            conflictLogger.log.warning("Can't serve the metrics on %s:%s: "
+                                       "%s" % (settings.METRICS_HOST,
+                                               settings.METRICS_PORT, e))
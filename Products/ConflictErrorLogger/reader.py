@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+""" Read the JSON log (CELogger_LOG_FORMAT=json) one event at a time.
+
+The log is streamed line by line, so it can be filtered whatever its size;
+gzipped logs (.gz) are read as they are. Lines that are not JSON (a text log
+appended to the same file) are skipped.
+
+    >>> for event in iter_events('conflicts.log', events=['conflict']):
+    ...     print event['oid'], event['class']
+"""
+
+import gzip
+import json
+from collections import OrderedDict
+from ZODB.utils import oid_repr, p64
+from Products.ConflictErrorLogger.stacks import OMITTED_FILENAME
+from Products.ConflictErrorLogger.stacks import STACK_TABLE_SIZE
+from Products.ConflictErrorLogger.stacks import format_omitted
+
+# Stacks kept by process and signature. The logger writes the stack of a
+# signature again once 2 * STACK_TABLE_SIZE others were written.
+MAX_STACKS = 2 * STACK_TABLE_SIZE
+
+def open_log(path):
+    """ Open the log file, gzipped or not
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def normalize_oid(oid):
+    """ Get the repr of the oid in the log ('0x..') of an int, a p64 or a
+    hex string
+    """
+    if isinstance(oid, (int, long)):
+        return oid_repr(p64(oid))
+    if isinstance(oid, str) and len(oid) == 8 and not oid.startswith('0x'):
+        return oid_repr(oid)
+    return oid_repr(p64(int(oid, 16)))
+
+def iter_events(log, events=None, oids=None, classes=None, since=None,
+                until=None):
+    """ Iterate over the events of the log (a path or an open file), as
+    dicts.
+
+    `events`, `oids` and `classes` are sequences of the event types, oids
+    and dotted class names to keep; `since` and `until` are times (seconds
+    since the epoch). The stack events are filtered by type only.
+    """
+    if isinstance(log, basestring):
+        f = open_log(log)
+    else:
+        f = log
+    if events is not None:
+        events = set(events)
+    if oids is not None:
+        oids = set([normalize_oid(oid) for oid in oids])
+    if classes is not None:
+        classes = set(classes)
+
+    try:
+        for line in f:
+            # Cheap test before decoding the line
+            if not line.startswith('{'):
+                continue
+            if oids is not None and '"oid"' not in line and \
+                    '"stack"' not in line:
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            kind = event.get('event')
+            if events is not None and kind not in events:
+                continue
+            if kind == 'stack':
+                yield event
+                continue
+            if oids is not None and event.get('oid') not in oids:
+                continue
+            if classes is not None and event.get('class') not in classes:
+                continue
+            ts = event.get('ts', 0)
+            if since is not None and ts < since:
+                continue
+            if until is not None and ts >= until:
+                continue
+            yield event
+    finally:
+        if f is not log:
+            f.close()
+
+def format_frames(frames):
+    """ Format the frames of a stack event like traceback.format_stack
+    """
+    lines = []
+    for filename, lineno, name in frames:
+        if filename == OMITTED_FILENAME:
+            lines.append(format_omitted(lineno, name))
+        else:
+            lines.append('  File "%s", line %d, in %s\n' % (filename, lineno,
+                                                           name))
+    return "".join(lines)
+
+class StackCache(object):
+    """ The `size` last used values (stacks) by key, the least recently
+    used one is dropped first.
+    """
+
+    def __init__(self, size=MAX_STACKS):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        value = self.items.pop(key, None)
+        if value is not None:
+            self.items[key] = value
+        return value
+
+    def set(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+class StackResolver(object):
+    """ Keep the stacks read from the log, by process and signature.
+
+    Feed it all the events (the stack of a signature is written before the
+    first event referring to it):
+
+        >>> resolver = StackResolver()
+        >>> for event in resolver.resolve(iter_events(path)):
+        ...     if event['event'] == 'conflict':
+        ...         print resolver.format(event)
+    """
+
+    def __init__(self, size=MAX_STACKS):
+        # (pid, sig) -> frames
+        self.stacks = StackCache(size)
+
+    def resolve(self, events):
+        """ Keep the stacks, yield the other events
+        """
+        for event in events:
+            if event.get('event') == 'stack':
+                self.stacks.set((event.get('pid'), event['sig']),
+                                event['frames'])
+            else:
+                yield event
+
+    def get(self, event, sig=None):
+        """ Get the frames of the signature (of the event by default)
+        """
+        if sig is None:
+            sig = event.get('sig')
+        return self.stacks.get((event.get('pid'), sig))
+
+    def format(self, event):
+        """ Format the stack of the event, and of the other connections
+        changing the object
+        """
+        result = []
+        frames = self.get(event)
+        if frames:
+            result.append(format_frames(frames))
+        for other in event.get('others', ()):
+            for kind, stamp, sig in other['records']:
+                frames = self.get(event, sig)
+                result.append("connection %s, %s (signature: %s):\n%s" % (
+                              other['conn'], kind, sig,
+                              frames and format_frames(frames) or
+                              "(no stack)\n"))
+        return "".join(result)
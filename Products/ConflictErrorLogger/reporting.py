@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+""" Deduplication of the reports of a hot object.
+
+The overlaps and ConflictErrors of the same object (or class) and code path
+(stack signature) are reported once per window (CELogger_REPORT_WINDOW
+seconds): the next ones are only counted, and when the window is over the
+count is reported on a summary line:
+
+    The report was repeated. (event: conflict, object._p_oid: 0x3f2a,
+    class: BTrees.OOBTree.OOBucket, signature: 12, occurrences: 340 in 60s)
+
+The windows over are summarized by the next report, or by the logger's
+"CELogger reports" thread, which expires them every REPORT_SWEEP_INTERVAL
+seconds even if no report comes: a summary is written at the latest one
+window (and REPORT_SWEEP_INTERVAL) after the end of its window. The counts
+of the current windows are written when the logger is reset or deactivated
+and when the process exits. At most `size` keys are kept, the oldest one is
+summarized first when another one comes.
+"""
+
+import time
+import thread
+
+REPORT_WINDOW = 60
+REPORT_MAX_KEYS = 1000
+# Seconds between the expirations of the windows over (see expire)
+REPORT_SWEEP_INTERVAL = 1
+
+class Deduplicator(object):
+    """ The keys reported in the current window, and their count of
+    occurrences not reported.
+    """
+
+    def __init__(self, window=REPORT_WINDOW, size=REPORT_MAX_KEYS):
+        self.window = window
+        self.size = size
+        # key -> [start of the window, occurrences not reported]
+        self.keys = {}
+        self.next_sweep = time.time() + window
+        self.lock = thread.allocate_lock()
+
+    def check(self, key, now=None):
+        """ Get (report, summaries): if the occurrence of the key must be
+        reported, and the (key, occurrences, seconds) of the windows to
+        summarize
+        """
+        if now is None:
+            now = time.time()
+        summaries = []
+        self.lock.acquire()
+        try:
+            if now >= self.next_sweep:
+                self.sweep(now, summaries)
+            keys = self.keys
+            entry = keys.get(key)
+            if entry is not None:
+                if now - entry[0] < self.window:
+                    entry[1] += 1
+                    return False, summaries
+                if entry[1]:
+                    summaries.append((key, entry[1], now - entry[0]))
+            elif len(keys) >= self.size:
+                oldest = min(keys, key=lambda k: keys[k][0])
+                start, count = keys.pop(oldest)
+                if count:
+                    summaries.append((oldest, count, now - start))
+            keys[key] = [now, 0]
+            return True, summaries
+        finally:
+            self.lock.release()
+
+    def sweep(self, now, summaries):
+        """ Forget the keys whose window is over, and add the summaries of
+        their occurrences not reported
+        """
+        self.next_sweep = now + self.window
+        for key, (start, count) in self.keys.items():
+            if now - start >= self.window:
+                del self.keys[key]
+                if count:
+                    summaries.append((key, count, now - start))
+
+    def expire(self, now=None):
+        """ Get the summaries of the windows over, if they were not swept
+        lately (the reports may stop coming)
+        """
+        if now is None:
+            now = time.time()
+        summaries = []
+        self.lock.acquire()
+        try:
+            if now >= self.next_sweep:
+                self.sweep(now, summaries)
+        finally:
+            self.lock.release()
+        return summaries
+
+    def flush(self, now=None):
+        """ Forget all the keys, get the summaries of their occurrences not
+        reported
+        """
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            summaries = [(key, count, now - start)
+                         for key, (start, count) in self.keys.items()
+                         if count]
+            self.keys = {}
+            self.next_sweep = now + self.window
+        finally:
+            self.lock.release()
+        return summaries
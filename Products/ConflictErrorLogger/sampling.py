@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+""" Capture modes: which registers pay for taking the stack.
+
+The overlap detection runs for every register, whatever the mode; only the
+stack capture is sampled.
+"""
+
+import time
+import itertools
+from Products.ConflictErrorLogger.watchlist import Watchlist
+
+# Capture the stack of every register
+CAPTURE_ALL = 'all'
+# Capture 1 in CAPTURE_SAMPLE_RATE registers
+CAPTURE_SAMPLE = 'sample'
+# Capture at most CAPTURE_BUDGET stacks per second
+CAPTURE_BUDGET = 'budget'
+# Capture every register of the objects (or classes) in the watchlist, that
+# were involved in an overlap or conflict in the last CAPTURE_HOT_TTL seconds,
+# sample the others
+CAPTURE_ADAPTIVE = 'adaptive'
+# Capture every register of the objects in the watchlist, the others just
+# record that the connection is changing them (no pool entry, no stack)
+CAPTURE_WATCHLIST = 'watchlist'
+CAPTURE_MODES = (CAPTURE_ALL, CAPTURE_SAMPLE, CAPTURE_BUDGET, CAPTURE_ADAPTIVE,
+                 CAPTURE_WATCHLIST)
+
+CAPTURE_SAMPLE_RATE = 100
+CAPTURE_BUDGET_PER_SECOND = 100
+CAPTURE_HOT_TTL = 600
+
+class Sampler(object):
+    """ Decide if the stack of a register is captured.
+
+    The counters are not locked; under concurrency the sample rate and the
+    budget are approximate.
+    """
+
+    def __init__(self, mode=CAPTURE_ALL, rate=CAPTURE_SAMPLE_RATE,
+                 budget=CAPTURE_BUDGET_PER_SECOND, hot_ttl=CAPTURE_HOT_TTL):
+        if mode not in CAPTURE_MODES:
+            raise ValueError("Unknown capture mode %r, use one of: %s" % (
+                             mode, ", ".join(CAPTURE_MODES)))
+        self.mode = mode
+        self.rate = max(1, rate)
+        self.budget = budget
+        self.hot_ttl = hot_ttl
+        self.counter = itertools.count(1)
+        self.second = 0
+        self.captured = 0
+        self.watchlist = Watchlist(half_life=hot_ttl)
+
+    def should_capture(self, oid, klass=None):
+        """ Check if the stack of this register must be captured
+        """
+        if self.mode == CAPTURE_ALL:
+            return True
+        if self.mode == CAPTURE_SAMPLE:
+            return self.sample()
+        if self.mode == CAPTURE_BUDGET:
+            return self.within_budget()
+        if self.watchlist.watched(oid, klass):
+            return True
+        if self.mode == CAPTURE_WATCHLIST:
+            return False
+        return self.sample()
+
+    def fast_path(self):
+        """ Check if the registers not captured skip the pool
+        """
+        return self.mode == CAPTURE_WATCHLIST
+
+    def sample(self):
+        """ True once every `rate` calls
+        """
+        return self.counter.next() % self.rate == 0
+
+    def within_budget(self):
+        """ True for the first `budget` calls of each second
+        """
+        now = int(time.time())
+        if now != self.second:
+            self.second = now
+            self.captured = 0
+        if self.captured >= self.budget:
+            return False
+        self.captured += 1
+        return True
+
+    def mark_hot(self, oid, klass=None):
+        """ The object was involved in an overlap or a conflict
+        """
+        self.watchlist.watch(oid, klass)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+""" The CELogger_* environment variables.
+
+They are read (and converted) once, when the product is loaded; the hot
+paths never look at os.environ.
+"""
+
+import os
+from Products.ConflictErrorLogger.dumper import OVERFLOW_DROP_OLDEST
+from Products.ConflictErrorLogger.dumper import LOG_FORMAT_TEXT
+from Products.ConflictErrorLogger.dumper import LOG_BACKUPS
+from Products.ConflictErrorLogger.metrics import METRICS_HOST
+
+ENVIRON_PREFIX = 'CELogger_'
+
+def asbool(value):
+    """ Convert an environment variable to a boolean
+    """
+    return value.strip().lower() in ('true', 'yes', 'on', '1')
+
+class Settings(object):
+    """ The options, with their converter and default value.
+    """
+
+    options = {
+        # Install the patches at startup (see patch.activate/deactivate)
+        'ACTIVE': (asbool, True),
+        'LOGFILE': (str, ''),
+        'LOG_QUEUE_SIZE': (int, 0),
+        'LOG_QUEUE_OVERFLOW': (str, OVERFLOW_DROP_OLDEST),
+        # Rotate the log file over this size (bytes) and every interval
+        # (seconds, e.g. 3600 at each hour), keep the last LOG_BACKUPS
+        # rotated files (0 all), gzipped by a background thread
+        'LOG_MAX_BYTES': (int, 0),
+        'LOG_ROTATE_INTERVAL': (int, 0),
+        'LOG_BACKUPS': (int, LOG_BACKUPS),
+        'LOG_COMPRESS': (asbool, True),
+        # 'text' or 'json' (one event per line, see reader.py)
+        'LOG_FORMAT': (str, LOG_FORMAT_TEXT),
+        # Name of a signal toggling the logger on and off, e.g. SIGTTIN.
+        # Zope already dumps the stacks on SIGUSR1 and reopens the logs on
+        # SIGUSR2; the handlers of a signal are all called.
+        'TOGGLE_SIGNAL': (str, ''),
+        'FIRST_CHANGE_ONLY': (asbool, True),
+        'RAISE_CONFLICTERRORPREVIEW': (asbool, False),
+        'LOCK_STRIPES': (int, None),
+        'STACK_TABLE_SIZE': (int, None),
+        # Frames kept in the stacks (0 all), and the modules whose frames
+        # are collapsed, e.g. "ZPublisher, ZODB" ("" none)
+        'STACK_MAX_DEPTH': (int, None),
+        'STACK_COLLAPSE': (str, None),
+        'POOL_MAX_ENTRIES': (int, None),
+        'POOL_MAX_BYTES': (int, None),
+        'POOL_TTL': (int, None),
+        'CAPTURE_MODE': (str, None),
+        'CAPTURE_SAMPLE_RATE': (int, None),
+        'CAPTURE_BUDGET': (int, None),
+        'CAPTURE_HOT_TTL': (int, None),
+        'WATCHLIST_FILE': (str, None),
+        # SQLite database shared by the processes of the host (aggregator.py)
+        'AGGREGATOR_DB': (str, None),
+        'AGGREGATOR_QUEUE_SIZE': (int, None),
+        # Registers of a thread sent to the aggregator at once
+        'PUBLISH_BATCH': (int, None),
+        # Include/exclude rules (filters.py), e.g. "-_p_resolveConflict"
+        'FILTERS': (str, None),
+        # Seconds the repeated reports of an object are only counted
+        # (reporting.py), 0 reports them all
+        'REPORT_WINDOW': (int, None),
+        'REPORT_MAX_KEYS': (int, None),
+        # Top offenders counters (stats.py), 0 disables them
+        'STATS_TOP_SIZE': (int, None),
+        'STATS_HALF_LIFE': (int, None),
+        # Count the events and time the registers (metrics.py), served by
+        # a view and, with a port, by an HTTP listener
+        'METRICS': (asbool, None),
+        'METRICS_PORT': (int, None),
+        'METRICS_HOST': (str, METRICS_HOST),
+    }
+
+    # The options passed to ConflictLogger.config
+    monitor_options = (
+        'FIRST_CHANGE_ONLY',
+        'RAISE_CONFLICTERRORPREVIEW',
+        'LOCK_STRIPES',
+        'STACK_TABLE_SIZE',
+        'STACK_MAX_DEPTH',
+        'STACK_COLLAPSE',
+        'POOL_MAX_ENTRIES',
+        'POOL_MAX_BYTES',
+        'POOL_TTL',
+        'CAPTURE_MODE',
+        'CAPTURE_SAMPLE_RATE',
+        'CAPTURE_BUDGET',
+        'CAPTURE_HOT_TTL',
+        'WATCHLIST_FILE',
+        'LOG_FORMAT',
+        'AGGREGATOR_DB',
+        'AGGREGATOR_QUEUE_SIZE',
+        'STATS_TOP_SIZE',
+        'STATS_HALF_LIFE',
+        'METRICS',
+        'PUBLISH_BATCH',
+        'FILTERS',
+        'REPORT_WINDOW',
+        'REPORT_MAX_KEYS',
+    )
+
+    def __init__(self, environ=None, prefix=ENVIRON_PREFIX):
+        if environ is None:
+            environ = os.environ
+        for name, (convert, default) in self.options.items():
+            value = environ.get(prefix + name)
+            if value is None:
+                setattr(self, name, default)
+            else:
+                try:
+                    setattr(self, name, convert(value))
+                except ValueError:
+                    raise ValueError("Invalid value for %s%s: %r" % (
+                                     prefix, name, value))
+
+    def monitor_config(self):
+        """ Get the keyword arguments of ConflictLogger.config
+        """
+        return dict([(name, getattr(self, name))
+                     for name in self.monitor_options])
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+""" Compact call stacks.
+
+A stack is kept as a tuple of (code, lineno) pairs, oldest call first. It is
+cheap to take and small to keep; the source lines are only read when the
+stack is printed. Identical stacks are interned in a StackTable and
+referred to by a signature id.
+
+A FrameFilter shortens the stacks while they are taken: the frames of some
+modules (ZPublisher, ZODB...) are collapsed into one (COLLAPSED, count)
+entry, or dropped when they are the closest to the change (the logger and
+ZODB calls), and the walk stops after `max_depth` frames, leaving a
+(TRUNCATED, 0) entry.
+"""
+
+import sys
+import thread
+import itertools
+import linecache
+
+STACK_TABLE_SIZE = 10000
+# Modules whose frames are the same in most stacks
+STACK_COLLAPSE = ('ZServer', 'ZPublisher', 'ZODB', 'transaction',
+                  'Products.ConflictErrorLogger.patch',
+                  'Products.ConflictErrorLogger.monitor')
+OMITTED_FILENAME = '...'
+OMITTED_PREFIX = '  ... '
+
+class Omitted(object):
+    """ Stands for the code of the frames left out of a stack.
+    """
+    co_filename = OMITTED_FILENAME
+
+    def __init__(self, name):
+        self.co_name = name
+
+COLLAPSED = Omitted('frames collapsed')
+TRUNCATED = Omitted('outer frames not captured')
+
+class FrameFilter(object):
+    """ Maximum depth of the stacks (0 unlimited) and the modules (dotted
+    prefixes) whose frames are collapsed.
+    """
+
+    def __init__(self, max_depth=0, collapse=STACK_COLLAPSE):
+        if isinstance(collapse, basestring):
+            collapse = collapse.replace(',', ' ').split()
+        self.max_depth = max_depth
+        self.collapse = tuple(collapse)
+        # code -> collapsed
+        self.codes = {}
+
+    def collapsed(self, frame):
+        """ Check if the frame is collapsed, decided once per code
+        """
+        name = frame.f_globals.get('__name__') or ''
+        result = False
+        for prefix in self.collapse:
+            if name == prefix or name.startswith(prefix + '.'):
+                result = True
+                break
+        self.codes[frame.f_code] = result
+        return result
+
+def capture_stack(skip=0, frame_filter=None):
+    """ Get the stack of the caller (minus `skip` frames).
+    """
+    frame = sys._getframe(skip + 1)
+    stack = []
+    if frame_filter is None or not (frame_filter.max_depth or
+                                    frame_filter.collapse):
+        while frame is not None:
+            stack.append((frame.f_code, frame.f_lineno))
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    max_depth = frame_filter.max_depth
+    if not frame_filter.collapse:
+        while frame is not None:
+            stack.append((frame.f_code, frame.f_lineno))
+            frame = frame.f_back
+            if len(stack) >= max_depth:
+                if frame is not None:
+                    stack.append((TRUNCATED, 0))
+                break
+        stack.reverse()
+        return tuple(stack)
+
+    codes = frame_filter.codes
+    collapsed = 0
+    while frame is not None:
+        code = frame.f_code
+        skipped = codes.get(code)
+        if skipped is None:
+            skipped = frame_filter.collapsed(frame)
+        if skipped:
+            collapsed += 1
+        else:
+            # The frames closest to the change are dropped
+            if collapsed and stack:
+                stack.append((COLLAPSED, collapsed))
+            collapsed = 0
+            stack.append((code, frame.f_lineno))
+            if max_depth and len(stack) >= max_depth:
+                if frame.f_back is not None:
+                    stack.append((TRUNCATED, 0))
+                break
+        frame = frame.f_back
+    if collapsed:
+        stack.append((COLLAPSED, collapsed))
+    stack.reverse()
+    return tuple(stack)
+
+def format_omitted(count, name):
+    """ Format the entry of the frames left out of a stack
+    """
+    if count:
+        return '%s%d %s\n' % (OMITTED_PREFIX, count, name)
+    return '%s%s\n' % (OMITTED_PREFIX, name)
+
+def format_stack(stack):
+    """ Format the stack like traceback.format_stack (string)
+    """
+    lines = []
+    for code, lineno in stack:
+        if code.__class__ is Omitted:
+            lines.append(format_omitted(lineno, code.co_name))
+            continue
+        filename = code.co_filename
+        lines.append('  File "%s", line %d, in %s\n' % (filename, lineno,
+                                                       code.co_name))
+        line = linecache.getline(filename, lineno)
+        if line:
+            lines.append('    %s\n' % line.strip())
+    return "".join(lines)
+
+class StackTable(object):
+    """ Table of the distinct stacks (signatures) and how often they were hit.
+
+    The table has a bounded size; when it is full the least used signatures
+    are dropped, except the ones `referenced()` returns (still needed to log
+    a conflict, e.g. rare code paths). Looking up a known stack takes no
+    lock, so the hit counters are approximate.
+    """
+
+    def __init__(self, size=STACK_TABLE_SIZE, referenced=None):
+        self.size = size
+        self.referenced = referenced
+        self.lock = thread.allocate_lock()
+        self.ids = {}
+        self.signatures = {}
+        self.counter = itertools.count(1)
+        self.evicted = 0
+
+    def intern(self, stack):
+        """ Get the signature id of the stack, and count one hit.
+        """
+        entry = self.signatures.get(self.ids.get(stack))
+        if entry is not None:
+            entry[1] += 1
+            return entry[2]
+
+        self.lock.acquire()
+        try:
+            entry = self.signatures.get(self.ids.get(stack))
+            if entry is not None:
+                entry[1] += 1
+                return entry[2]
+            if len(self.signatures) >= self.size:
+                self.evict()
+            sig = self.counter.next()
+            self.signatures[sig] = [stack, 1, sig]
+            self.ids[stack] = sig
+            return sig
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        """ Drop the least used tenth of the signatures not referenced
+        """
+        count = max(1, len(self.signatures) // 10)
+        entries = self.signatures.values()
+        if self.referenced is not None:
+            keep = self.referenced()
+            entries = [entry for entry in entries if entry[2] not in keep]
+        entries.sort(key=lambda e: e[1])
+        for stack, hits, sig in entries[:count]:
+            del self.signatures[sig]
+            del self.ids[stack]
+            self.evicted += 1
+
+    def get(self, sig):
+        """ Get the stack of the signature (None if it was dropped)
+        """
+        entry = self.signatures.get(sig)
+        if entry is not None:
+            return entry[0]
+
+    def hits(self, sig):
+        """ Get how often the signature was hit
+        """
+        entry = self.signatures.get(sig)
+        if entry is not None:
+            return entry[1]
+        return 0
+
+    def top(self, n=10):
+        """ Get the (hits, sig, stack) of the n most hit signatures
+        """
+        entries = sorted(self.signatures.values(), key=lambda e: e[1],
+                         reverse=True)
+        return [(hits, sig, stack) for stack, hits, sig in entries[:n]]
+
+    def clear(self):
+        """ Drop all the signatures
+        """
+        self.lock.acquire()
+        try:
+            self.ids = {}
+            self.signatures = {}
+        finally:
+            self.lock.release()
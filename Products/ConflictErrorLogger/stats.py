@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+""" Rolling counters of the registers, overlaps, ConflictErrors and previews,
+by oid, class and stack signature.
+
+The counts are estimated with a count-min sketch (fixed size, never below
+the real count) and only the top keys are kept, so the memory is bounded
+whatever the number of objects. Every `half_life` seconds the counts are
+halved, the top follows the recent activity.
+
+    >>> conflictLogger.stats.top('conflicts', 'class', 5)
+    [(12, 'BTrees.OOBTree.OOBucket'), (3, 'Products.Foo.Bar')]
+
+The durations of the overlaps (two connections changing the same object)
+and the time the losing transactions ran before their ConflictError are
+kept in a histogram per class, for the `size` first classes (the others are
+counted together):
+
+    >>> conflictLogger.stats.durations[('overlap', 'Products.Foo.Bar')]
+    [3, 1, 0, 0, 0, 0, 0, 0, 0, 0, 4, 0.72]
+
+The time (wall and CPU) of the publishing attempts discarded by a retry is
+counted (in milliseconds) on the object, class and code path of the
+ConflictError that caused the retry, and reported per hour:
+
+    >>> conflictLogger.stats.wasted_top('class', 5)
+    [(180.2, 2.5, 1.9, 'BTrees.OOBTree.OOBucket')]
+"""
+
+import time
+import thread
+import bisect
+from ZODB.utils import oid_repr
+
+EVENT_REGISTERS = 'registers'
+EVENT_OVERLAPS = 'overlaps'
+EVENT_CONFLICTS = 'conflicts'
+EVENT_PREVIEWS = 'previews'
+EVENTS = (EVENT_REGISTERS, EVENT_OVERLAPS, EVENT_CONFLICTS, EVENT_PREVIEWS)
+DIMENSIONS = ('oid', 'class', 'sig')
+DURATION_OVERLAP = 'overlap'
+DURATION_CONFLICT = 'time-to-conflict'
+DURATIONS = (DURATION_OVERLAP, DURATION_CONFLICT)
+# Upper bounds (seconds) of the buckets of the duration histograms
+DURATION_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+OTHER_CLASSES = '(other)'
+
+STATS_TOP_SIZE = 100
+STATS_HALF_LIFE = 3600
+SKETCH_WIDTH = 4096
+SKETCH_DEPTH = 4
+
+class HeavyHitters(object):
+    """ Approximate counts of the keys, and the `size` most counted ones.
+
+    The sketch is not locked, concurrent adds may be lost; the top is
+    locked when a key replaces another one.
+    """
+
+    def __init__(self, size=STATS_TOP_SIZE, width=SKETCH_WIDTH,
+                 depth=SKETCH_DEPTH):
+        self.size = size
+        self.width = width
+        self.rows = [[0] * width for i in range(depth)]
+        # key -> estimated count
+        self.top = {}
+        # Lowest count in the top (may be lower than the real one)
+        self.threshold = 0
+        self.total = 0
+        self.lock = thread.allocate_lock()
+
+    def add(self, key, n=1):
+        """ Count the key n times
+        """
+        self.total += n
+        h = hash(key)
+        step = (h >> 16) | 1
+        width = self.width
+        estimate = None
+        for row in self.rows:
+            i = h % width
+            count = row[i] = row[i] + n
+            if estimate is None or count < estimate:
+                estimate = count
+            h += step
+
+        top = self.top
+        if key in top:
+            top[key] = estimate
+        elif len(top) < self.size or estimate > self.threshold:
+            self.lock.acquire()
+            try:
+                if len(top) >= self.size:
+                    lowest = min(top, key=top.get)
+                    if top[lowest] >= estimate:
+                        self.threshold = top[lowest]
+                        return
+                    del top[lowest]
+                top[key] = estimate
+                if len(top) >= self.size:
+                    self.threshold = min(top.itervalues())
+            finally:
+                self.lock.release()
+
+    def get(self, key):
+        """ Get the estimated count of the key
+        """
+        h = hash(key)
+        step = (h >> 16) | 1
+        estimate = None
+        for row in self.rows:
+            count = row[h % self.width]
+            if estimate is None or count < estimate:
+                estimate = count
+            h += step
+        return estimate
+
+    def most_common(self, n=10):
+        """ Get the (count, key) of the n most counted keys
+        """
+        items = [(count, key) for key, count in self.top.items()]
+        items.sort(reverse=True)
+        return items[:n]
+
+    def merge(self, other):
+        """ Add the counts of another counter of the same width and depth
+        """
+        for row, other_row in zip(self.rows, other.rows):
+            row[:] = [a + b for a, b in zip(row, other_row)]
+        self.total += other.total
+        keys = set(self.top) | set(other.top)
+        top = [(self.get(key), key) for key in keys]
+        top.sort(reverse=True)
+        self.top = dict([(key, count) for count, key in top[:self.size]])
+        self.threshold = 0
+
+    def __getstate__(self):
+        # For the process pool of the analyzer
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = thread.allocate_lock()
+
+    def halve(self):
+        """ Halve the counts (older counts weigh less)
+        """
+        self.lock.acquire()
+        try:
+            for row in self.rows:
+                row[:] = [count // 2 for count in row]
+            self.top = dict([(key, count // 2)
+                             for key, count in self.top.items()
+                             if count > 1])
+            self.threshold = 0
+            self.total //= 2
+        finally:
+            self.lock.release()
+
+class ConflictStats(object):
+    """ The counters of each event, by oid, class and stack signature.
+    """
+
+    def __init__(self, size=STATS_TOP_SIZE, half_life=STATS_HALF_LIFE):
+        self.size = size
+        self.half_life = half_life
+        self.clear()
+
+    def clear(self):
+        """ Forget all the counts
+        """
+        self.counters = dict([((event, dimension), HeavyHitters(self.size))
+                              for event in EVENTS
+                              for dimension in DIMENSIONS])
+        self.totals = dict.fromkeys(EVENTS, 0)
+        # (kind, class) -> [buckets..., +Inf bucket, count, sum]
+        self.durations = {}
+        self.duration_classes = dict.fromkeys(DURATIONS, 0)
+        # Milliseconds wasted by the retries, (kind, dimension) -> counter
+        self.wasted = dict([((kind, dimension), HeavyHitters(self.size))
+                            for kind in ('wall', 'cpu')
+                            for dimension in DIMENSIONS])
+        self.retries = 0
+        # Retries whose CPU time is not available (see monitor.thread_cpu)
+        self.retries_no_cpu = 0
+        self.wasted_wall = self.wasted_cpu = 0.0
+        # Start of the time the counts were taken in (see per_hour)
+        self.window_start = time.time()
+        self.next_halving = self.half_life and time.time() + self.half_life
+
+    def count(self, event, oid=None, klass=None, sig=None):
+        """ Count the event of the object (oid), its class (dotted name) and
+        the code path (stack signature)
+        """
+        if self.next_halving and time.time() > self.next_halving:
+            self.halve()
+        self.totals[event] += 1
+        if oid is not None:
+            self.counters[(event, 'oid')].add(oid)
+        if klass is not None:
+            self.counters[(event, 'class')].add(klass)
+        if sig is not None:
+            self.counters[(event, 'sig')].add(sig)
+
+    def observe(self, kind, klass, seconds):
+        """ Count a duration (DURATION_OVERLAP or DURATION_CONFLICT) of
+        the class (dotted name)
+        """
+        key = (kind, klass)
+        histogram = self.durations.get(key)
+        if histogram is None:
+            if self.duration_classes[kind] >= self.size:
+                key = (kind, OTHER_CLASSES)
+                histogram = self.durations.get(key)
+            else:
+                self.duration_classes[kind] += 1
+            if histogram is None:
+                histogram = self.durations[key] = \
+                    [0] * (len(DURATION_BUCKETS) + 2) + [0.0]
+        histogram[bisect.bisect_left(DURATION_BUCKETS, seconds)] += 1
+        histogram[-2] += 1
+        histogram[-1] += seconds
+
+    def waste(self, oid, klass, sig, wall, cpu):
+        """ Count the wall and CPU time (seconds, None if not available) of
+        an attempt discarded because of a ConflictError of the object
+        """
+        self.retries += 1
+        self.wasted_wall += wall
+        if cpu is None:
+            self.retries_no_cpu += 1
+        else:
+            self.wasted_cpu += cpu
+        for kind, seconds in (('wall', wall), ('cpu', cpu)):
+            if seconds is None:
+                continue
+            ms = int(seconds * 1000)
+            if ms <= 0:
+                continue
+            for dimension, key in (('oid', oid), ('class', klass),
+                                   ('sig', sig)):
+                if key is not None:
+                    self.wasted[(kind, dimension)].add(key, ms)
+
+    def per_hour(self, seconds):
+        """ Get the seconds per hour, of seconds counted since the start
+        of the window (at least a minute, not to extrapolate a few retries)
+        """
+        return seconds * 3600 / max(time.time() - self.window_start, 60)
+
+    def wasted_top(self, dimension, n=10):
+        """ Get the (wasted seconds per hour, wall seconds, CPU seconds,
+        key) of the n objects, classes or code paths wasting the most time
+        in retries
+        """
+        cpu = self.wasted[('cpu', dimension)]
+        result = []
+        for ms, key in self.wasted[('wall', dimension)].most_common(n):
+            cpu_ms = cpu.get(key)
+            if dimension == 'oid':
+                key = oid_repr(key)
+            result.append((self.per_hour(ms / 1000.0), ms / 1000.0,
+                           cpu_ms / 1000.0, key))
+        return result
+
+    def halve(self):
+        """ Halve all the counts
+        """
+        self.next_halving = time.time() + self.half_life
+        for counter in self.counters.values():
+            counter.halve()
+        for event in EVENTS:
+            self.totals[event] //= 2
+        for histogram in self.durations.values():
+            histogram[:-1] = [count // 2 for count in histogram[:-1]]
+            histogram[-1] /= 2
+        for counter in self.wasted.values():
+            counter.halve()
+        self.retries //= 2
+        self.retries_no_cpu //= 2
+        self.wasted_wall /= 2
+        self.wasted_cpu /= 2
+        # Half the counts: as if they were taken in half the time
+        now = time.time()
+        self.window_start = now - (now - self.window_start) / 2
+
+    def top(self, event, dimension, n=10):
+        """ Get the (count, key) of the n top offenders of the event by 'oid'
+        (as '0x..'), 'class' (dotted name) or 'sig' (stack signature)
+        """
+        if event not in EVENTS or dimension not in DIMENSIONS:
+            raise ValueError("Unknown counter %r, %r: use one of %s by one "
+                             "of %s" % (event, dimension, ", ".join(EVENTS),
+                                        ", ".join(DIMENSIONS)))
+        result = self.counters[(event, dimension)].most_common(n)
+        if dimension == 'oid':
+            result = [(count, oid_repr(oid)) for count, oid in result]
+        return result
+
+    def duration_top(self, kind, n=10):
+        """ Get the (total seconds, class, count, histogram) of the n
+        classes with the longest durations of the kind
+        """
+        result = [(histogram[-1], klass, histogram[-2], histogram)
+                  for (k, klass), histogram in self.durations.items()
+                  if k == kind]
+        result.sort(reverse=True)
+        return result[:n]
+
+    def report(self, n=10):
+        """ Get the totals and the top offenders of each event (text)
+        """
+        lines = []
+        for event in EVENTS:
+            lines.append("%s: %s" % (event, self.totals[event]))
+            for dimension in DIMENSIONS:
+                for count, key in self.top(event, dimension, n):
+                    lines.append("    %s %s: %s" % (dimension, key, count))
+        bounds = ["<=%ss" % bound for bound in DURATION_BUCKETS] + ["more"]
+        for kind in DURATIONS:
+            lines.append("%s durations:" % kind)
+            for total, klass, count, histogram in self.duration_top(kind, n):
+                buckets = ", ".join(["%s: %s" % (bound, value) for bound, value
+                                     in zip(bounds, histogram) if value])
+                lines.append("    class %s: %s, mean %.3fs (%s)" % (
+                             klass, count, count and total / count, buckets))
+        # Not measured at all (outside Linux): not shown as 0
+        no_cpu = self.retries and self.retries_no_cpu == self.retries
+        def format_cpu(seconds):
+            if no_cpu:
+                return "n/a"
+            return "%.3fs" % seconds
+        lines.append("retries: %s, wasted %.3fs (CPU %s), %.1fs per "
+                     "hour" % (self.retries, self.wasted_wall,
+                               format_cpu(self.wasted_cpu),
+                               self.per_hour(self.wasted_wall)))
+        for dimension in DIMENSIONS:
+            for per_hour, wall, cpu, key in self.wasted_top(dimension, n):
+                lines.append("    %s %s: %.1fs per hour (wasted %.3fs, CPU "
+                             "%s)" % (dimension, key, per_hour, wall,
+                                      format_cpu(cpu)))
+        return "\n".join(lines)
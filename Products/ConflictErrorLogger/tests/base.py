@@ -12,7 +12,11 @@ import transaction
 from persistent import Persistent  
 
 from Products.ConflictErrorLogger.patch import conflictLogger
+from Products.ConflictErrorLogger.patch import activate, deactivate
 from Products.ConflictErrorLogger.dumper import do_enable
+from Products.ConflictErrorLogger.dumper import LOG_FORMAT_TEXT
+from Products.ConflictErrorLogger.monitor import POOL_MAX_ENTRIES
+from Products.ConflictErrorLogger.sampling import CAPTURE_ALL
 
 def removeDirectory(wd):
     """ Remove the test directory and files
@@ -70,6 +74,11 @@ class TestBase(unittest.TestCase):
     def tearDown(self):
         """ close and delete.
         """
+        activate()
+        if hasattr(self, 'logCE'):
+            for handler in list(self.logCE.handlers):
+                self.logCE.removeHandler(handler)
+                handler.close()
         self.db.close()
         self.storage.close()
         removeDirectory(self.testdir)
@@ -77,7 +86,8 @@ class TestBase(unittest.TestCase):
     def getLog(self, continue_from_here=""):
         """ Read the log file.
         """
-        self.logCE.handlers[0].flush()
+        for handler in self.logCE.handlers:
+            handler.flush()
         #f = open(self.logCE.handlers[0].baseFilename, "r")
         f = open(self.logfile, "r")
         text = f.read()
@@ -86,15 +96,34 @@ class TestBase(unittest.TestCase):
 
     def configureCE(self,
                     CELogger_LOGFILE='conflict_error_test.log',
+                    CELogger_LOG_QUEUE_SIZE=0,
                     CELogger_FIRST_CHANGE_ONLY=True,
                     CELogger_RAISE_CONFLICTERRORPREVIEW=False,
-                    CELogger_ACTIVE=True):
+                    CELogger_ACTIVE=True,
+                    CELogger_POOL_MAX_ENTRIES=POOL_MAX_ENTRIES,
+                    CELogger_POOL_MAX_BYTES=0,
+                    CELogger_POOL_TTL=0,
+                    CELogger_CAPTURE_MODE=CAPTURE_ALL,
+                    CELogger_CAPTURE_SAMPLE_RATE=None,
+                    CELogger_LOG_FORMAT=LOG_FORMAT_TEXT):
         """ configure ClinflictErrorLooger
         """
         self.logfile = os.path.join(self.testdir, CELogger_LOGFILE)
-        self.logCE = do_enable(self.logfile)
+        self.logCE = do_enable(self.logfile, CELogger_LOG_QUEUE_SIZE,
+                               log_format=CELogger_LOG_FORMAT)
         self.logCE.level = logging.DEBUG
+        conflictLogger.reset()
         conflictLogger.config(
                  log=self.logCE,
                  FIRST_CHANGE_ONLY=CELogger_FIRST_CHANGE_ONLY,
-                 RAISE_CONFLICTERRORPREVIEW=CELogger_RAISE_CONFLICTERRORPREVIEW)
+                 RAISE_CONFLICTERRORPREVIEW=CELogger_RAISE_CONFLICTERRORPREVIEW,
+                 POOL_MAX_ENTRIES=CELogger_POOL_MAX_ENTRIES,
+                 POOL_MAX_BYTES=CELogger_POOL_MAX_BYTES,
+                 POOL_TTL=CELogger_POOL_TTL,
+                 CAPTURE_MODE=CELogger_CAPTURE_MODE,
+                 CAPTURE_SAMPLE_RATE=CELogger_CAPTURE_SAMPLE_RATE,
+                 LOG_FORMAT=CELogger_LOG_FORMAT)
+        if CELogger_ACTIVE:
+            activate()
+        else:
+            deactivate()
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks of the patched Connection.register and of the commits.
+
+Every thread changes its own objects (unrelated oids). Under the GIL the
+throughput does not grow with the thread count, and the lock stripes
+perform about as one lock: they only save the waits of a thread for a lock
+holder that released the GIL, and the DEBUG messages written under the lock
+are serialized by the log handler anyway. The benchmark measures the cost
+of a register and finds the regressions, not a scaling. A "holder"
+connection keeps `pool` objects changed (not committed) meanwhile, to
+measure the cost of a big pool.
+
+The logger runs in each of the modes:
+
+    unpatched   deactivated, the original ZODB methods (the baseline)
+    watchlist   active, nothing watched: the changes are only indexed
+    active      active, the stack of every change is captured
+
+with FIRST_CHANGE_ONLY on and off, the pool guarded by 64 striped locks or
+by one global lock (LOCK_STRIPES=1), and the DEBUG messages off and on (the
+cost of a register when every change is written). The results are written
+as JSON, and a previous report can be compared to find the regressions:
+
+    python -m Products.ConflictErrorLogger.tests.benchmark -o new.json
+    python -m Products.ConflictErrorLogger.tests.benchmark --compare old.json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+import threading
+import optparse
+import transaction
+import ZODB
+from ZODB.MappingStorage import MappingStorage
+
+from Products.ConflictErrorLogger.patch import conflictLogger
+from Products.ConflictErrorLogger.patch import activate
+from Products.ConflictErrorLogger.monitor import LOCK_STRIPES
+from Products.ConflictErrorLogger.sampling import CAPTURE_ALL
+from Products.ConflictErrorLogger.sampling import CAPTURE_WATCHLIST
+from Products.ConflictErrorLogger.tests.base import TestBase, PCounter
+
+MODE_UNPATCHED = 'unpatched'
+MODE_WATCHLIST = 'watchlist'
+MODE_ACTIVE = 'active'
+MODES = (MODE_UNPATCHED, MODE_WATCHLIST, MODE_ACTIVE)
+THREADS = (1, 2, 4, 8, 16, 32)
+POOLS = (10, 1000, 100000)
+# Striped locks, and one global lock
+STRIPES = (LOCK_STRIPES, 1)
+DEBUG = (False, True)
+OBJECTS = 50
+ROUNDS = 20
+# A throughput lower by this ratio is a regression
+TOLERANCE = 0.1
+
+class Benchmark(TestBase):
+    """ The TestBase fixtures on a MappingStorage, with one list of counters
+    per thread and `pool` counters for the holder connection.
+    """
+
+    def __init__(self, threads, pool, objects=OBJECTS):
+        TestBase.__init__(self, 'measure')
+        self.threads = threads
+        self.pool = pool
+        self.objects = objects
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.storage = MappingStorage()
+        self.db = ZODB.DB(self.storage)
+        conn = self.db.open()
+        root = conn.root()
+        for t in range(self.threads):
+            root[t] = [PCounter() for i in range(self.objects)]
+        root['pool'] = [PCounter() for i in range(self.pool)]
+        transaction.commit()
+        conn.close()
+        # Kept open, its cache would slow down the connections of the
+        # workers
+        self.holder_tm = transaction.TransactionManager()
+        self.holder = self.db.open(transaction_manager=self.holder_tm)
+
+    def tearDown(self):
+        self.holder_tm.abort()
+        self.holder.close()
+        conflictLogger.config(self.logCE, LOCK_STRIPES=LOCK_STRIPES)
+        activate()
+        TestBase.tearDown(self)
+
+    def configure(self, mode, first_change_only, stripes=LOCK_STRIPES,
+                  debug=False):
+        """ Set the logger in the mode, with that many lock stripes and
+        the DEBUG messages written or not
+        """
+        self.holder_tm.abort()
+        if hasattr(self, 'logCE'):
+            for handler in list(self.logCE.handlers):
+                self.logCE.removeHandler(handler)
+                handler.close()
+        if mode == MODE_WATCHLIST:
+            capture_mode = CAPTURE_WATCHLIST
+        else:
+            capture_mode = CAPTURE_ALL
+        self.configureCE(CELogger_FIRST_CHANGE_ONLY=first_change_only,
+                         CELogger_ACTIVE=mode != MODE_UNPATCHED,
+                         CELogger_POOL_MAX_ENTRIES=0,
+                         CELogger_CAPTURE_MODE=capture_mode)
+        # Resets the pool
+        conflictLogger.config(self.logCE, LOCK_STRIPES=stripes)
+        # Without DEBUG nothing is written: the threads never change the
+        # same objects
+        if debug:
+            self.logCE.setLevel(logging.DEBUG)
+        else:
+            self.logCE.setLevel(logging.WARNING)
+        conflictLogger.stats.clear()
+        # The pool
+        for obj in self.holder.root()['pool']:
+            obj.inc()
+
+    def measure(self, threads, commit=False, rounds=ROUNDS):
+        """ Get the registers (or commits) per second of the threads
+        """
+        start = threading.Event()
+        counter = []
+        workers = [threading.Thread(target=self.worker,
+                                    args=(t, rounds, commit, start, counter))
+                   for t in range(threads)]
+        for w in workers:
+            w.start()
+        t0 = time.time()
+        start.set()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - t0
+        return sum(counter) / elapsed
+
+    def worker(self, t, rounds, commit, start, counter):
+        """ Change the counters of the thread `rounds` times, and commit or
+        abort each time
+        """
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        objs = conn.root()[t]
+        start.wait()
+        done = 0
+        for r in range(rounds):
+            for obj in objs:
+                obj.inc()
+            if commit:
+                tm.commit()
+                done += 1
+            else:
+                tm.abort()
+                done += len(objs)
+        counter.append(done)
+        conn.close()
+
+def configurations(modes, stripes, debug):
+    """ Get the (mode, first change only, lock stripes, debug) to measure
+    """
+    result = []
+    for first_change_only in (True, False):
+        for mode in modes:
+            if mode == MODE_UNPATCHED:
+                # No lock, no message
+                result.append((mode, first_change_only, LOCK_STRIPES, False))
+                continue
+            for n in stripes:
+                for d in debug:
+                    result.append((mode, first_change_only, n, d))
+    return result
+
+def run_suite(modes=MODES, threads=THREADS, pools=POOLS, rounds=ROUNDS,
+              stripes=STRIPES, debug=DEBUG, out=sys.stdout):
+    """ Run the benchmarks, get the results (list of dicts)
+    """
+    results = []
+    print >> out, "%9s %5s %7s %5s %7s %7s %12s %12s %9s" % (
+                  "mode", "first", "stripes", "debug", "threads", "pool",
+                  "registers/s", "commits/s", "us/reg")
+    for pool in pools:
+        bench = Benchmark(max(threads), pool)
+        bench.setUp()
+        try:
+            for mode, first_change_only, n_stripes, d in configurations(
+                    modes, stripes, debug):
+                bench.configure(mode, first_change_only, n_stripes, d)
+                for n in threads:
+                    # Load the objects
+                    bench.measure(n, rounds=1)
+                    registers = bench.measure(n, rounds=rounds)
+                    commits = bench.measure(n, commit=True, rounds=rounds)
+                    result = {
+                        'mode': mode,
+                        'first_change_only': first_change_only,
+                        'lock_stripes': n_stripes,
+                        'debug': d,
+                        'threads': n,
+                        'pool': pool,
+                        'registers_per_second': registers,
+                        'commits_per_second': commits,
+                        'register_us': 1e6 * n / registers,
+                    }
+                    results.append(result)
+                    print >> out, "%9s %5s %7d %5s %7d %7d %12.0f %12.0f " \
+                                  "%9.1f" % (
+                        mode, first_change_only, n_stripes, d, n, pool,
+                        registers, commits, result['register_us'])
+        finally:
+            bench.tearDown()
+    return results
+
+def make_report(results):
+    """ The results with what is needed to compare them
+    """
+    version = open(os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                'version.txt')).read().strip()
+    return {
+        'version': version,
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'time': time.time(),
+        'results': results,
+    }
+
+def result_key(result):
+    # The reports without lock stripes and debug measured the defaults
+    return (result['mode'], result['first_change_only'],
+            result.get('lock_stripes', LOCK_STRIPES),
+            result.get('debug', False), result['threads'], result['pool'])
+
+def compare(old, new, tolerance=TOLERANCE):
+    """ Get the (key, metric, old, new) of the throughputs lower than in the
+    old report
+    """
+    old_results = dict([(result_key(r), r) for r in old['results']])
+    regressions = []
+    for result in new['results']:
+        before = old_results.get(result_key(result))
+        if before is None:
+            continue
+        for metric in ('registers_per_second', 'commits_per_second'):
+            if result[metric] < before[metric] * (1 - tolerance):
+                regressions.append((result_key(result), metric,
+                                    before[metric], result[metric]))
+    return regressions
+
+def split_ints(value):
+    return tuple([int(v) for v in value.split(',')])
+
+def main(args=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-o', '--output', help="write the JSON report here")
+    parser.add_option('--compare', help="compare with this JSON report")
+    parser.add_option('--modes', default=",".join(MODES),
+                      help="comma separated (default: %default)")
+    parser.add_option('--threads', default=",".join(map(str, THREADS)),
+                      help="comma separated (default: %default)")
+    parser.add_option('--pools', default=",".join(map(str, POOLS)),
+                      help="comma separated (default: %default)")
+    parser.add_option('--stripes', default=",".join(map(str, STRIPES)),
+                      help="lock stripes, comma separated (default: "
+                           "%default)")
+    parser.add_option('--debug', default="off,on",
+                      help="DEBUG messages, comma separated (default: "
+                           "%default)")
+    parser.add_option('--rounds', type='int', default=ROUNDS)
+    options, args = parser.parse_args(args)
+
+    modes = options.modes.split(',')
+    for mode in modes:
+        if mode not in MODES:
+            parser.error("unknown mode %r" % mode)
+    debug = []
+    for value in options.debug.split(','):
+        if value not in ('off', 'on'):
+            parser.error("unknown debug value %r (off or on)" % value)
+        debug.append(value == 'on')
+    report = make_report(run_suite(modes, split_ints(options.threads),
+                                   split_ints(options.pools), options.rounds,
+                                   split_ints(options.stripes), debug))
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(report, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+    if options.compare:
+        f = open(options.compare)
+        try:
+            old = json.load(f)
+        finally:
+            f.close()
+        regressions = compare(old, report)
+        for key, metric, before, after in regressions:
+            print "REGRESSION %s %s: %.0f -> %.0f" % (key, metric, before,
+                                                      after)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import subprocess
+import tempfile
+import unittest
+from ZODB.utils import p64
+from Products.ConflictErrorLogger.stacks import StackTable, capture_stack
+from Products.ConflictErrorLogger.aggregator import Aggregator
+from Products.ConflictErrorLogger.aggregator import AGGREGATOR_RETENTION
+from Products.ConflictErrorLogger.aggregator import connect
+
+class testAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        path = os.path.join(self.testdir, 'aggregator.db')
+        self.overlaps = []
+        self.stack_table = StackTable()
+        # Two processes
+        self.agg_1 = Aggregator(path, self.stack_table, pid=1)
+        self.agg_2 = Aggregator(path, self.stack_table, pid=2,
+                                on_overlap=self.on_overlap)
+
+    def tearDown(self):
+        self.agg_1.close()
+        self.agg_2.close()
+        shutil.rmtree(self.testdir)
+
+    def on_overlap(self, oid, others):
+        self.overlaps.append((oid, others))
+
+    def change_here(self):
+        return self.stack_table.intern(capture_stack())
+
+    def purge(self, aggregator):
+        """ Purge the database after the retention
+        """
+        db = connect(aggregator.path)
+        try:
+            aggregator.purge(db, time.time() + AGGREGATOR_RETENTION + 1)
+            db.commit()
+        finally:
+            db.close()
+
+    def stack_pids(self):
+        db = connect(self.agg_1.path)
+        try:
+            return [pid for (pid,) in
+                    db.execute("SELECT pid FROM stacks").fetchall()]
+        finally:
+            db.close()
+
+    def test_CrossProcessOverlap(self):
+        oid = p64(42)
+        conn_1, conn_2 = 1, 2
+        self.agg_1.publish_register(oid, conn_1, self.change_here())
+        self.agg_1.flush()
+        self.agg_2.publish_register(oid, conn_2, None)
+        self.agg_2.publish_register(p64(43), conn_2, None)
+        self.agg_2.flush()
+        self.assertEqual(len(self.overlaps), 1)
+        self.assertEqual(self.overlaps[0][0], oid)
+        self.assertEqual([(pid, conn) for pid, conn, stamp
+                          in self.overlaps[0][1]], [(1, conn_1)])
+
+        # The transaction ended, the stack is kept for the conflict
+        self.agg_1.publish_end(conn_1)
+        self.agg_1.flush()
+        rows = self.agg_2.other_processes(oid)
+        self.assertEqual(len(rows), 1)
+        pid, conn, stamp, ended, stack = rows[0]
+        self.assertEqual(pid, 1)
+        self.assertTrue(ended)
+        self.assertTrue("in change_here" in stack)
+        self.assertEqual(self.agg_1.other_processes(oid)[0][4], None)
+
+    def test_PurgeIdleProcess(self):
+        oid = p64(42)
+        sig = self.change_here()
+        self.agg_1.publish_register(oid, 1, sig)
+        self.agg_1.publish_end(1)
+        self.agg_1.flush()
+        # The process 1 is idle meanwhile
+        self.purge(self.agg_2)
+        self.assertEqual(self.stack_pids(), [1])
+        # and changes the object again from the same code path
+        self.agg_1.publish_register(oid, 1, sig)
+        self.agg_1.flush()
+        rows = self.agg_2.other_processes(oid)
+        self.assertTrue("in change_here" in rows[0][4])
+
+        # A process removes its own stacks no more used, and publishes
+        # them again
+        self.agg_1.publish_end(1)
+        self.agg_1.flush()
+        self.purge(self.agg_1)
+        self.assertEqual(self.stack_pids(), [])
+        self.assertEqual(self.agg_1.published_sigs, set())
+        self.agg_1.publish_register(oid, 1, sig)
+        self.agg_1.flush()
+        rows = self.agg_2.other_processes(oid)
+        self.assertTrue("in change_here" in rows[0][4])
+
+    def test_PurgeDeadProcess(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        dead = Aggregator(self.agg_1.path, self.stack_table, pid=process.pid)
+        dead.publish_register(p64(42), 1, self.change_here())
+        dead.publish_end(1)
+        dead.close()
+        self.assertEqual(self.stack_pids(), [process.pid])
+        self.purge(self.agg_2)
+        self.assertEqual(self.stack_pids(), [])
+
+    def test_ReadError(self):
+        oid = p64(42)
+        self.agg_1.publish_register(oid, 1, None)
+        self.agg_1.flush()
+        path = self.agg_2.path
+        self.agg_2.path = os.path.join(self.testdir, 'not-a-database')
+        f = open(self.agg_2.path, 'w')
+        f.write('x' * 1024)
+        f.close()
+        self.assertEqual(self.agg_2.other_processes(oid), [])
+        self.assertEqual(self.agg_2.errors, 1)
+        # The next conflicts don't read (nor wait for) the database
+        self.agg_2.path = path
+        self.assertEqual(self.agg_2.other_processes(oid), [])
+        self.assertEqual(self.agg_2.errors, 1)
+        self.agg_2.skip_until = 0
+        self.assertEqual(len(self.agg_2.other_processes(oid)), 1)
+
+    def test_Batch(self):
+        conn_1, conn_2 = 1, 2
+        self.agg_1.publish_register(p64(42), conn_1, None)
+        self.agg_1.flush()
+        # Several registers in one item
+        self.agg_2.publish_registers([(p64(i), conn_2, None, 0)
+                                      for i in range(40, 45)])
+        self.agg_2.flush()
+        self.assertEqual([oid for oid, others in self.overlaps], [p64(42)])
+
+    def test_NeverWait(self):
+        self.agg_1.close()
+        self.agg_1.queue.maxsize = 2
+        for i in range(5):
+            self.agg_1.publish_register(p64(i), self, None)
+        self.assertEqual(self.agg_1.dropped, 3)
+
+def test_suite():
+    return unittest.TestSuite((
+         unittest.makeSuite(testAggregator),
+    ))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import gzip
+import json
+import unittest
+import subprocess
+from ZODB.POSException import ConflictError
+from Products.ConflictErrorLogger.tests.base import TestBase
+from Products.ConflictErrorLogger.patch import conflictLogger
+from Products.ConflictErrorLogger.dumper import LOG_FORMAT_TEXT
+from Products.ConflictErrorLogger.dumper import LOG_FORMAT_JSON
+from Products.ConflictErrorLogger.monitor import MSG_REPORT_REPEATED
+from Products.ConflictErrorLogger.monitor import EVENT_REPEATED
+from Products.ConflictErrorLogger.reporting import REPORT_WINDOW
+from Products.ConflictErrorLogger.analyzer import analyze_all, Analysis
+from Products.ConflictErrorLogger.analyzer import LogParser
+from Products.ConflictErrorLogger.reader import StackCache
+
+class testAnalyzer(TestBase):
+
+    def conflict(self):
+        # A request: its retry wastes 1.5 seconds
+        conflictLogger.notify_publish(None)
+        conflictLogger.attempts.start -= 1.5
+        self.conn_A.root()['p'].inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        self.tm_B.commit()
+        self.assertRaises(ConflictError, self.tm_A.commit)
+        self.tm_A.abort()
+        conflictLogger.notify_retry(None)
+        self.getLog()
+
+    def check(self, analysis, conflicts):
+        self.assertEqual(analysis.total_conflicts, conflicts)
+        self.assertEqual(analysis.total_overlaps, conflicts)
+        self.assertEqual(analysis.conflicts['oid'].most_common(),
+                         [(conflicts, '0x01')])
+        self.assertEqual(analysis.conflicts['class'].most_common(), [(
+            conflicts, 'Products.ConflictErrorLogger.tests.base.PCounter')])
+        # The line changing the object, in PCounter.inc
+        [(count, line)] = analysis.conflicts['line'].most_common()
+        self.assertTrue(line.endswith('(inc)'), line)
+        self.assertEqual(sum(analysis.rate.values()), conflicts)
+        self.assertEqual(analysis.retries, conflicts)
+        top_wasted = analysis.as_dict()['top_wasted']
+        [(per_hour, seconds, klass)] = top_wasted['class']
+        self.assertEqual(klass,
+                         'Products.ConflictErrorLogger.tests.base.PCounter')
+        self.assertTrue(1.5 * conflicts <= seconds < 1.6 * conflicts)
+        self.assertTrue("Top wasted seconds per hour by oid:" in
+                        analysis.report())
+
+    def test_TextLog(self):
+        self.configureCE()
+        self.conflict()
+        self.conflict()
+        # Rotated and gzipped
+        gzipped = self.logfile + '.1.gz'
+        f = gzip.open(gzipped, 'wb')
+        f.write(open(self.logfile).read())
+        f.close()
+        self.check(analyze_all([self.logfile]), 2)
+        self.check(analyze_all([self.logfile, gzipped], jobs=2), 4)
+
+    def test_JSONLog(self):
+        self.configureCE(CELogger_LOG_FORMAT=LOG_FORMAT_JSON)
+        self.conflict()
+        self.check(analyze_all([self.logfile]), 1)
+
+    def test_Repeated(self):
+        # The same conflict, reported once and then summarized
+        for log_format, summary in (
+                (LOG_FORMAT_TEXT, MSG_REPORT_REPEATED),
+                (LOG_FORMAT_JSON, '"event": "%s"' % EVENT_REPEATED)):
+            self.configureCE(CELogger_LOG_FORMAT=log_format)
+            for i in range(3):
+                self.conflict()
+            self.assertEqual(self.getLog().count(summary), 0)
+            conflictLogger.flush_reports()
+            # The overlap and the conflict
+            self.assertEqual(self.getLog().count(summary), 2)
+            self.check(analyze_all([self.logfile]), 3)
+            self.tearDown()
+            self.setUp()
+
+    def test_RepeatedExpired(self):
+        self.configureCE()
+        conflictLogger.config(self.logCE, REPORT_WINDOW=1)
+        try:
+            for i in range(3):
+                self.conflict()
+            # Nothing comes after the burst: the summaries are written when
+            # the window is over
+            deadline = time.time() + 5
+            while (self.getLog().count(MSG_REPORT_REPEATED) < 2 and
+                   time.time() < deadline):
+                time.sleep(0.1)
+            self.assertEqual(self.getLog().count(MSG_REPORT_REPEATED), 2)
+            self.check(analyze_all([self.logfile]), 3)
+        finally:
+            conflictLogger.config(self.logCE, REPORT_WINDOW=REPORT_WINDOW)
+
+    def test_RepeatedReset(self):
+        self.configureCE()
+        for i in range(3):
+            self.conflict()
+        # Reset by activate, config(LOCK_STRIPES=...)...: the summaries are
+        # written
+        conflictLogger.reset()
+        self.assertEqual(self.getLog().count(MSG_REPORT_REPEATED), 2)
+        self.check(analyze_all([self.logfile]), 3)
+
+    def test_NoPatching(self):
+        # The offline tools don't install the patches, nor start the
+        # listener or open the log of the settings
+        env = dict(os.environ, CELogger_METRICS_PORT='0',
+                   CELogger_LOGFILE=os.path.join(self.testdir, 'cli.log'))
+        script = ("import threading\n"
+                  "from Products.ConflictErrorLogger import analyzer, reader\n"
+                  "from ZODB.Connection import Connection\n"
+                  "print Connection.register.__name__, "
+                  "len(threading.enumerate())\n")
+        process = subprocess.Popen([sys.executable, '-c', script], env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        self.assertEqual((out, err), ("register 1\n", ""))
+        self.assertFalse(os.path.exists(env['CELogger_LOGFILE']))
+
+    def test_Rate(self):
+        analysis = Analysis(interval=60)
+        for minute in range(2000):
+            analysis.conflict(minute * 60.0)
+        self.assertTrue(len(analysis.rate) <= 1000)
+        self.assertEqual(analysis.interval, 120)
+        self.assertEqual(sum(analysis.rate.values()), 2000)
+
+    def test_Stacks(self):
+        parser = LogParser(Analysis())
+        parser.stack_lines = StackCache(10)
+        def stack(sig, lineno):
+            return json.dumps({'event': 'stack', 'pid': 1, 'sig': sig,
+                               'frames': [['/app/code.py', lineno, 'change']]})
+        def conflict(sig):
+            return json.dumps({'event': 'conflict', 'ts': 0, 'pid': 1,
+                               'others': [{'conn': 1,
+                                           'records': [['edit', 0, sig]]}]})
+        lines = [stack(0, 1)]
+        for sig in range(1, 100):
+            lines.append(stack(sig, 2))
+            # The stack of a hot code path is written once
+            lines.append(conflict(0))
+        parser.parse(lines)
+        self.assertEqual(len(parser.stack_lines), 10)
+        self.assertEqual(parser.analysis.conflicts['line'].most_common(),
+                         [(99, '/app/code.py:1 (change)')])
+
+def test_suite():
+    return unittest.TestSuite((
+         unittest.makeSuite(testAnalyzer),
+    ))
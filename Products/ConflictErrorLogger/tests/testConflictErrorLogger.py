@@ -1,15 +1,38 @@
 # -*- coding: utf-8 -*-
 
+import gc
+import time
+import logging
 import unittest
 import persistent
+from StringIO import StringIO
 import transaction
 from ZODB.POSException import ConflictError
 from Products.ConflictErrorLogger.tests.base import TestBase
+from Products.ConflictErrorLogger.tests.base import PCounter
 from Products.ConflictErrorLogger.monitor import MSG_OBJ_EDITING
 from Products.ConflictErrorLogger.monitor import MSG_OBJ_ALREADY_EDITED
 from Products.ConflictErrorLogger.monitor import MSG_OBJ_CONFLICT_DETECTED
 from Products.ConflictErrorLogger.monitor import MSG_OBJ_CONFLICT
+from Products.ConflictErrorLogger.monitor import MSG_OBJ_OVERLAP_ENDED
+from Products.ConflictErrorLogger.monitor import MSG_REQUEST_RETRIED
 from Products.ConflictErrorLogger.monitor import ConflictErrorPreview
+from Products.ConflictErrorLogger import monitor
+from Products.ConflictErrorLogger.stacks import STACK_TABLE_SIZE
+from Products.ConflictErrorLogger.stats import DURATION_OVERLAP
+from Products.ConflictErrorLogger.stats import DURATION_CONFLICT
+from Products.ConflictErrorLogger.sampling import CAPTURE_ADAPTIVE
+from Products.ConflictErrorLogger.sampling import CAPTURE_SAMPLE
+from Products.ConflictErrorLogger.sampling import CAPTURE_WATCHLIST
+from Products.ConflictErrorLogger.patch import conflictLogger
+from Products.ConflictErrorLogger.dumper import LOG_FORMAT_TEXT
+from Products.ConflictErrorLogger.dumper import LOG_FORMAT_JSON
+from Products.ConflictErrorLogger.reader import iter_events, StackResolver
+from Products.ConflictErrorLogger.patch import activate, is_active
+from Products.ConflictErrorLogger.patch import signalToggle, control_lock
+from ZODB.Connection import Connection
+from ZPublisher.HTTPRequest import HTTPRequest
+from ZPublisher.HTTPResponse import HTTPResponse
 
 class testConflictErrorLogger(TestBase):
 
@@ -38,6 +61,7 @@ class testConflictErrorLogger(TestBase):
         self.assertEqual(p_ConnB.value, 2)
         # Check if no information in the logs
         assert(MSG_OBJ_CONFLICT not in self.getLog())
+        assert(MSG_OBJ_CONFLICT_DETECTED not in self.getLog())
 
     def test_SimpleConflict(self):
         self.configureCE(
@@ -57,6 +81,7 @@ class testConflictErrorLogger(TestBase):
         # are changing the same object at the same time
         log = self.getLog()
         self.assertTrue(MSG_OBJ_ALREADY_EDITED in log)
+        self.assertTrue(MSG_OBJ_CONFLICT_DETECTED in log)
         # But there is no conflict yet 
         self.assertTrue(MSG_OBJ_CONFLICT not in log)
 
@@ -159,6 +184,446 @@ class testConflictErrorLogger(TestBase):
         # And also the origin of this conflict (source-code from traceback) 
         self.assertTrue("p_ConnA.inc()" in log)
 
+    def test_BareConflictError(self):
+        # Raised by the application to retry the request: no object, no oid
+        for log_format in (LOG_FORMAT_TEXT, LOG_FORMAT_JSON):
+            self.configureCE(CELogger_LOG_FORMAT=log_format)
+            self.conn_A.root()['p'].inc()
+            self.assertEqual(str(ConflictError()), "database conflict error")
+            self.assertEqual(str(ConflictError("msg")), "msg")
+            log = self.getLog()
+            if log_format == LOG_FORMAT_TEXT:
+                self.assertTrue("%s There is no traceback info." %
+                                MSG_OBJ_CONFLICT in log)
+            else:
+                self.assertTrue('"event": "conflict"' in log)
+            self.tm_A.abort()
+
+    def test_CollapsedStack(self):
+        self.configureCE()
+        p_ConnA = self.conn_A.root()['p']
+        p_ConnA.inc()
+        [entry] = conflictLogger.obj_pool[p_ConnA._p_oid][id(self.conn_A)]
+        stack = conflictLogger.stack_table.get(entry[2])
+        # The logger and ZODB frames closest to the change are dropped
+        self.assertEqual(stack[-1][0], PCounter.inc.im_func.func_code)
+
+    def test_StackOfPoolKept(self):
+        self.configureCE()
+        conflictLogger.config(self.logCE, STACK_TABLE_SIZE=10)
+        try:
+            # A rare code path
+            p_ConnA = self.conn_A.root()['p']
+            p_ConnA.inc()
+            # Then the table is filled by more used ones
+            code = PCounter.inc.im_func.func_code
+            for i in range(20):
+                for j in range(2):
+                    conflictLogger.stack_table.intern(((code, i),))
+            self.assertTrue(conflictLogger.stack_table.evicted >= 10)
+            self.tm_B.begin() #sync DB
+            self.conn_B.root()['p'].inc()
+            self.tm_B.commit()
+            self.assertRaises(ConflictError, self.tm_A.commit)
+            log = self.getLog()
+            self.assertTrue("p_ConnA.inc()" in log)
+            self.assertFalse("the stack was dropped" in log)
+        finally:
+            conflictLogger.config(self.logCE,
+                                  STACK_TABLE_SIZE=STACK_TABLE_SIZE)
+
+    def test_QueuedLog(self):
+        self.configureCE(CELogger_LOG_QUEUE_SIZE=100)
+        p_ConnA = self.conn_A.root()['p'] 
+        p_ConnA.inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        self.tm_B.commit()
+        self.assertRaises(ConflictError, self.tm_A.commit)
+
+        log = self.getLog()
+        self.assertTrue(MSG_OBJ_CONFLICT_DETECTED in log)
+        self.assertTrue(MSG_OBJ_CONFLICT in log)
+        self.assertTrue("p_ConnA.inc()" in log)
+
+    def test_PoolClearedOnTransactionEnd(self):
+        self.configureCE(
+                    CELogger_FIRST_CHANGE_ONLY=True,
+                    CELogger_RAISE_CONFLICTERRORPREVIEW=False,
+                    CELogger_ACTIVE=True)
+        p_ConnA = self.conn_A.root()['p'] 
+        p_ConnA.inc()
+        self.tm_B.begin() #sync DB
+        p_ConnB = self.conn_B.root()['p'] 
+        p_ConnB.inc()
+        poid = p_ConnA._p_oid
+        self.assertEqual(len(conflictLogger.obj_pool[poid]), 2)
+
+        # The commit removes just the entries of its connection
+        self.tm_A.commit()
+        self.assertEqual(conflictLogger.obj_pool[poid].keys(),
+                         [id(self.conn_B)])
+        self.assertTrue(id(self.conn_A) not in conflictLogger.conn_index)
+
+        # And also the abort
+        self.tm_B.abort()
+        self.assertTrue(poid not in conflictLogger.obj_pool)
+        self.assertTrue(id(self.conn_B) not in conflictLogger.conn_index)
+
+    def test_PoolBudget(self):
+        self.configureCE(CELogger_POOL_MAX_ENTRIES=2)
+        root_A = self.conn_A.root()
+        root_A['counters'] = counters = [PCounter() for i in range(5)]
+        self.tm_A.commit()
+
+        for counter in counters:
+            counter.inc()
+        # Just the 2 last changed objects are kept
+        self.assertEqual(conflictLogger.pool_size()[0], 2)
+        self.assertEqual(conflictLogger.evicted['entries'], 3)
+        self.assertTrue(counters[-1]._p_oid in conflictLogger.obj_pool)
+        self.assertTrue(counters[0]._p_oid not in conflictLogger.obj_pool)
+
+        # But the changes are still detected
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['counters'][0].inc()
+        self.assertTrue(MSG_OBJ_CONFLICT_DETECTED in self.getLog())
+
+        self.tm_A.abort()
+        self.tm_B.abort()
+        self.assertEqual(conflictLogger.pool_size(), (0, 0))
+
+    def test_AdaptiveCapture(self):
+        self.configureCE(CELogger_CAPTURE_MODE=CAPTURE_ADAPTIVE,
+                         CELogger_CAPTURE_SAMPLE_RATE=1000000)
+        # The stack of A is not sampled
+        p_ConnA = self.conn_A.root()['p'] 
+        p_ConnA.inc()
+        self.tm_B.begin() #sync DB
+        p_ConnB = self.conn_B.root()['p'] 
+        p_ConnB.inc()
+        # But the overlap is detected, and the object is now hot
+        log = self.getLog()
+        self.assertTrue(MSG_OBJ_CONFLICT_DETECTED in log)
+        self.tm_B.commit()
+        self.assertRaises(ConflictError, self.tm_A.commit)
+        log = self.getLog(continue_from_here=log)
+        self.assertTrue(MSG_OBJ_CONFLICT in log)
+        self.assertTrue("p_ConnA.inc()" not in log)
+        self.tm_A.abort()
+
+        # The next changes of the hot object capture the stack
+        p_ConnA = self.conn_A.root()['p'] 
+        p_ConnA.inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        self.tm_B.commit()
+        self.assertRaises(ConflictError, self.tm_A.commit)
+        log = self.getLog(continue_from_here=log)
+        self.assertTrue("p_ConnA.inc()" in log)
+
+    def test_WatchlistFastPath(self):
+        self.configureCE(CELogger_CAPTURE_MODE=CAPTURE_WATCHLIST)
+        p_ConnA = self.conn_A.root()['p'] 
+        p_ConnA.inc()
+        # Not watched: the change is just indexed
+        poid = p_ConnA._p_oid
+        self.assertEqual(conflictLogger.dirty_index[poid].keys(),
+                         [id(self.conn_A)])
+        self.assertTrue(poid not in conflictLogger.obj_pool)
+
+        # The overlap is still detected, and the object is now watched
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        self.assertTrue(MSG_OBJ_CONFLICT_DETECTED in self.getLog())
+        self.assertTrue(conflictLogger.sampler.watchlist.watched(poid))
+        self.tm_A.abort()
+        self.tm_B.abort()
+
+        self.conn_A.root()['p'].inc()
+        self.assertTrue(poid in conflictLogger.obj_pool)
+
+    def test_Deactivate(self):
+        self.configureCE(CELogger_ACTIVE=False)
+        # The original methods are back
+        self.assertFalse(hasattr(Connection, 'ORIG_register'))
+        self.assertFalse(hasattr(ConflictError, '__ORIG_init__'))
+        self.assertFalse(hasattr(HTTPRequest, 'ORIG_retry'))
+        self.conn_A.root()['p'].inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        self.tm_B.commit()
+        self.assertRaises(ConflictError, self.tm_A.commit)
+        self.tm_A.abort()
+        self.assertEqual(conflictLogger.obj_pool, {})
+        self.assertTrue(MSG_OBJ_CONFLICT not in self.getLog())
+
+        # Reactivated, the patches are installed once
+        activate()
+        activate()
+        self.assertEqual(Connection.ORIG_register.im_func.__name__, 'register')
+        self.conn_A.root()['p'].inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        self.assertTrue(MSG_OBJ_CONFLICT_DETECTED in self.getLog())
+        self.tm_B.commit()
+        self.assertRaises(ConflictError, self.tm_A.commit)
+        self.assertTrue(MSG_OBJ_CONFLICT in self.getLog())
+
+    def test_SignalToggle(self):
+        self.configureCE()
+        # The signal comes while the main thread holds the lock
+        control_lock.acquire()
+        try:
+            signalToggle()
+            self.assertTrue(is_active())
+        finally:
+            control_lock.release()
+        deadline = time.time() + 5
+        while is_active() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(is_active())
+
+    def test_JSONLog(self):
+        self.configureCE(CELogger_LOG_FORMAT=LOG_FORMAT_JSON)
+        p_ConnA = self.conn_A.root()['p']
+        p_ConnA.inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        self.tm_B.commit()
+        self.assertRaises(ConflictError, self.tm_A.commit)
+        self.getLog()
+
+        oid = p_ConnA._p_oid
+        kinds = [e['event'] for e in iter_events(self.logfile, oids=[oid])
+                 if e['event'] != 'stack']
+        self.assertEqual(kinds.count('overlap'), 1)
+        self.assertEqual(kinds.count('conflict'), 1)
+        self.assertEqual(list(iter_events(self.logfile, events=['edit'],
+                                          since=2 ** 31)), [])
+
+        resolver = StackResolver()
+        conflicts = [e for e in resolver.resolve(iter_events(self.logfile))
+                     if e['event'] == 'conflict']
+        self.assertEqual(len(conflicts), 1)
+        conflict = conflicts[0]
+        self.assertEqual(conflict['class'],
+                         'Products.ConflictErrorLogger.tests.base.PCounter')
+        self.assertEqual(conflict['others'][0]['conn'], id(self.conn_A))
+        self.assertTrue("in test_JSONLog" in resolver.format(conflict))
+
+    def test_Stats(self):
+        self.configureCE()
+        conflictLogger.stats.clear()
+        self.conn_A.root()['p'].inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        self.tm_B.commit()
+        self.assertRaises(ConflictError, self.tm_A.commit)
+
+        stats = conflictLogger.stats
+        klass = 'Products.ConflictErrorLogger.tests.base.PCounter'
+        self.assertEqual(stats.top('registers', 'class'), [(2, klass)])
+        self.assertEqual(stats.top('overlaps', 'class'), [(1, klass)])
+        self.assertEqual(stats.top('conflicts', 'class'), [(1, klass)])
+        self.assertEqual(stats.top('conflicts', 'oid'), [(1, '0x01')])
+        # The conflict is counted on the code path that changed the object
+        self.assertEqual(len(stats.top('conflicts', 'sig')), 1)
+
+    def test_RepeatedRegister(self):
+        self.configureCE()
+        p_ConnA = self.conn_A.root()['p']
+        p_ConnA.inc()
+        poid = p_ConnA._p_oid
+        acquired = []
+        get_lock = conflictLogger.locks.get
+        def get(oid):
+            acquired.append(oid)
+            return get_lock(oid)
+        conflictLogger.locks.get = get
+        try:
+            # Changed again after a savepoint: registered again, but the
+            # connection already knows it changes the object
+            self.tm_A.savepoint()
+            p_ConnA.inc()
+        finally:
+            del conflictLogger.locks.get
+        self.assertEqual(acquired, [])
+        self.assertEqual(len(conflictLogger.obj_pool[poid][id(self.conn_A)]),
+                         1)
+        self.tm_A.commit()
+        self.assertTrue(poid not in conflictLogger.obj_pool)
+
+    def test_RepeatedRegisterOverlap(self):
+        self.configureCE(CELogger_RAISE_CONFLICTERRORPREVIEW=True)
+        p_ConnA = self.conn_A.root()['p']
+        p_ConnA.inc()
+        self.tm_B.begin() #sync DB
+        self.assertRaises(ConflictErrorPreview, self.conn_B.root()['p'].inc)
+        # Changed again by A after a savepoint: B still changes it
+        self.tm_A.savepoint()
+        log = self.getLog()
+        self.assertRaises(ConflictErrorPreview, p_ConnA.inc)
+        log = self.getLog(continue_from_here=log)
+        self.assertTrue(MSG_OBJ_CONFLICT_DETECTED in log)
+
+    def test_RepeatedRegisterSampled(self):
+        self.configureCE(CELogger_CAPTURE_MODE=CAPTURE_SAMPLE,
+                         CELogger_CAPTURE_SAMPLE_RATE=2)
+        p_ConnA = self.conn_A.root()['p']
+        for i in range(4):
+            p_ConnA.inc()
+            self.tm_A.savepoint()
+        # The stack of a later change fills in the missing one
+        [entry] = conflictLogger.obj_pool[p_ConnA._p_oid][id(self.conn_A)]
+        self.assertNotEqual(entry[2], None)
+
+    def test_ContentionTiming(self):
+        self.configureCE()
+        conflictLogger.stats.clear()
+        self.conn_A.root()['p'].inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        poid = self.conn_B.root()['p']._p_oid
+        log = self.getLog()
+        self.assertTrue("changed by another connection" in log)
+        self.assertEqual(conflictLogger.overlaps[poid][2], None)
+
+        # The overlap ends with the commit of B
+        self.tm_B.commit()
+        log = self.getLog(continue_from_here=log)
+        self.assertTrue(MSG_OBJ_OVERLAP_ENDED in log)
+        self.assertRaises(ConflictError, self.tm_A.commit)
+        log = self.getLog(continue_from_here=log)
+        self.assertTrue("overlap: " in log)
+        self.assertTrue("transaction running for " in log)
+        self.tm_A.abort()
+        self.assertTrue(poid not in conflictLogger.overlaps)
+
+        klass = 'Products.ConflictErrorLogger.tests.base.PCounter'
+        durations = conflictLogger.stats.durations
+        self.assertEqual(durations[(DURATION_OVERLAP, klass)][-2], 1)
+        self.assertEqual(durations[(DURATION_CONFLICT, klass)][-2], 1)
+        self.assertTrue("time-to-conflict durations:\n    class %s: 1" %
+                        klass in conflictLogger.stats.report())
+
+    def test_RetryCost(self):
+        self.configureCE()
+        conflictLogger.stats.clear()
+        environ = {'SERVER_NAME': 'nohost', 'SERVER_PORT': '80',
+                   'REQUEST_METHOD': 'GET'}
+        request = HTTPRequest(StringIO(), environ, HTTPResponse())
+        # What the patched ZPublisher.Publish.publish does
+        conflictLogger.notify_publish(request)
+        conflictLogger.attempts.start -= 2
+        self.conn_A.root()['p'].inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        self.tm_B.commit()
+        self.assertRaises(ConflictError, self.tm_A.commit)
+        self.tm_A.abort()
+
+        request.retry()
+        log = self.getLog()
+        self.assertTrue(MSG_REQUEST_RETRIED in log)
+        self.assertTrue("retry: 1, wasted: 2." in log)
+        stats = conflictLogger.stats
+        self.assertEqual(stats.retries, 1)
+        per_hour, wall, cpu, klass = stats.wasted_top('class')[0]
+        self.assertEqual(klass,
+                         'Products.ConflictErrorLogger.tests.base.PCounter')
+        self.assertTrue(2 <= wall < 3)
+        self.assertTrue(per_hour > wall)
+        self.assertEqual(stats.wasted_top('oid')[0][3], '0x01')
+        # The code path that changed the object first
+        self.assertEqual(len(stats.wasted_top('sig')), 1)
+
+        # Retried for another reason: nothing is counted
+        conflictLogger.notify_publish(request)
+        request.retry()
+        self.assertEqual(stats.retries, 1)
+
+    def test_RetryCostWithoutCPU(self):
+        # Outside Linux the CPU time of a thread is not available
+        thread_cpu = monitor.thread_cpu
+        monitor.thread_cpu = lambda: None
+        try:
+            self.configureCE()
+            conflictLogger.stats.clear()
+            environ = {'SERVER_NAME': 'nohost', 'SERVER_PORT': '80',
+                       'REQUEST_METHOD': 'GET'}
+            request = HTTPRequest(StringIO(), environ, HTTPResponse())
+            conflictLogger.notify_publish(request)
+            self.conn_A.root()['p'].inc()
+            self.tm_B.begin() #sync DB
+            self.conn_B.root()['p'].inc()
+            self.tm_B.commit()
+            self.assertRaises(ConflictError, self.tm_A.commit)
+            self.tm_A.abort()
+            request.retry()
+        finally:
+            monitor.thread_cpu = thread_cpu
+        self.assertTrue(", CPU: n/a)" in self.getLog())
+        stats = conflictLogger.stats
+        self.assertEqual(stats.retries, 1)
+        self.assertEqual(stats.wasted_cpu, 0.0)
+        self.assertTrue("(CPU n/a)" in stats.report())
+
+    def test_Filters(self):
+        self.configureCE()
+        conflictLogger.config(self.logCE,
+                              FILTERS="-Products.ConflictErrorLogger.*")
+        self.addCleanup(conflictLogger.config, self.logCE, FILTERS='')
+        self.conn_A.root()['p'].inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        # Not logged, not indexed
+        self.assertEqual(conflictLogger.dirty_index, {})
+        self.assertTrue(MSG_OBJ_CONFLICT_DETECTED not in self.getLog())
+        self.tm_B.commit()
+        # The ConflictError still is
+        self.assertRaises(ConflictError, self.tm_A.commit)
+        self.assertTrue("%s There is no traceback info." % MSG_OBJ_CONFLICT
+                        in self.getLog())
+
+    def test_PartialConfig(self):
+        self.configureCE(CELogger_FIRST_CHANGE_ONLY=False,
+                         CELogger_RAISE_CONFLICTERRORPREVIEW=True)
+        # The options not passed are left as they are
+        conflictLogger.config(self.logCE, METRICS=True)
+        self.addCleanup(conflictLogger.config, self.logCE, METRICS=False)
+        self.assertEqual(conflictLogger.FIRST_CHANGE_ONLY, False)
+        self.assertEqual(conflictLogger.RAISE_CONFLICTERRORPREVIEW, True)
+
+    def test_CollectedConnections(self):
+        self.configureCE(CELogger_POOL_MAX_ENTRIES=0)
+        self.logCE.setLevel(logging.ERROR)
+        self.db.setPoolSize(10000)
+        root = self.conn_A.root()
+        root['counters'] = [PCounter() for i in range(10)]
+        self.tm_A.commit()
+        gc.collect()
+        connections = len([o for o in gc.get_objects()
+                           if isinstance(o, Connection)])
+        # Connections dropped in the middle of a transaction
+        for i in range(2000):
+            tm = transaction.TransactionManager()
+            conn = self.db.open(transaction_manager=tm)
+            for counter in conn.root()['counters']:
+                counter.inc()
+        del tm, conn, counter
+        gc.collect()
+        # Forgotten before the next register
+        self.conn_A.root()['p'].inc()
+        self.assertEqual(conflictLogger.conn_index.keys(), [id(self.conn_A)])
+        self.assertEqual(conflictLogger.dirty_index.keys(),
+                         [self.conn_A.root()['p']._p_oid])
+        self.assertEqual(conflictLogger.pool_size()[0], 1)
+        self.assertEqual(len(conflictLogger.conn_refs), 1)
+        self.assertEqual(conflictLogger.evicted['collected'], 2000 * 10)
+        self.assertEqual(len([o for o in gc.get_objects()
+                              if isinstance(o, Connection)]), connections)
+
 def test_suite():
     return unittest.TestSuite((
          unittest.makeSuite(testConflictErrorLogger),
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import gzip
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+from Products.ConflictErrorLogger.dumper import QueueHandler
+from Products.ConflictErrorLogger.dumper import RotatingFileHandler
+from Products.ConflictErrorLogger.dumper import OVERFLOW_DROP_OLDEST
+from Products.ConflictErrorLogger.dumper import OVERFLOW_DROP_NEW
+
+class ListHandler(logging.Handler):
+    """ Keep the messages, the writes wait for `gate`.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.gate = threading.Event()
+        self.reopened = 0
+
+    def emit(self, record):
+        self.gate.wait()
+        self.messages.append(record.getMessage())
+
+    def reopen(self):
+        self.reopened += 1
+
+class testQueueHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.target = ListHandler()
+        self.log = logging.getLogger("CELogger.testDumper")
+        self.log.propagate = False
+
+    def tearDown(self):
+        self.target.gate.set()
+        self.log.removeHandler(self.handler)
+        self.handler.close()
+
+    def fill(self, overflow):
+        self.handler = QueueHandler(self.target, 3, overflow)
+        self.log.addHandler(self.handler)
+        # The writer takes the first record and waits
+        self.log.warning("first")
+        while not self.handler.queue.empty():
+            time.sleep(0.01)
+        for i in range(5):
+            self.log.warning("msg %s", i)
+        self.target.gate.set()
+        self.handler.flush()
+
+    def test_DropOldest(self):
+        self.fill(OVERFLOW_DROP_OLDEST)
+        self.assertEqual(self.target.messages,
+                         ["first", "msg 2", "msg 3", "msg 4"])
+        self.assertEqual(self.handler.dropped, 2)
+
+    def test_DropNew(self):
+        self.fill(OVERFLOW_DROP_NEW)
+        self.assertEqual(self.target.messages,
+                         ["first", "msg 0", "msg 1", "msg 2"])
+        self.assertEqual(self.handler.dropped, 2)
+
+    def test_CloseAndReopen(self):
+        self.handler = QueueHandler(self.target, 100)
+        self.log.addHandler(self.handler)
+        self.target.gate.set()
+        self.handler.reopen()
+        self.assertEqual(self.target.reopened, 1)
+        for i in range(10):
+            self.log.warning("msg %s", i)
+        # Closing writes what is queued
+        self.handler.close()
+        self.assertEqual(len(self.target.messages), 10)
+        self.assertFalse(self.handler.writer.isAlive())
+
+class testRotatingFileHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.testdir, 'conflict.log')
+        self.log = logging.getLogger("CELogger.testDumper")
+        self.log.propagate = False
+        self.handlers = []
+
+    def tearDown(self):
+        for handler in self.handlers:
+            self.log.removeHandler(handler)
+            handler.close()
+        shutil.rmtree(self.testdir)
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+        self.log.addHandler(handler)
+        return handler
+
+    def rotated(self, handler):
+        handler.compressor.queue.join()
+        return handler.compressor.rotated()
+
+    def test_MaxBytes(self):
+        handler = self.add_handler(RotatingFileHandler(self.logfile,
+                                                       max_bytes=100,
+                                                       backups=3))
+        for i in range(50):
+            # 10 bytes each
+            self.log.warning("message%02d", i)
+        rotated = self.rotated(handler)
+        # The oldest ones are removed
+        self.assertEqual(len(rotated), 3)
+        self.assertTrue(os.path.getsize(self.logfile) <= 100)
+        for path in rotated:
+            self.assertTrue(path.endswith('.gz'))
+            text = gzip.open(path).read()
+            self.assertEqual(len(text), 100)
+        self.assertTrue(gzip.open(rotated[-1]).read().endswith(
+                        "message39\n"))
+        self.assertEqual(open(self.logfile).read(),
+                         "".join(["message%02d\n" % i
+                                  for i in range(40, 50)]))
+
+    def test_Interval(self):
+        handler = self.add_handler(RotatingFileHandler(self.logfile,
+                                                       interval=3600,
+                                                       compress=False))
+        self.log.warning("before")
+        handler.rollover_at = time.time()
+        self.log.warning("after")
+        [path] = self.rotated(handler)
+        self.assertEqual(open(path).read(), "before\n")
+        self.assertEqual(open(self.logfile).read(), "after\n")
+        self.assertTrue(handler.rollover_at > time.time())
+
+    def test_Queued(self):
+        target = RotatingFileHandler(self.logfile, max_bytes=100, backups=0)
+        handler = self.add_handler(QueueHandler(target, 1000))
+        for i in range(50):
+            self.log.warning("message%02d", i)
+        handler.flush()
+        rotated = self.rotated(target)
+        # Rotated between the batches
+        self.assertTrue(rotated)
+        text = "".join([gzip.open(path).read() for path in rotated])
+        text += open(self.logfile).read()
+        self.assertEqual(text, "".join(["message%02d\n" % i
+                                        for i in range(50)]))
+
+    def test_Reopen(self):
+        handler = self.add_handler(RotatingFileHandler(self.logfile,
+                                                       max_bytes=100))
+        self.log.warning("message00")
+        # Rotated by another tool
+        os.rename(self.logfile, self.logfile + '.1')
+        handler.reopen()
+        self.assertEqual(handler.written, 0)
+        self.log.warning("message01")
+        self.assertEqual(open(self.logfile).read(), "message01\n")
+
+def test_suite():
+    return unittest.TestSuite((
+         unittest.makeSuite(testQueueHandler),
+         unittest.makeSuite(testRotatingFileHandler),
+    ))
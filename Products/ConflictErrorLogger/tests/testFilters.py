@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from ZODB.utils import p64
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBucket, OOBTree
+from persistent.mapping import PersistentMapping
+from Products.ConflictErrorLogger.filters import Filter
+from Products.ConflictErrorLogger.tests.base import PCounter
+
+class testFilter(unittest.TestCase):
+
+    def test_Rules(self):
+        rules = Filter("+BTrees.OOBTree.OOBucket, -_p_resolveConflict "
+                       "-Products.ConflictErrorLogger.*")
+        self.assertTrue(rules.included(p64(1), OOBucket))
+        self.assertFalse(rules.included(p64(1), OOBTree))
+        self.assertFalse(rules.included(p64(1), Length))
+        self.assertFalse(rules.included(p64(1), PCounter))
+        self.assertTrue(rules.included(p64(1), PersistentMapping))
+        # Decided once per class
+        self.assertEqual(rules.decisions[OOBTree], False)
+
+    def test_Oids(self):
+        rules = Filter(["+0x01", "-0x01", "-BTrees.Length.Length"])
+        self.assertTrue(rules.included(p64(1), Length))
+        self.assertFalse(rules.included(p64(2), Length))
+
+    def test_Invalid(self):
+        self.assertRaises(ValueError, Filter, "BTrees.Length.Length")
+        self.assertRaises(ValueError, Filter, "-0xzz")
+
+def test_suite():
+    return unittest.TestSuite((
+         unittest.makeSuite(testFilter),
+    ))
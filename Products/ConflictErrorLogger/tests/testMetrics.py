@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+from ZODB.POSException import ConflictError
+from Products.ConflictErrorLogger.patch import conflictLogger
+from Products.ConflictErrorLogger.metrics import Metrics, render
+from Products.ConflictErrorLogger.metrics import REGISTERS, CONFLICTS
+from Products.ConflictErrorLogger.tests.base import TestBase
+
+class testMetrics(unittest.TestCase):
+
+    def test_Shards(self):
+        metrics = Metrics()
+        def work():
+            for i in range(1000):
+                metrics.inc(CONFLICTS)
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(metrics.values()[CONFLICTS], 4000)
+
+    def test_Histogram(self):
+        metrics = Metrics(buckets=(0.001, 0.01))
+        metrics.observe_register(0.0005)
+        metrics.observe_register(0.005)
+        metrics.observe_register(1)
+        values = metrics.values()
+        self.assertEqual(values[REGISTERS], 3)
+        self.assertEqual(values[metrics.first_bucket:metrics.sum_index],
+                         [1, 1, 1])
+
+class testRender(TestBase):
+
+    def test_Conflict(self):
+        self.configureCE()
+        conflictLogger.stats.clear()
+        conflictLogger.config(self.logCE, METRICS=True)
+        self.addCleanup(conflictLogger.config, self.logCE, METRICS=False)
+        self.conn_A.root()['p'].inc()
+        self.tm_B.begin() #sync DB
+        self.conn_B.root()['p'].inc()
+        self.tm_B.commit()
+        self.assertRaises(ConflictError, self.tm_A.commit)
+
+        text = render(conflictLogger).splitlines()
+        self.assertTrue('celogger_active 1' in text)
+        self.assertTrue('celogger_registers_total 2' in text)
+        self.assertTrue('celogger_overlaps_total 1' in text)
+        self.assertTrue('celogger_conflicts_total 1' in text)
+        self.assertTrue('celogger_register_seconds_bucket{le="+Inf"} 2'
+                        in text)
+        self.assertTrue('celogger_register_seconds_count 2' in text)
+        self.assertTrue('celogger_log_queue_depth 0' in text)
+        klass = 'Products.ConflictErrorLogger.tests.base.PCounter'
+        self.assertTrue('celogger_time_to_conflict_seconds_count{class="%s"} '
+                        '1' % klass in text)
+
+    def test_Disabled(self):
+        self.configureCE()
+        self.assertEqual(conflictLogger.metrics, None)
+        text = render(conflictLogger, False)
+        self.assertTrue('celogger_active 0' in text.splitlines())
+        self.assertFalse('celogger_registers_total' in text)
+
+def test_suite():
+    return unittest.TestSuite((
+         unittest.makeSuite(testMetrics),
+         unittest.makeSuite(testRender),
+    ))
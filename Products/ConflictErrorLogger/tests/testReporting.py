@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from Products.ConflictErrorLogger.reporting import Deduplicator
+
+class testDeduplicator(unittest.TestCase):
+
+    def test_Window(self):
+        reports = Deduplicator(window=60)
+        self.assertEqual(reports.check('a', now=1000), (True, []))
+        for i in range(5):
+            self.assertEqual(reports.check('a', now=1001 + i), (False, []))
+        self.assertEqual(reports.check('b', now=1010), (True, []))
+        # The next window starts with a report, and the summary of the
+        # previous one
+        self.assertEqual(reports.check('a', now=1070),
+                         (True, [('a', 5, 70)]))
+
+    def test_Sweep(self):
+        reports = Deduplicator(window=60)
+        reports.next_sweep = 1060
+        reports.check('a', now=1000)
+        reports.check('a', now=1001)
+        reports.check('b', now=1050)
+        # The windows over are summarized by any report
+        self.assertEqual(reports.check('c', now=1061),
+                         (True, [('a', 1, 61)]))
+        self.assertEqual(sorted(reports.keys), ['b', 'c'])
+
+    def test_Expire(self):
+        reports = Deduplicator(window=60)
+        reports.next_sweep = 1060
+        reports.check('a', now=1000)
+        reports.check('a', now=1001)
+        # No report comes after the burst
+        self.assertEqual(reports.expire(now=1059), [])
+        self.assertEqual(reports.expire(now=1061), [('a', 1, 61)])
+        self.assertEqual(reports.keys, {})
+        self.assertEqual(reports.next_sweep, 1121)
+
+    def test_Size(self):
+        reports = Deduplicator(window=60, size=10)
+        reports.check(0, now=1000)
+        reports.check(0, now=1000)
+        summaries = []
+        for key in range(1, 20):
+            summaries.extend(reports.check(key, now=1000 + key)[1])
+        self.assertEqual(len(reports.keys), 10)
+        # The oldest key is summarized when it makes room
+        self.assertEqual(summaries, [(0, 1, 10)])
+        self.assertEqual(reports.check(0, now=1030), (True, []))
+
+    def test_Flush(self):
+        reports = Deduplicator(window=60)
+        reports.check('a', now=1000)
+        reports.check('a', now=1001)
+        reports.check('b', now=1002)
+        self.assertEqual(reports.flush(now=1030), [('a', 1, 30)])
+        self.assertEqual(reports.keys, {})
+
+def test_suite():
+    return unittest.TestSuite((
+         unittest.makeSuite(testDeduplicator),
+    ))
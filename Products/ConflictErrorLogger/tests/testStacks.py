@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from Products.ConflictErrorLogger.stacks import capture_stack
+from Products.ConflictErrorLogger.stacks import format_stack
+from Products.ConflictErrorLogger.stacks import StackTable
+from Products.ConflictErrorLogger.stacks import FrameFilter
+from Products.ConflictErrorLogger.stacks import COLLAPSED, TRUNCATED
+
+def change_here():
+    return capture_stack()
+
+def nested(n, frame_filter):
+    if n:
+        return nested(n - 1, frame_filter)
+    return capture_stack(0, frame_filter)
+
+class testStacks(unittest.TestCase):
+
+    def test_FormatStack(self):
+        stack = change_here()
+        text = format_stack(stack)
+        self.assertTrue(text.endswith("    return capture_stack()\n"))
+        self.assertTrue("stack = change_here()" in text)
+
+    def test_Intern(self):
+        table = StackTable()
+        stacks = [change_here() for i in range(3)]
+        sigs = [table.intern(stack) for stack in stacks]
+        # The same code path has one signature
+        self.assertEqual(len(set(sigs)), 1)
+        self.assertEqual(table.hits(sigs[0]), 3)
+        self.assertEqual(table.get(sigs[0]), stacks[0])
+        self.assertNotEqual(table.intern(capture_stack()), sigs[0])
+        self.assertEqual(table.top(1), [(3, sigs[0], stacks[0])])
+
+    def test_Evict(self):
+        table = StackTable(size=10)
+        for i in range(2):
+            hot = table.intern(change_here())
+        for i in range(20):
+            # A distinct stack per lineno
+            table.intern(((test_Evict_code, i),))
+        self.assertTrue(len(table.signatures) <= 10)
+        self.assertTrue(table.evicted >= 10)
+        # The most used signature is kept
+        self.assertEqual(table.hits(hot), 2)
+
+    def test_EvictReferenced(self):
+        referenced = set()
+        table = StackTable(size=10, referenced=lambda: referenced)
+        # A rare code path, still in the pool
+        stack = change_here()
+        rare = table.intern(stack)
+        referenced.add(rare)
+        for i in range(20):
+            for j in range(2):
+                table.intern(((test_Evict_code, i),))
+        self.assertTrue(table.evicted >= 10)
+        self.assertEqual(table.hits(rare), 1)
+        self.assertEqual(table.get(rare), stack)
+
+    def test_MaxDepth(self):
+        stack = nested(20, FrameFilter(max_depth=5, collapse=()))
+        # The 5 innermost frames, and the mark of the others
+        self.assertEqual(len(stack), 6)
+        self.assertEqual(stack[0], (TRUNCATED, 0))
+        for code, lineno in stack[1:]:
+            self.assertEqual(code, nested.func_code)
+        text = format_stack(stack)
+        self.assertTrue(text.startswith("  ... outer frames not captured\n"))
+        self.assertTrue(text.endswith("    return capture_stack(0, "
+                                      "frame_filter)\n"))
+
+    def test_Collapse(self):
+        full = nested(3, None)
+        # The frames closest to the change are dropped
+        frame_filter = FrameFilter(collapse=[__name__])
+        stack = nested(3, frame_filter)
+        self.assertTrue(len(stack) < len(full))
+        self.assertTrue(nested.func_code not in [c for c, l in stack])
+        self.assertEqual(frame_filter.codes[nested.func_code], True)
+
+        # The other ones are collapsed
+        frame_filter = FrameFilter(collapse=['unittest'])
+        stack = nested(3, frame_filter)
+        self.assertEqual(stack[-1][0], nested.func_code)
+        collapsed = [l for c, l in stack if c is COLLAPSED]
+        self.assertTrue(collapsed)
+        self.assertTrue("  ... %d frames collapsed\n" % collapsed[0] in
+                        format_stack(stack))
+        self.assertTrue(unittest.TestCase.run.func_code not in
+                        [c for c, l in stack])
+        # The same code path has the same stack
+        stacks = [nested(3, frame_filter) for i in range(2)]
+        self.assertEqual(stacks[0], stacks[1])
+
+        # A prefix matches the module and its submodules only
+        frame_filter = FrameFilter(collapse="Products.ConflictErrorLogger")
+        self.assertEqual(frame_filter.collapse,
+                         ("Products.ConflictErrorLogger",))
+        stack = nested(3, frame_filter)
+        self.assertTrue(nested.func_code not in [c for c, l in stack])
+        frame_filter = FrameFilter(collapse="Products.Conflict")
+        self.assertEqual(nested(3, frame_filter)[-1][0], nested.func_code)
+
+test_Evict_code = change_here.func_code
+
+def test_suite():
+    return unittest.TestSuite((
+         unittest.makeSuite(testStacks),
+    ))
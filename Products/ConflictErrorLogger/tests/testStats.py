@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from ZODB.utils import p64
+from Products.ConflictErrorLogger.stats import HeavyHitters, ConflictStats
+from Products.ConflictErrorLogger.stats import EVENT_CONFLICTS
+from Products.ConflictErrorLogger.stats import DURATION_OVERLAP
+from Products.ConflictErrorLogger.stats import DURATION_CONFLICT
+from Products.ConflictErrorLogger.stats import OTHER_CLASSES
+
+class testHeavyHitters(unittest.TestCase):
+
+    def test_Top(self):
+        counter = HeavyHitters(size=5, width=1024)
+        for i in range(1000):
+            counter.add('key-%s' % i)
+            counter.add('hot', 3)
+            if i % 2:
+                counter.add('warm')
+        self.assertEqual(len(counter.top), 5)
+        self.assertEqual(counter.most_common(2), [(3000, 'hot'),
+                                                  (500, 'warm')])
+        # Never under the real count
+        self.assertTrue(counter.get('key-1') >= 1)
+        self.assertEqual(counter.total, 4500)
+
+    def test_Halve(self):
+        counter = HeavyHitters(size=5)
+        counter.add('hot', 10)
+        counter.add('cold')
+        counter.halve()
+        self.assertEqual(counter.most_common(), [(5, 'hot')])
+        self.assertEqual(counter.get('hot'), 5)
+
+class testConflictStats(unittest.TestCase):
+
+    def test_Top(self):
+        stats = ConflictStats(size=3)
+        for i in range(3):
+            stats.count(EVENT_CONFLICTS, p64(1), 'Foo.Bar', 7)
+        stats.count(EVENT_CONFLICTS, p64(2), 'Foo.Bar')
+        self.assertEqual(stats.totals[EVENT_CONFLICTS], 4)
+        self.assertEqual(stats.top(EVENT_CONFLICTS, 'oid'),
+                         [(3, '0x01'), (1, '0x02')])
+        self.assertEqual(stats.top(EVENT_CONFLICTS, 'class'),
+                         [(4, 'Foo.Bar')])
+        self.assertEqual(stats.top(EVENT_CONFLICTS, 'sig'), [(3, 7)])
+        self.assertRaises(ValueError, stats.top, EVENT_CONFLICTS, 'module')
+        self.assertTrue("oid 0x01: 3" in stats.report())
+
+    def test_Durations(self):
+        stats = ConflictStats(size=1)
+        stats.observe(DURATION_OVERLAP, 'Foo.Bar', 0.05)
+        stats.observe(DURATION_OVERLAP, 'Foo.Bar', 20)
+        # Over the size, the other classes are counted together
+        stats.observe(DURATION_OVERLAP, 'Foo.Baz', 1)
+        stats.observe(DURATION_OVERLAP, 'Foo.Qux', 1)
+        stats.observe(DURATION_CONFLICT, 'Foo.Bar', 400)
+        histogram = stats.durations[(DURATION_OVERLAP, 'Foo.Bar')]
+        self.assertEqual(histogram[:-2], [0, 1, 0, 0, 0, 0, 1, 0, 0, 0])
+        self.assertEqual(histogram[-2:], [2, 20.05])
+        self.assertEqual(stats.durations[(DURATION_OVERLAP, OTHER_CLASSES)],
+                         [0, 0, 0, 2, 0, 0, 0, 0, 0, 0, 2, 2.0])
+        # Up to `size` classes of each kind
+        self.assertEqual(stats.durations[(DURATION_CONFLICT, 'Foo.Bar')][-3],
+                         1)
+        self.assertTrue("class Foo.Bar: 2, mean 10.025s" in stats.report())
+
+def test_suite():
+    return unittest.TestSuite((
+         unittest.makeSuite(testHeavyHitters),
+         unittest.makeSuite(testConflictStats),
+    ))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+from ZODB.utils import p64
+from Products.ConflictErrorLogger.watchlist import Watchlist
+from Products.ConflictErrorLogger.tests.base import PCounter
+
+class testWatchlist(unittest.TestCase):
+
+    def test_Decay(self):
+        watchlist = Watchlist(half_life=60)
+        watchlist.watch(p64(1))
+        self.assertTrue(watchlist.watched(p64(1)))
+        self.assertFalse(watchlist.watched(p64(2)))
+
+        # One hit is watched for one half-life
+        watchlist.oids[p64(1)][1] -= 61
+        self.assertFalse(watchlist.watched(p64(1)))
+        self.assertFalse(p64(1) in watchlist.oids)
+
+        # Frequent hits for longer
+        for i in range(4):
+            watchlist.watch(p64(1))
+        watchlist.oids[p64(1)][1] -= 61
+        self.assertTrue(watchlist.watched(p64(1)))
+
+    def test_Classes(self):
+        watchlist = Watchlist()
+        watchlist.watch(p64(1), PCounter)
+        # Other objects of the class are watched
+        self.assertTrue(watchlist.watched(p64(2), PCounter))
+        self.assertFalse(watchlist.watched(p64(2), Watchlist))
+
+    def test_Size(self):
+        watchlist = Watchlist(size=10)
+        for i in range(25):
+            watchlist.watch(p64(i))
+        self.assertTrue(len(watchlist.oids) <= 10)
+        self.assertTrue(watchlist.watched(p64(24)))
+
+    def test_LoadDump(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, "# seed\n0x2a\n\n"
+                     "Products.ConflictErrorLogger.tests.base.PCounter 4\n")
+        os.close(fd)
+        try:
+            watchlist = Watchlist()
+            watchlist.load(path)
+            self.assertTrue(watchlist.watched(p64(42)))
+            self.assertTrue(watchlist.watched(p64(1), PCounter))
+
+            watchlist.dump(path)
+            loaded = Watchlist()
+            loaded.load(path)
+            self.assertEqual(sorted(loaded.oids), [p64(42)])
+            name = 'Products.ConflictErrorLogger.tests.base.PCounter'
+            self.assertEqual(round(loaded.classes[name][0]), 4)
+        finally:
+            os.remove(path)
+
+def test_suite():
+    return unittest.TestSuite((
+         unittest.makeSuite(testWatchlist),
+    ))
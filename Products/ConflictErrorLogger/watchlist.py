@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+""" Watchlist of the objects (oids) and classes known to conflict.
+
+Each overlap or ConflictError adds 1 to the score of the oid and of its
+class. The scores halve every `half_life` seconds and an entry is watched
+while its score is at least WATCH_THRESHOLD, so one hit is watched for
+`half_life` seconds and frequent hits for longer.
+
+The watchlist can be seeded from a file with one oid (0x...) or dotted class
+name per line, optionally followed by a weight (the score at startup):
+
+    # comments and blank lines are ignored
+    0x3f2a
+    BTrees.OOBTree.OOBucket 8
+"""
+
+import time
+from ZODB.utils import p64, oid_repr
+
+WATCHLIST_HALF_LIFE = 600
+WATCHLIST_MAX_SIZE = 10000
+WATCH_THRESHOLD = 0.5
+
+class Watchlist(object):
+    """ Decaying scores of oids and classes.
+
+    The tables are not locked; concurrent hits may be lost, which only
+    shortens the time an entry is watched.
+    """
+
+    def __init__(self, half_life=WATCHLIST_HALF_LIFE,
+                 size=WATCHLIST_MAX_SIZE):
+        self.half_life = float(half_life)
+        self.size = size
+        # oid or dotted class name -> [score, time of the score]
+        self.oids = {}
+        self.classes = {}
+        # class -> dotted class name
+        self.class_names = {}
+
+    def class_name(self, klass):
+        """ Get the dotted name of the class (or of a dotted name)
+        """
+        if isinstance(klass, basestring):
+            return klass
+        name = self.class_names.get(klass)
+        if name is None:
+            name = "%s.%s" % (klass.__module__, klass.__name__)
+            self.class_names[klass] = name
+        return name
+
+    def score(self, entry, now):
+        """ Get the score of the entry, decayed until now
+        """
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life)
+
+    def watch(self, oid=None, klass=None, weight=1.0):
+        """ The object and its class were involved in an overlap or conflict
+        """
+        now = time.time()
+        if oid is not None:
+            self.hit(self.oids, oid, weight, now)
+        if klass is not None:
+            self.hit(self.classes, self.class_name(klass), weight, now)
+
+    def hit(self, table, key, weight, now):
+        """ Add the weight to the score of the key
+        """
+        entry = table.get(key)
+        if entry is None:
+            if len(table) >= self.size:
+                self.prune(table, now)
+            table[key] = [weight, now]
+        else:
+            entry[0] = self.score(entry, now) + weight
+            entry[1] = now
+
+    def watched(self, oid, klass=None):
+        """ Check if the object or its class is watched
+        """
+        if not (self.oids or self.classes):
+            return False
+        now = time.time()
+        if self.check(self.oids, oid, now):
+            return True
+        if klass is not None and self.classes:
+            return self.check(self.classes, self.class_name(klass), now)
+        return False
+
+    def check(self, table, key, now):
+        """ Check if the key is watched, forget it if decayed
+        """
+        entry = table.get(key)
+        if entry is None:
+            return False
+        if self.score(entry, now) >= WATCH_THRESHOLD:
+            return True
+        # Decayed
+        table.pop(key, None)
+        return False
+
+    def prune(self, table, now):
+        """ Drop the decayed entries of the table, and at least the lowest
+        scored half
+        """
+        items = sorted([(self.score(entry, now), key)
+                        for key, entry in table.items()])
+        for n, (score, key) in enumerate(items):
+            if n >= len(items) // 2 and score >= WATCH_THRESHOLD:
+                break
+            table.pop(key, None)
+
+    def load(self, path):
+        """ Seed the watchlist from a file
+        """
+        f = open(path)
+        try:
+            for line in f:
+                line = line.split('#', 1)[0].split()
+                if not line:
+                    continue
+                weight = 1.0
+                if len(line) > 1:
+                    weight = float(line[1])
+                if line[0].startswith('0x'):
+                    self.watch(oid=p64(int(line[0], 16)), weight=weight)
+                else:
+                    self.watch(klass=line[0], weight=weight)
+        finally:
+            f.close()
+
+    def dump(self, path):
+        """ Write the watched entries to a file (to seed a next start)
+        """
+        now = time.time()
+        f = open(path, 'w')
+        try:
+            for table, key_repr in ((self.oids, oid_repr),
+                                    (self.classes, str)):
+                for key, entry in table.items():
+                    score = self.score(entry, now)
+                    if score >= WATCH_THRESHOLD:
+                        f.write("%s %.2f\n" % (key_repr(key), score))
+        finally:
+            f.close()
+
+    def clear(self):
+        """ Forget all the entries
+        """
+        self.oids = {}
+        self.classes = {}
@@ -42,5 +42,7 @@ setup(name='Products.ConflictErrorLogger',
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      celogger-analyze = Products.ConflictErrorLogger.analyzer:main
       """,
       )